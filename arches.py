@@ -4,6 +4,7 @@ from abc import abstractmethod
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torchvision import models
 
 from resonet.utils import orientation
@@ -23,8 +24,20 @@ class RESNetBase(nn.Module):
         self.fc2_geom = nn.Linear(100+self.ngeom, self.nout, device=self.dev)
         self.Sigmoid = nn.Sigmoid()
 
+    def _checkpointed_resnet(self, x):
+        """same as self.resnet(x), but the activations of each residual stage are recomputed during backward"""
+        r = self.resnet
+        x = r.maxpool(r.relu(r.bn1(r.conv1(x))))
+        for stage in [r.layer1, r.layer2, r.layer3, r.layer4]:
+            x = checkpoint(stage, x, use_reentrant=False)
+        x = torch.flatten(r.avgpool(x), 1)
+        return r.fc(x)
+
     def forward(self, x, y=None):
-        x = self.resnet(x)
+        if self.checkpoint_activations and torch.is_grad_enabled():
+            x = self._checkpointed_resnet(x)
+        else:
+            x = self.resnet(x)
         x = torch.flatten(x, 1)
         if self.dropout:
             x = self.DROP(F.relu(self.fc1(x)))
@@ -141,7 +154,7 @@ class RESNetAny(RESNetBase):
     # not used anywhere yet...
 
     def __init__(self, netnum, dev=None, device_id=0, nout=1, dropout=False, ngeom=5, nchan=1,
-                 weights=None, kernel_size=7):
+                 weights=None, kernel_size=7, checkpoint_activations=False):
         """
 
         :param netnum: resnet number (18,34,50,101,152)
@@ -153,6 +166,8 @@ class RESNetAny(RESNetBase):
         :param nchan: number of channels in input image (e.g. RGB images have 3 channels)
         :param weights: whether to use the pretrained resnet models, and specify weights
         :param kernel_size: the size of the conv1 kernel in the resnet
+        :param checkpoint_activations: during training, only keep the inputs of the residual stages (layer1-4),
+            and recompute their activations in the backward pass (less memory, more compute)
         """
         super().__init__()
         self.dropout = dropout
@@ -172,9 +187,29 @@ class RESNetAny(RESNetBase):
 
         self.binary = False
         self.ori_mode = False
+        self.checkpoint_activations = checkpoint_activations
         self._set_blocks()
 
 
+def saved_activation_bytes(model, *inputs):
+    """
+    :param model: pytorch model
+    :param inputs: model inputs
+    :return: number of bytes of the tensors (other than parameters) saved for the backward pass of model(*inputs)
+    """
+    param_ptrs = {p.data_ptr() for p in model.parameters()}
+    saved = {}
+
+    def pack(tens):
+        if tens.data_ptr() not in param_ptrs:
+            saved[tens.data_ptr()] = tens.nelement() * tens.element_size()
+        return tens
+
+    with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack, lambda tens: tens):
+        model(*inputs)
+    return sum(saved.values())
+
+
 class LeNet(nn.Module):
     def __init__(self, dev=None, nout=1, dropout=False, ngeom=5, nchan=1, kernel_size=None):
         """
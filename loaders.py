@@ -1,17 +1,38 @@
 
 import os
-from torch.utils.data import Dataset
+import bisect
+import csv
+import glob
+import hashlib
+import itertools
+import json
+import time
+from collections import OrderedDict
+from torch.utils.data import Dataset, Sampler, Subset, get_worker_info
 import torch
 import numpy as np
 import h5py
 from resonet.sims import paths_and_const
+from resonet.utils import h5codecs  # registers hdf5plugin filters (if installed) for reading compressed data
+from resonet.utils import sample_cache
+
+# file names in a flat training set folder (see resonet/scripts/export_flat.py)
+FLAT_META = "meta.json"
+FLAT_IMAGES = "images.bin"
+FLAT_LABELS = "labels.npy"
+FLAT_GEOM = "geom.npy"
+
+# supported storage types for training images. uint8 is lossless for images written by
+# resonet.utils.eval_model.to_tens (floor of sqrt, clipped at 65025), and is converted to float on the device
+IMAGE_DTYPES = [np.uint8, np.uint16, np.float16, np.float32]
 
 
 class H5SimDataDset(Dataset):
 
     def __init__(self, h5name, dev=None, labels="labels", images="images",
                  start=None, stop=None, label_sel=None, use_geom=False, transform=None,
-                 half_precision=False, use_sgnums=False, convert_to_float=False):
+                 half_precision=False, use_sgnums=False, convert_to_float=False, cpu_tensors=False,
+                 cache_bytes=0, cache_policy="lru", cache_name=None):
         """
 
         :param h5name: hdf5 master file written by resonet/scripts/merge_h5s.py
@@ -28,6 +49,16 @@ class H5SimDataDset(Dataset):
             The geom tensor can be used as a secondary input to certain models
         :param use_sgnums:
         :param convert_to_float: automatically convert to float32 if h5 data are in compressed format
+        :param cpu_tensors: return CPU tensors from __getitem__ and ignore `dev`. Use this when loading
+            with DataLoader worker processes, and move each collated batch with `batch_to_dev`.
+            uint8 images are then returned as uint8, and batch_to_dev converts them to float on the device
+        :param cache_bytes: if >0, keep up to this many bytes of decoded images (converted to the training dtype)
+            in shared memory, see resonet.utils.sample_cache. All processes on a node (DDP ranks and
+            DataLoader workers) opening the same data share the cache, so images are read once per node
+        :param cache_policy: `lru` (evict the least recently used images) or `first` (cache the first images read,
+            until the cache is full)
+        :param cache_name: shared memory name of the cache. By default it is derived from the input file and the
+            image dtype, and is the same for all ranks
         """
         if label_sel is None:
             label_sel = [0]
@@ -45,10 +76,7 @@ class H5SimDataDset(Dataset):
         self.transform = transform
         self.half_precision = half_precision
         self.has_geom = False  # if geometry is present in master file, it can be used as model input
-        # open to get length quickly!
-        with h5py.File(h5name, "r") as h:
-            self.num_images = h[self.images_name].shape[0]
-            self.has_geom = "geom" in list(h.keys())
+        self._probe()
         if use_geom and not self.has_geom:
             raise ValueError("Cannot use geometry if it is not present in the master files. requires `geom` dataset")
         self.use_geom = use_geom and self.has_geom
@@ -73,6 +101,30 @@ class H5SimDataDset(Dataset):
         self.sgnums = None
         self._setup_sgmaps()
         self.convert_to_float = convert_to_float
+        self.cpu_tensors = cpu_tensors
+        # bytes and seconds of the batched reads, one row per loading process (see share_read_stats)
+        self.read_stats = torch.zeros((1, 2), dtype=torch.float64)
+        self.cache = None
+        if cache_bytes > 0:
+            cache_dtype = self._cache_dtype()
+            if cache_name is None:
+                cache_name = sample_cache.cache_name(os.path.abspath(self.h5name), self.images_name,
+                                                      self.num_images, cache_dtype.str)
+            self.cache = sample_cache.SharedSampleCache(cache_name, self.num_images, self.image_shape, cache_dtype,
+                                           cache_bytes, cache_policy)
+
+    def _probe(self):
+        """sets the number of images, their layout, and whether geom is present"""
+        # open to get length quickly!
+        with h5py.File(self.h5name, "r") as h:
+            imgs = h[self.images_name]
+            self.num_images = imgs.shape[0]
+            self.image_shape = imgs.shape[1:]
+            self.image_dtype = imgs.dtype
+            self.image_nbytes = int(np.prod(imgs.shape[1:])) * imgs.dtype.itemsize
+            self.chunk_len = imgs.chunks[0] if imgs.chunks is not None else None
+            self.source_edges = get_source_edges(imgs)
+            self.has_geom = "geom" in list(h.keys())
 
     def _setup_sgmaps(self):
         if not self.use_sgnums:
@@ -102,27 +154,25 @@ class H5SimDataDset(Dataset):
     def open(self):
         self.h5 = h5py.File(self.h5name, "r")
         self.images = self.h5[self.images_name]
-        assert self.images.dtype in [np.uint16, np.float16, np.float32]
+        assert self.images.dtype in IMAGE_DTYPES
         if self.images.dtype!=np.float32 and not self.convert_to_float:
             raise ValueError("Images should be type float32!")
-        self.labels = self.h5[self.labels_name][:, self.label_sel]
-        lab_dt = self.labels.dtype
-        if not self.half_precision and lab_dt != np.float32:
-            self.labels = self.labels.astype(np.float32)
-        elif self.half_precision and lab_dt != np.float16:
-            self.labels = self.labels.astype(np.float16)
+        self.labels = self._to_precision(self.h5[self.labels_name][:, self.label_sel])
         if self.use_geom:
             geom_dset = self.h5["geom"]
-            self.geom = self.get_geom(geom_dset)
-            geom_dt = self.geom.dtype
-            if not self.half_precision and geom_dt!=np.float32:
-                self.geom = self.geom.astype(np.float32)
-            elif self.half_precision and geom_dt != np.float16:
-                self.geom = self.geom.astype(np.float16)
+            self.geom = self._to_precision(self.get_geom(geom_dset))
 
         if self.use_sgnums:
             self.get_sgnums()
 
+    def _to_precision(self, arr):
+        """cast labels or geometry to the training precision"""
+        if not self.half_precision and arr.dtype != np.float32:
+            arr = arr.astype(np.float32)
+        elif self.half_precision and arr.dtype != np.float16:
+            arr = arr.astype(np.float16)
+        return arr
+
     def get_sgnums(self):
         pdbmap = {i: os.path.basename(f) for i,f in
                    enumerate(self.h5[self.labels_name].attrs['pdbmap'])}
@@ -131,11 +181,18 @@ class H5SimDataDset(Dataset):
         self.sgnums = [self.pdb_id_to_num[p] for p in pdb_id_per_img]
 
     def get_geom(self, geom_dset):
-        ngeom = geom_dset.shape[-1]
-        inds = list(range(ngeom))
+        names = None
         if "names" in geom_dset.attrs:
             names = list(geom_dset.attrs["names"])
+        inds = self._geom_inds(names, geom_dset.shape[-1])
+        geom = geom_dset[()][:, inds]
+        return geom
 
+    @staticmethod
+    def _geom_inds(names, ngeom):
+        """column order of the geometry model input (detdist, pixsize, wavelen, xdim, ydim)"""
+        inds = list(range(ngeom))
+        if names is not None:
             try:
                 inds = [names.index("detdist"),
                         names.index('pixsize'),
@@ -144,8 +201,7 @@ class H5SimDataDset(Dataset):
                     names.index("ydim")]
             except ValueError:
                 pass
-        geom = geom_dset[()][:, inds]
-        return geom
+        return inds
 
     @property
     def dev(self):
@@ -159,29 +215,127 @@ class H5SimDataDset(Dataset):
         return self.stop - self.start
 
     def __getitem__(self, i):
-        assert self.dev is not None
+        if self.cache is not None:
+            return self.__getitems__([i])[0]
+        assert self.dev is not None or self.cpu_tensors
         if self.images is None:
             self.open()
-        img_dat, img_lab = self.images[i + self.start], self.labels[i + self.start]
-        if len(img_dat.shape) == 2:
-            img_dat = img_dat[None]
-        if self.half_precision and not self.images.dtype==np.float16:
+        img_dat = self._convert_image(self.images[i + self.start])
+        return self._make_sample(i, img_dat)
+
+    def __getitems__(self, indices):
+        """
+        batched version of __getitem__, used automatically by DataLoader.
+        Images are fetched with one sorted read per source file instead of one read per index
+        :param indices: list of dataset indices
+        :return: list of samples, same as [self[i] for i in indices]
+        """
+        assert self.dev is not None or self.cpu_tensors
+        if self.images is None:
+            self.open()
+        img_dats = self._read_cached(np.asarray(indices) + self.start)
+        return [self._make_sample(i, img_dat) for i, img_dat in zip(indices, img_dats)]
+
+    def _read_cached(self, inds):
+        """
+        :param inds: global (h5 dataset) indices
+        :return: list of images at inds converted to the training dtype, from the sample cache where possible
+        """
+        img_dats = [None]*len(inds)
+        if self.cache is not None:
+            img_dats = self.cache.get(inds)
+        missing = [i for i, img_dat in enumerate(img_dats) if img_dat is None]
+        if not missing:
+            return img_dats
+        t = time.time()
+        read = [self._convert_image(img_dat) for img_dat in self._read_images(inds[missing])]
+        # each DataLoader worker has its own row, so no two processes update the same values
+        worker = get_worker_info()
+        row = 0 if worker is None or len(self.read_stats) == 1 else worker.id + 1
+        self.read_stats[row, 0] += len(missing)*self.image_nbytes
+        self.read_stats[row, 1] += time.time()-t
+        if self.cache is not None:
+            self.cache.put(inds[missing], read)
+        for i, img_dat in zip(missing, read):
+            img_dats[i] = img_dat
+        return img_dats
+
+    def share_read_stats(self, num_workers):
+        """
+        keep the read statistics in shared memory, so reads in DataLoader worker processes are counted
+        by get_read_stats in the main process. Call before the DataLoader workers are started
+        :param num_workers: number of DataLoader worker processes
+        """
+        self.read_stats = torch.zeros((num_workers+1, 2), dtype=torch.float64).share_memory_()
+
+    def get_read_stats(self):
+        """
+        :return: number of image bytes read from disk (sample cache hits excluded), and the seconds spent
+            reading and decompressing them, summed over the loading processes since the dataset was created
+        """
+        nbytes, seconds = self.read_stats.sum(0).tolist()
+        return nbytes, seconds
+
+    def _read_images(self, inds):
+        """
+        :param inds: global (h5 dataset) indices
+        :return: images at inds, in the order of inds
+        """
+        uniq, inverse = np.unique(inds, return_inverse=True)
+        # h5py selections must be increasing, and must not cross virtual source boundaries to be fast
+        file_ids = np.searchsorted(self.source_edges, uniq, side="right")
+        groups = np.split(uniq, np.where(np.diff(file_ids))[0] + 1)
+        img_dats = np.concatenate([self._read_sorted(group) for group in groups])
+        return img_dats[inverse]
+
+    def _read_sorted(self, inds):
+        """read images at increasing global indices that all lie in one source file"""
+        return read_rows(self.images, inds)
+
+    def _sample_meta(self, i):
+        """labels, geom (or None) and sgnum (or None) of dataset index i"""
+        geom = self.geom[i+self.start] if self.use_geom else None
+        sgnum = self.sgnums[i+self.start] if self.use_sgnums else None
+        return self.labels[i + self.start], geom, sgnum
+
+    def _convert_image(self, img_dat):
+        """convert a stored image to the training dtype (uint8 images are converted on the device, in _make_sample)"""
+        if self.image_dtype == np.uint8:
+            return img_dat
+        if self.half_precision and not self.image_dtype==np.float16:
             #print("Warning, converting images from float32 to float16. This could slow things down.")
             img_dat = img_dat.astype(np.float16)
-        if self.convert_to_float and not self.images.dtype==np.float32:
+        if self.convert_to_float and not self.image_dtype==np.float32:
             img_dat = img_dat.astype(np.float32)
-        img_dat = torch.tensor(img_dat).to(self.dev)
+        return img_dat
+
+    def _cache_dtype(self):
+        """dtype of the images returned by _convert_image"""
+        return self._convert_image(np.zeros(1, self.image_dtype)).dtype
+
+    def _make_sample(self, i, img_dat):
+        """
+        :param i: dataset index
+        :param img_dat: image at dataset index i, converted with _convert_image
+        """
+        # tensors stay on the CPU when loading in worker processes
+        dev = "cpu" if self.cpu_tensors else self.dev
+        img_lab, geom_inputs, sgnums = self._sample_meta(i)
+        if len(img_dat.shape) == 2:
+            img_dat = img_dat[None]
+        img_dat = torch.from_numpy(img_dat).to(dev)
+        if self.image_dtype == np.uint8 and not self.cpu_tensors:
+            # the 8-bit data were copied, and are only converted to float on the device
+            img_dat = img_dat.to(torch.float16 if self.half_precision else torch.float32)
         # if we are applying image augmentation
         if self.transform:
             img_dat = self.transform(img_dat)
-        img_lab = torch.tensor(img_lab).to(self.dev)
+        img_lab = torch.tensor(img_lab).to(dev)
         if self.use_geom:
-            geom_inputs = self.geom[i+self.start]
-            geom_inputs = torch.tensor(geom_inputs).to(self.dev)
+            geom_inputs = torch.tensor(geom_inputs).to(dev)
             return img_dat, img_lab, geom_inputs
         elif self.use_sgnums:
-            sgnums = self.sgnums[i+self.start]
-            sgnums = torch.tensor(sgnums).to(self.dev)
+            sgnums = torch.tensor(sgnums).to(dev)
             return img_dat, img_lab, sgnums
         else:
             return img_dat, img_lab
@@ -190,6 +344,611 @@ class H5SimDataDset(Dataset):
         return self.nlab
 
 
+class MemmapSimDataDset(H5SimDataDset):
+
+    def __init__(self, flatdir, *args, **kwargs):
+        """
+        Serves the flat, page-aligned image store written by resonet/scripts/export_flat.py
+        Images are memory-mapped, so samples are views into the page cache, shared by all
+        DataLoader workers and ranks on a node. Arguments are the same as for H5SimDataDset
+        (labels and images are ignored).
+
+        :param flatdir: output folder of export_flat.py
+        """
+        self.meta = self.load_meta(flatdir)
+        super().__init__(flatdir, *args, **kwargs)
+
+    @staticmethod
+    def load_meta(flatdir):
+        with open(os.path.join(flatdir, FLAT_META), "r") as f:
+            meta = json.load(f)
+        return meta
+
+    def _probe(self):
+        self.num_images = self.meta["num_images"]
+        self.image_shape = tuple(self.meta["shape"])
+        self.image_dtype = np.dtype(self.meta["dtype"])
+        self.image_nbytes = int(np.prod(self.meta["shape"])) * np.dtype(self.meta["dtype"]).itemsize
+        self.chunk_len = None
+        self.source_edges = np.array([0])
+        self.has_geom = self.meta["geom_names"] is not None
+
+    @staticmethod
+    def _get_label_sel_from_label_names(fname, dset_name, label_names):
+        names = MemmapSimDataDset.load_meta(fname)["label_names"]
+        if names is None:
+            raise KeyError("the labels in %s have no names" % fname)
+        label_sel = []
+        for name in label_names:
+            if name not in names:
+                raise ValueError("label name '%s' is not in label names (in %s)" % (name, fname))
+            label_sel.append(names.index(name))
+        return label_sel
+
+    def open(self):
+        dtype = np.dtype(self.meta["dtype"])
+        shape = tuple(self.meta["shape"])
+        # copy-on-write, so views are writable (torch.from_numpy) but the file is never modified
+        records = np.memmap(os.path.join(self.h5name, FLAT_IMAGES), dtype=dtype, mode="c",
+                            shape=(self.num_images, self.meta["stride"] // dtype.itemsize))
+        self.images = records[:, :int(np.prod(shape))].reshape((self.num_images,) + shape)
+        assert self.images.dtype in IMAGE_DTYPES
+        if self.images.dtype!=np.float32 and not self.convert_to_float:
+            raise ValueError("Images should be type float32!")
+        labels = np.load(os.path.join(self.h5name, FLAT_LABELS))
+        self.labels = self._to_precision(labels[:, self.label_sel])
+        if self.use_geom:
+            geom = np.load(os.path.join(self.h5name, FLAT_GEOM))
+            inds = self._geom_inds(self.meta["geom_names"], geom.shape[-1])
+            self.geom = self._to_precision(geom[:, inds])
+
+        if self.use_sgnums:
+            self.get_sgnums()
+
+    def get_sgnums(self):
+        pdbmap = {i: os.path.basename(f) for i, f in enumerate(self.meta["pdbmap"])}
+        pdb_i = self.meta["label_names"].index("pdb")
+        labels = np.load(os.path.join(self.h5name, FLAT_LABELS), mmap_mode="r")
+        pdb_id_per_img = [pdbmap[i] for i in labels[:, pdb_i].astype(int)]
+        self.sgnums = [self.pdb_id_to_num[p] for p in pdb_id_per_img]
+
+    def _read_images(self, inds):
+        # views into the memory map, no copies
+        return [self.images[i] for i in inds]
+
+
+class H5MultiFileDset(H5SimDataDset):
+
+    def __init__(self, paths, *args, prefix="rank", max_open=128, index=None, **kwargs):
+        """
+        Reads the rank*.h5 files from the simulations directly, without a virtual master file.
+        A global index is mapped to (file, local index) with a cumulative-offset index,
+        and at most `max_open` files are kept open at once. Other arguments are the same as for H5SimDataDset.
+        All files should have the same image shape and dtype, and the same labels names.
+
+        :param paths: list of folders and/or h5 files (ignored if index is provided)
+        :param prefix: in folders, read files matching {prefix}*h5
+        :param max_open: maximum number of open file handles (least recently used are closed first)
+        :param index: optional index sidecar written by merge_h5s.py (master_index.json). The files and their
+            image counts are then read from the index, instead of opening every file at startup
+        """
+        self.counts = None
+        if index is not None:
+            with open(index, "r") as f:
+                files = json.load(f)["files"]
+            paths = [f["name"] for f in files]
+            self.counts = [f["count"] for f in files]
+        if isinstance(paths, str):
+            paths = [paths]
+        self.fnames = self.find_files(paths, prefix)
+        if not self.fnames:
+            raise OSError("No %s*h5 files found in %s" % (prefix, ", ".join(paths)))
+        self.max_open = max_open
+        self.handles = None  # pool of open h5py files
+        self.file_meta = {}  # labels, geom and sgnums per file, loaded when a file is first opened
+        super().__init__(self.fnames[0], *args, **kwargs)
+
+    @staticmethod
+    def find_files(paths, prefix="rank"):
+        fnames = []
+        for path in paths:
+            if os.path.isdir(path):
+                fnames += sorted(glob.glob(os.path.join(path, "%s*h5" % prefix)))
+            else:
+                fnames.append(path)
+        return [os.path.abspath(f) for f in fnames]
+
+    def _probe(self):
+        if self.counts is None:
+            self.counts = []
+            for f in self.fnames:
+                with h5py.File(f, "r") as h:
+                    self.counts.append(h[self.labels_name].shape[0])
+        self._set_offsets(self.counts)
+        with h5py.File(self.fnames[0], "r") as h:
+            imgs = h[self.images_name]
+            self.image_shape = imgs.shape[1:]
+            self.image_dtype = imgs.dtype
+            self.image_nbytes = int(np.prod(imgs.shape[1:])) * imgs.dtype.itemsize
+            self.chunk_len = imgs.chunks[0] if imgs.chunks is not None else None
+            self.has_geom = "geom" in list(h.keys())
+
+    def _set_offsets(self, counts):
+        self.offsets = np.cumsum([0] + list(counts))
+        self.num_images = int(self.offsets[-1])
+        self.source_edges = self.offsets[:-1]
+
+    def open(self):
+        self.handles = OrderedDict()
+        # the first file stays open, its images dataset is used for dtype checks
+        self.h5 = h5py.File(self.fnames[0], "r")
+        self.images = self.h5[self.images_name]
+        assert self.images.dtype in IMAGE_DTYPES
+        if self.images.dtype!=np.float32 and not self.convert_to_float:
+            raise ValueError("Images should be type float32!")
+
+    def _get_handle(self, i_f):
+        if i_f in self.handles:
+            self.handles.move_to_end(i_f)
+            return self.handles[i_f]
+        h = h5py.File(self.fnames[i_f], "r")
+        imgs = h[self.images_name]
+        if imgs.shape[1:] != self.image_shape or imgs.dtype != self.image_dtype:
+            raise ValueError("images in %s have shape %s and dtype %s, expected %s and %s"
+                             % (self.fnames[i_f], imgs.shape[1:], imgs.dtype, self.image_shape, self.image_dtype))
+        if i_f not in self.file_meta:
+            self.file_meta[i_f] = self._load_file_meta(h)
+        self.handles[i_f] = h
+        if len(self.handles) > self.max_open:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+        return h
+
+    def _load_file_meta(self, h):
+        labels_dset = h[self.labels_name]
+        all_labels = labels_dset[()]
+        labels = self._to_precision(all_labels[:, self.label_sel])
+        geom = sgnums = None
+        if self.use_geom:
+            geom = self._to_precision(self.get_geom(h["geom"]))
+        if self.use_sgnums:
+            pdbmap = {i: os.path.basename(f) for i, f in enumerate(labels_dset.attrs['pdbmap'])}
+            pdb_i = list(labels_dset.attrs['names']).index('pdb')
+            sgnums = [self.pdb_id_to_num[pdbmap[i]] for i in all_labels[:, pdb_i].astype(int)]
+        return labels, geom, sgnums
+
+    def _locate(self, i):
+        """file index and local index of global index i"""
+        i_f = bisect.bisect_right(self.offsets, i) - 1
+        return i_f, i - self.offsets[i_f]
+
+    def _read_sorted(self, inds):
+        i_f, _ = self._locate(inds[0])
+        h = self._get_handle(i_f)
+        return read_rows(h[self.images_name], np.asarray(inds) - self.offsets[i_f])
+
+    def _sample_meta(self, i):
+        i_f, local = self._locate(i + self.start)
+        if i_f not in self.file_meta:
+            self._get_handle(i_f)
+        labels, geom, sgnums = self.file_meta[i_f]
+        geom = geom[local] if self.use_geom else None
+        sgnum = sgnums[local] if self.use_sgnums else None
+        return labels[local], geom, sgnum
+
+    def __getitem__(self, i):
+        return self.__getitems__([i])[0]
+
+
+class ImageFileDset(Dataset):
+
+    # CSV columns that are not labels
+    META_COLUMNS = ["image", "filenum", "detdist", "wavelen", "pixsize", "gain", "cent_fast", "cent_slow"]
+    CACHE_VERSION = 1  # bump when the preprocessing changes, to invalidate cached files
+
+    def __init__(self, csvname, dev=None, label_sel=None, use_geom=False, start=None, stop=None,
+                 half_precision=False, cpu_tensors=False, cache_dir=None, reader="fabio",
+                 quad="A", ds_stride=2, hash_contents=False):
+        """
+        Real diffraction images (e.g. CBF or NeXus files) listed in a CSV file, for fine-tuning.
+        Each raw image is decoded, masked, and reduced to a 512x512 quad with eval_model.to_tens (in the DataLoader
+        workers), and the result is saved in a content-addressed cache folder, so later epochs and
+        later runs skip the decoding and downsampling. Samples are the same as for H5SimDataDset
+        (images are stored as uint8, which is lossless for to_tens output).
+
+        CSV columns: `image` (path to the file), and one column per label (e.g. one_over_reso).
+        Optional columns: `filenum` (image number in multi-image files), `detdist` (mm), `wavelen` (Angstrom),
+        `pixsize` (mm), `gain` (adu per photon), and `cent_fast`, `cent_slow` (beam center in pixels).
+        If the geometry columns are missing and use_geom=True, the geometry is read from the file (dxtbx reader only).
+
+        :param csvname: CSV file
+        :param dev: pytorch device
+        :param label_sel: names or indices of the label columns (default is the first label column)
+        :param use_geom: also return the geometry tensor (detdist, pixsize, wavelen, xdim, ydim)
+        :param start: index of the first CSV row to use
+        :param stop: index of the CSV row to stop
+        :param half_precision: return float16 labels and geometry (and images, on the device)
+        :param cpu_tensors: return CPU tensors, see H5SimDataDset
+        :param cache_dir: folder of the preprocessed images (default is {csv name}_cache, next to the CSV)
+        :param reader: `fabio` (ImagePredictFabio.get_image_array) or `dxtbx` (ImagePredictDxtbx.get_image_array)
+        :param quad: which quad to_tens extracts (A, B, C or D)
+        :param ds_stride: downsampling factor of the quad (2 for Pilatus 6M, 4 for Eiger 16M)
+        :param hash_contents: address cached images by a hash of the image file contents, instead of by
+            file path, size and modification time. Robust to moving the data. The hash of each file is computed once,
+            and kept in cache_dir/hashes until the file size or modification time changes (or the file is moved)
+        """
+        if reader not in ["fabio", "dxtbx"]:
+            raise ValueError("reader should be fabio or dxtbx")
+        with open(csvname, "r") as f:
+            rows = list(csv.DictReader(f))
+        if not rows or "image" not in rows[0]:
+            raise KeyError("CSV file %s needs an `image` column" % csvname)
+        csv_dir = os.path.dirname(os.path.abspath(csvname))
+        self.fnames = [os.path.join(csv_dir, row["image"]) for row in rows]
+        self.filenums = [int(row.get("filenum") or 0) for row in rows]
+        self.label_names = [col for col in rows[0] if col not in self.META_COLUMNS]
+        if label_sel is None:
+            label_sel = [0]
+        elif all([isinstance(l, str) for l in label_sel]):
+            for name in label_sel:
+                if name not in self.label_names:
+                    raise ValueError("label name '%s' is not a column in %s" % (name, csvname))
+            label_sel = [self.label_names.index(name) for name in label_sel]
+        self.label_sel = label_sel
+        self.nlab = len(label_sel)
+        labels = np.array([[float(row[name]) for name in self.label_names] for row in rows], np.float32)
+        self.labels = labels[:, label_sel].astype(np.float16 if half_precision else np.float32)
+
+        def column(name, default):
+            return np.array([float(row[name]) if row.get(name) not in (None, "") else default for row in rows])
+        self.gains = column("gain", 1)
+        self.cents = np.stack([column("cent_fast", np.nan), column("cent_slow", np.nan)], axis=1)
+        self.csv_geom = np.stack([column(name, np.nan) for name in ["detdist", "pixsize", "wavelen"]], axis=1)
+        if use_geom and reader == "fabio" and np.any(np.isnan(self.csv_geom)):
+            raise ValueError("use_geom requires the detdist, wavelen and pixsize columns (or reader=dxtbx)")
+
+        self.use_geom = use_geom
+        self.half_precision = half_precision
+        self.cpu_tensors = cpu_tensors
+        self.dev = dev
+        self.reader = reader
+        self.quad = quad
+        self.ds_stride = ds_stride
+        self.hash_contents = hash_contents
+        self._content_hashes = {}  # path: ((size, mtime), sha1), per process
+        if cache_dir is None:
+            cache_dir = os.path.splitext(os.path.abspath(csvname))[0] + "_cache"
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self.num_images = len(rows)
+        self.start = 0 if start is None else start
+        self.stop = self.num_images if stop is None else stop
+        assert 0 <= self.start < self.stop <= self.num_images
+        self.image_shape = 512, 512
+        self.image_dtype = np.dtype(np.uint8)
+        self.image_nbytes = 512*512
+        self.cache = None  # no shared-memory sample cache (see H5SimDataDset)
+        self.cache_stats = {"hits": 0, "misses": 0}  # per process
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def content_hash(self, fname):
+        """
+        sha1 of the contents of fname. It is remembered in this process, and saved in cache_dir/hashes
+        for the other processes and later runs, until the size or modification time of the file changes
+        """
+        stat = os.stat(fname)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        if fname in self._content_hashes and self._content_hashes[fname][0] == stamp:
+            return self._content_hashes[fname][1]
+        index_name = os.path.join(self.cache_dir, "hashes", hashlib.sha1(fname.encode()).hexdigest() + ".json")
+        digest = None
+        if os.path.exists(index_name):
+            with open(index_name, "r") as f:
+                entry = json.load(f)
+            if entry["stamp"] == stamp:
+                digest = entry["sha1"]
+        if digest is None:
+            with open(fname, "rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            os.makedirs(os.path.dirname(index_name), exist_ok=True)
+            tmp_name = "%s.%d.tmp" % (index_name, os.getpid())
+            with open(tmp_name, "w") as f:
+                json.dump({"path": fname, "stamp": stamp, "sha1": digest}, f)
+            os.replace(tmp_name, index_name)
+        self._content_hashes[fname] = stamp, digest
+        return digest
+
+    def cache_key(self, i):
+        """hash of the image file (or its path, size and mtime) and the preprocessing parameters of CSV row i"""
+        fname = os.path.realpath(self.fnames[i])
+        if self.hash_contents:
+            source = self.content_hash(fname)
+        else:
+            stat = os.stat(fname)
+            source = [fname, stat.st_size, stat.st_mtime_ns]
+        cent = None if np.any(np.isnan(self.cents[i])) else list(self.cents[i])
+        params = [source, self.filenums[i], float(self.gains[i]), cent, self.quad, self.ds_stride,
+                  self.reader, self.CACHE_VERSION]
+        return hashlib.sha1(json.dumps(params).encode()).hexdigest()
+
+    def _read_raw(self, i):
+        """raw image and the (detdist, pixsize, wavelen) of CSV row i, from the image file"""
+        file_geom = np.full(3, np.nan)
+        if self.reader == "fabio":
+            from resonet.utils.predict_fabio import ImagePredictFabio
+            raw_image = ImagePredictFabio.get_image_array(self.fnames[i]).astype(np.float32)
+        else:
+            from resonet.utils.predict_dxtbx import ImagePredictDxtbx
+            raw_image, det, beam = ImagePredictDxtbx.get_image_array(self.fnames[i], self.filenums[i])
+            file_geom[:] = abs(det[0].get_distance()), det[0].get_pixel_size()[0], beam.get_wavelength()
+        return raw_image, file_geom
+
+    def _preprocess(self, i):
+        """decode and downsample CSV row i, see ImagePredict._set_pixel_tensor"""
+        from scipy.ndimage import binary_dilation
+        from resonet.utils.eval_model import to_tens
+        raw_image, file_geom = self._read_raw(i)
+        mask = raw_image >= 0
+        mask = ~binary_dilation(~mask, iterations=1)
+        cent = None if np.any(np.isnan(self.cents[i])) else tuple(self.cents[i])
+        maxpool = torch.nn.MaxPool2d(self.ds_stride, self.ds_stride)
+        quad = to_tens(raw_image / self.gains[i], mask, maxpool=maxpool, cent=cent,
+                       ds_fact=self.ds_stride, quad=self.quad)
+        # to_tens output is the floor of the sqrt of values clipped at 65025, so uint8 is lossless
+        img = quad.numpy().reshape(self.image_shape).astype(np.uint8)
+        dims = np.array(raw_image.shape[::-1], np.float64)  # xdim, ydim
+        return img, np.concatenate([file_geom, dims])
+
+    def load(self, i):
+        """
+        :param i: CSV row
+        :return: the preprocessed image (uint8, 512x512), and the geometry read from the file
+            (detdist, pixsize, wavelen, xdim, ydim; the first three are nan for the fabio reader)
+        """
+        key = self.cache_key(i)
+        cache_name = os.path.join(self.cache_dir, key[:2], key + ".npz")
+        if os.path.exists(cache_name):
+            self.cache_stats["hits"] += 1
+            with np.load(cache_name) as cached:
+                return cached["img"], cached["geom"]
+        self.cache_stats["misses"] += 1
+        img, geom = self._preprocess(i)
+        os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+        # write then rename, so concurrent workers and ranks never read a partial file
+        tmp_name = "%s.%d.tmp.npz" % (cache_name[:-4], os.getpid())
+        np.savez(tmp_name, img=img, geom=geom)
+        os.replace(tmp_name, cache_name)
+        return img, geom
+
+    def __getitem__(self, i):
+        assert self.dev is not None or self.cpu_tensors
+        dev = "cpu" if self.cpu_tensors else self.dev
+        img, file_geom = self.load(i + self.start)
+        img_dat = torch.from_numpy(img[None]).to(dev)
+        if not self.cpu_tensors:
+            img_dat = img_dat.to(torch.float16 if self.half_precision else torch.float32)
+        img_lab = torch.tensor(self.labels[i + self.start]).to(dev)
+        if self.use_geom:
+            geom = file_geom.copy()
+            csv_geom = self.csv_geom[i + self.start]
+            geom[:3] = np.where(np.isnan(csv_geom), geom[:3], csv_geom)
+            geom = torch.tensor(geom.astype(self.labels.dtype)).to(dev)
+            return img_dat, img_lab, geom
+        return img_dat, img_lab
+
+
+def read_rows(dset, rows):
+    """
+    :param dset: h5py dataset (or array)
+    :param rows: increasing indices along axis 0
+    :return: dset[rows], read as one hyperslab if the rows are contiguous
+    """
+    first, last = rows[0], rows[-1]
+    if last - first + 1 == len(rows):
+        return dset[first:last+1]
+    return dset[list(rows)]
+
+
+def get_source_edges(dset):
+    """
+    :param dset: h5py dataset (e.g. the images in a master file written by merge_h5s.py)
+    :return: sorted array of the first index of each virtual source file along axis 0 ([0] if not virtual)
+    """
+    edges = [0]
+    if dset.is_virtual:
+        edges += [vs.vspace.get_select_bounds()[0][0] for vs in dset.virtual_sources()]
+    return np.unique(edges)
+
+
+def unwrap_subset(data_source):
+    """
+    :param data_source: H5SimDataDset, or a (possibly nested) torch Subset of one, e.g. from random_split
+    :return: the underlying dataset, and the dataset index of each position in data_source
+    """
+    inds = np.arange(len(data_source))
+    while isinstance(data_source, Subset):
+        inds = np.asarray(data_source.indices)[inds]
+        data_source = data_source.dataset
+    return data_source, inds
+
+
+class ChunkBatchSampler(Sampler):
+
+    def __init__(self, data_source, batch_size, block_size=64, window=4, shuffle=True, seed=0,
+                 num_replicas=1, rank=0):
+        """
+        Batch sampler that groups each batch by source file and chunk, so the batched reads in
+        H5SimDataDset.__getitems__ touch few files and chunks. Each epoch the blocks (contiguous,
+        chunk-aligned index ranges within one source file) are shuffled, then `window` blocks at a time
+        are pooled and shuffled before being split into batches. Randomness is per epoch, but
+        samples are only shuffled within a window, not across the whole dataset.
+
+        :param data_source: H5SimDataDset or a Subset of one
+        :param batch_size: number of samples per batch
+        :param block_size: number of consecutive images per block (rounded up to a multiple of the h5 chunk size)
+        :param window: number of blocks pooled together when forming batches
+        :param shuffle: whether to shuffle blocks and samples
+        :param seed: random seed, combined with the epoch (see set_epoch). Should agree across ranks.
+        :param num_replicas: number of distributed ranks
+        :param rank: distributed rank of this process
+        """
+        dset, inds = unwrap_subset(data_source)
+        inds = inds + dset.start
+        chunk_len = dset.chunk_len or 1
+        block_size = int(np.ceil(max(block_size, chunk_len) / chunk_len)) * chunk_len
+
+        # block edges: source file boundaries, and every block_size images within a source
+        edges = []
+        file_edges = list(dset.source_edges) + [dset.num_images]
+        for first, last in zip(file_edges[:-1], file_edges[1:]):
+            edges += list(range(first, last, block_size))
+        block_ids = np.searchsorted(edges, inds, side="right") - 1
+        order = np.argsort(block_ids, kind="stable")
+        splits = np.where(np.diff(block_ids[order]))[0] + 1
+        self.blocks = np.split(order, splits)  # positions in data_source, per block
+
+        self.batch_size = batch_size
+        self.window = window
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        nbatch = int(np.ceil(len(inds) / batch_size))
+        self.num_batches = int(np.ceil(nbatch / num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _all_batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        blocks = self.blocks
+        if self.shuffle:
+            blocks = [blocks[i_b] for i_b in rng.permutation(len(blocks))]
+        positions = []
+        for i_b in range(0, len(blocks), self.window):
+            pool = np.concatenate(blocks[i_b: i_b+self.window])
+            if self.shuffle:
+                pool = rng.permutation(pool)
+            positions.append(pool)
+        positions = np.concatenate(positions)
+        batches = [positions[i: i+self.batch_size].tolist() for i in range(0, len(positions), self.batch_size)]
+        # pad so each rank gets the same number of batches (as in DistributedSampler)
+        npad = self.num_batches*self.num_replicas - len(batches)
+        batches += batches[:npad]
+        return batches
+
+    def __iter__(self):
+        batches = self._all_batches()
+        return iter(batches[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return self.num_batches
+
+
+class ShardShuffleSampler(Sampler):
+
+    def __init__(self, data_source, buffer_size=1000, shuffle=True, seed=0, num_replicas=1, rank=0):
+        """
+        Sampler for pre-shuffled shards (see resonet/scripts/make_shards.py), in the style of WebDataset.
+        Shards are the virtual source files of a master file. Each epoch the shard order is shuffled,
+        each shard is read sequentially, and samples are shuffled through an in-memory buffer.
+        Ranks read contiguous stretches of the shuffled shard sequence.
+
+        :param data_source: H5SimDataDset or a Subset of one
+        :param buffer_size: number of indices in the shuffle buffer
+        :param shuffle: whether to shuffle shards and samples
+        :param seed: random seed, combined with the epoch (see set_epoch). Should agree across ranks.
+        :param num_replicas: number of distributed ranks
+        :param rank: distributed rank of this process
+        """
+        dset, inds = unwrap_subset(data_source)
+        inds = inds + dset.start
+        shard_ids = np.searchsorted(dset.source_edges, inds, side="right") - 1
+        order = np.lexsort((inds, shard_ids))  # by shard, then sequentially within a shard
+        splits = np.where(np.diff(shard_ids[order]))[0] + 1
+        self.shards = np.split(order, splits)  # positions in data_source, per shard
+
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.num_samples = int(np.ceil(len(inds) / num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        shards = self.shards
+        if self.shuffle:
+            shards = [shards[i_s] for i_s in rng.permutation(len(shards))]
+        stream = np.concatenate(shards)
+        # pad so each rank gets the same number of samples (as in DistributedSampler)
+        total = self.num_samples*self.num_replicas
+        stream = np.resize(stream, total)
+        stream = stream[self.rank*self.num_samples: (self.rank+1)*self.num_samples].tolist()
+        if not self.shuffle:
+            yield from stream
+            return
+
+        buff = []
+        for pos in stream:
+            if len(buff) < self.buffer_size:
+                buff.append(pos)
+                continue
+            i_buff = rng.integers(self.buffer_size)
+            yield buff[i_buff]
+            buff[i_buff] = pos
+        rng.shuffle(buff)
+        yield from buff
+
+    def __len__(self):
+        return self.num_samples
+
+
+class SkipBatchSampler(Sampler):
+
+    def __init__(self, batch_sampler, skip):
+        """
+        Yields the batches of batch_sampler after the first `skip` ones, to resume an epoch at a given step.
+        Only batch indices are skipped, no data is read for them, so batch_sampler should
+        be deterministic for the epoch (e.g. a DistributedSampler after set_epoch).
+
+        :param batch_sampler: batch sampler of the training DataLoader
+        :param skip: number of batches to skip
+        """
+        self.batch_sampler = batch_sampler
+        self.skip = skip
+
+    def __iter__(self):
+        return itertools.islice(iter(self.batch_sampler), self.skip, None)
+
+    def __len__(self):
+        return max(len(self.batch_sampler) - self.skip, 0)
+
+
+def batch_to_dev(tensors, dev, non_blocking=False, img_dtype=torch.float32):
+    """
+    move a collated batch to the device in one go
+    :param tensors: tuple of tensors yielded by a DataLoader
+    :param dev: pytorch device
+    :param non_blocking: use asynchronous host-to-device copies (requires pinned memory to overlap with compute)
+    :param img_dtype: integer images (tensors[0], e.g. uint8) are converted to this dtype after the copy
+    :return: tuple of tensors on dev
+    """
+    tensors = tuple(t.to(dev, non_blocking=non_blocking) for t in tensors)
+    if not tensors[0].is_floating_point():
+        tensors = (tensors[0].to(img_dtype),) + tensors[1:]
+    return tensors
+
+
 class H5SimDataMPI(H5SimDataDset):
 
     def __init__(self, mpi_comm, *args, **kwargs):
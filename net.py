@@ -5,13 +5,22 @@ from argparse import ArgumentDefaultsHelpFormatter as arg_formatter
 def get_parser():
     parser = ArgumentParser(formatter_class=arg_formatter)
     parser.add_argument("ep", type=int, help="number of epochs")
-    parser.add_argument("input", type=str, help="input training data h5 file")
+    parser.add_argument("input", type=str, help="input training data h5 file, or a folder written by scripts/export_flat.py, "
+                                                "or a folder of simulation files (see --prefix), "
+                                                "or the index sidecar (.json) of a master file from scripts/merge_h5s.py, "
+                                                "or a CSV file of real images and their labels (see loaders.ImageFileDset)")
     parser.add_argument("outdir", type=str, help="store output files here (will create if necessary)")
     parser.add_argument("--lr", type=float, default=0.000125, help="learning rate (important!)")
     parser.add_argument("--noDisplay", action="store_true", help="dont shot plots")
     parser.add_argument("--bs", type=int,default=16, help="batch size")
     parser.add_argument("--loss", type=str, choices=["L1", "L2", "BCE", "BCE2"], default="L1", help="loss function selector")
     parser.add_argument("--gpuid", type=int, help="device Id", default=0)
+    parser.add_argument("--cpu", action="store_true", help="train on the CPU")
+    parser.add_argument("--ddp", action="store_true",
+                        help="distributed training launched with torchrun (no SLURM or MPI needed), "
+                             "e.g. torchrun --nproc_per_node 8 net.py 100 master.h5 out --cpu --ddp")
+    parser.add_argument("--ddpBackend", type=str, choices=["nccl", "gloo"], default=None,
+                        help="torch.distributed backend for --ddp and td_net.py (default: nccl with GPUs, gloo on CPU)")
     parser.add_argument("--saveFreq", type=int, default=10, help="how often to write the model to disk")
     parser.add_argument("--arch", type=str, choices=["le", "res18", "res50", "res34", "res101", "res152", "counter"],
                         default="res50", help="architecture selector")
@@ -35,23 +44,117 @@ def get_parser():
     parser.add_argument("--error", type=float, default=0.07, help="the error threshold the model consider accurate")
     parser.add_argument("--weights", type=str, choices=["IMAGENET1K_V2","IMAGENET1K_V1"],
                         help="whether use pretrained weights", default=None)
-    parser.add_argument("--transform", action="store_true", help="whether use data augmentation")
+    parser.add_argument("--transform", action="store_true",
+                        help="whether use data augmentation (random flips and 90 degree rotations, applied to each batch on the device)")
+    parser.add_argument("--maxShift", type=int, default=0,
+                        help="with --transform, also shift images by up to this many pixels (integer shifts, zero-filled)")
     parser.add_argument("--labelSel", nargs="+", default=None,
                         help="optional list of names or numbers specifying labels. "
                              "If names are provided, this assumes the labels dataset in the hdf5 "
                              "input file has a `name` attribute set")
     parser.add_argument("--half", action="store_true", help="attempt to use half precision" )
+    parser.add_argument("--amp", type=str, choices=["fp16", "bf16"], default=None,
+                        help="automatic mixed precision: run the forward pass under torch.autocast with this dtype, "
+                             "keeping fp32 weights. fp16 uses gradient scaling. bf16 is recommended for CPU training. "
+                             "Alternative to --half")
     parser.add_argument("--oriMode", action="store_true", help="refine orientations using 6 param rot mat")
     parser.add_argument("--debugMode", action="store_true", help="run with detect_anaomly e.g. find NaNs in model/grad")
     parser.add_argument("--noEvalOnly", action="store_true", help="use model.train() mode during training after epoch1")
     parser.add_argument("--manualSeed", default=None, type=int, help="set to an integer in order to produce a reproducible training run")
     parser.add_argument("--kernelSize", type=int, default=7, help="Size of the resnet conv1 kernel (default=7)")
+    parser.add_argument("--numWorkers", type=int, default=0,
+                        help="number of DataLoader worker processes. If >0, workers return CPU tensors, "
+                             "and each collated batch is moved to the device once (pinned, non-blocking)")
+    parser.add_argument("--prefetchFactor", type=int, default=2,
+                        help="number of batches loaded in advance by each worker (only if numWorkers > 0)")
+    parser.add_argument("--chunkBatches", action="store_true",
+                        help="form each batch from a few source files and chunks, so batches are read with few sorted h5 reads. "
+                             "Shuffling is per block of images instead of per image (see loaders.ChunkBatchSampler)")
+    parser.add_argument("--blockSize", type=int, default=64,
+                        help="number of consecutive images per block (only if chunkBatches)")
+    parser.add_argument("--blockWindow", type=int, default=4,
+                        help="number of blocks shuffled together when forming batches (only if chunkBatches)")
+    parser.add_argument("--prefix", type=str, default="rank",
+                        help="if input is a folder of simulation files, read the files that start with this (no master file needed)")
+    parser.add_argument("--shardShuffle", action="store_true",
+                        help="input is a master file of pre-shuffled shards (scripts/make_shards.py). Read shards sequentially "
+                             "in random order, shuffling samples through a buffer (see loaders.ShardShuffleSampler)")
+    parser.add_argument("--shuffleBuffer", type=int, default=1000,
+                        help="number of samples in the shuffle buffer (only if shardShuffle)")
+    parser.add_argument("--cacheGB", type=float, default=0,
+                        help="keep up to this many GB of decoded images in shared memory, shared by all ranks and "
+                             "workers on a node, so images are only read and decompressed in the first epoch")
+    parser.add_argument("--cachePolicy", type=str, choices=["lru", "first"], default="lru",
+                        help="when the cache is full, evict the least recently used images (lru), "
+                             "or keep the first images that were cached (first)")
+    parser.add_argument("--streamSims", type=str, default=None,
+                        help="train on shots simulated on the fly, instead of the input file's training range. "
+                             "The value is a quoted string of sims/main.py arguments (without outdir), e.g. \"--cpuMode --nmos 10\". "
+                             "The input file is still used for testing. Shots per epoch is the size of the training range")
+    parser.add_argument("--streamProducers", type=int, default=1,
+                        help="number of simulation processes per rank (only if streamSims)")
+    parser.add_argument("--streamQueue", type=int, default=64,
+                        help="maximum number of simulated shots waiting to be trained on (only if streamSims)")
+    parser.add_argument("--streamTee", type=str, default=None,
+                        help="optionally also write the streamed shots to rank*.h5 files in this folder (only if streamSims)")
+    parser.add_argument("--preprocCache", type=str, default=None,
+                        help="if input is a CSV file, store the preprocessed images here (default is next to the CSV file). "
+                             "Reused across epochs and runs")
+    parser.add_argument("--imageReader", type=str, choices=["fabio", "dxtbx"], default="fabio",
+                        help="if input is a CSV file, read the images with this library")
+    parser.add_argument("--validateEvery", type=int, default=1,
+                        help="run the validation passes every this many epochs (and after the last epoch)")
+    parser.add_argument("--trainValidateSize", type=int, default=None,
+                        help="number of training images (a fixed random subset) used to compute the train accuracy. "
+                             "Default is the size of the test set")
+    parser.add_argument("--earlyStop", type=int, default=None,
+                        help="stop training if the test loss did not improve in this many validations")
+    parser.add_argument("--earlyStopDelta", type=float, default=0,
+                        help="minimum decrease of the test loss that counts as an improvement (only if earlyStop)")
+    parser.add_argument("--keepLast", type=int, default=None,
+                        help="only keep the last N nety_epN.nn/.chkpt checkpoints (default keeps all)")
+    parser.add_argument("--keepBest", type=int, default=0,
+                        help="also keep the K checkpoints with the lowest test loss (only if keepLast)")
+    parser.add_argument("--saveSteps", type=int, default=None,
+                        help="every this many training batches, overwrite nety_step.chkpt in outdir. It stores the "
+                             "position within the epoch and the random number generator states, so restart_net.py "
+                             "resumes training at the exact batch")
+    parser.add_argument("--compile", action="store_true",
+                        help="wrap the model in torch.compile (the compile time is logged with the first training step)")
+    parser.add_argument("--compileMode", type=str, choices=["default", "reduce-overhead", "max-autotune"],
+                        default="default", help="torch.compile mode (only if compile)")
+    parser.add_argument("--channelsLast", action="store_true",
+                        help="use the channels_last memory format for the model and the image batches")
+    parser.add_argument("--checkpointActivations", action="store_true",
+                        help="recompute the activations of each ResNet stage during the backward pass instead of "
+                             "storing them (less memory, about one extra forward pass of compute)")
+    parser.add_argument("--profileSteps", type=str, default=None,
+                        help="start:stop, profile these training batches (counted from 0 in this run, across epochs) "
+                             "with torch.profiler, and write a Chrome trace and a table of the top operators "
+                             "to outdir (profile_train_trace.json and profile_train_ops.txt)")
+    parser.add_argument("--debugChecks", action="store_true",
+                        help="check every training step (finite loss, and rotation matrix determinants with --oriMode), "
+                             "and count the host-device syncs per batch on CUDA. These checks wait on the device")
+    parser.add_argument("--printFreq", type=int, default=10,
+                        help="print the progress and the mean training loss every this many optimizer steps "
+                             "(the loss is accumulated on the device, reading it waits on the device)")
+    parser.add_argument("--accumSteps", type=int, default=1,
+                        help="accumulate gradients over this many batches per optimizer step "
+                             "(effective batch size is bs*accumSteps per rank)")
+    parser.add_argument("--commHook", type=str, choices=["fp16", "bf16", "powersgd"], default=None,
+                        help="compress the DDP gradient allreduce: cast to fp16 or bf16, or use PowerSGD "
+                             "(low-rank approximation, uncompressed for the first 1000 steps)")
+    parser.add_argument("--powerSGDRank", type=int, default=1,
+                        help="matrix approximation rank for --commHook powersgd")
+    parser.add_argument("--zero", action="store_true",
+                        help="shard the optimizer state across DDP ranks (ZeroRedundancyOptimizer)")
     return parser
 
 
 import time
 import os
 import sys
+import contextlib
 import h5py
 import numpy as np
 import logging
@@ -60,14 +163,21 @@ import pylab as plt
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as td
 from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data import DataLoader
 from torchmetrics.classification import BinaryJaccardIndex
-from torchvision import transforms
 
 from resonet.utils import orientation
+from resonet.utils import ddp
+from resonet.utils.augment import BatchAugment
+from resonet.utils.checkpoint import CheckpointWriter, rng_states, set_rng_states
+from resonet.utils.profiling import StepProfiler
+from resonet.utils.gpu import SyncCounter
 from resonet.params import ARCHES, LOSSES
-from resonet.loaders import H5SimDataDset
+from resonet.arches import saved_activation_bytes
+from resonet.loaders import H5SimDataDset, MemmapSimDataDset, H5MultiFileDset, ImageFileDset, FLAT_META
+from resonet.loaders import ChunkBatchSampler, ShardShuffleSampler, SkipBatchSampler, batch_to_dev
 
 
 def get_logger(filename=None, level="info", do_nothing=False):
@@ -101,23 +211,123 @@ def get_logger(filename=None, level="info", do_nothing=False):
     return logger
 
 
-def validate(input_tens, model, epoch, criterion, COMM=None, error=0.3):
+def get_autocast(dev, amp=None):
+    """
+    :param dev: pytorch device of the model
+    :param amp: fp16, bf16 or None
+    :return: autocast context for the forward pass (does nothing if amp is None)
+    """
+    if amp is None:
+        return contextlib.nullcontext()
+    dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}[amp]
+    return torch.autocast(torch.device(dev).type, dtype=dtype)
+
+
+class _RowBuffer:
+    """rows accumulated on the device, in a preallocated buffer (grows if more rows than expected arrive)"""
+
+    def __init__(self, nrows):
+        self.nrows = nrows
+        self.buf = None
+        self.n = 0
+
+    def append(self, rows):
+        rows = rows.detach().reshape(len(rows), -1)
+        if self.buf is None:
+            self.buf = torch.empty((max(self.nrows, len(rows)), rows.shape[1]), dtype=rows.dtype, device=rows.device)
+        elif self.n + len(rows) > len(self.buf):
+            buf = torch.empty((2*len(self.buf) + len(rows), self.buf.shape[1]), dtype=self.buf.dtype, device=self.buf.device)
+            buf[:self.n] = self.buf[:self.n]
+            self.buf = buf
+        self.buf[self.n: self.n+len(rows)] = rows
+        self.n += len(rows)
+
+    def get(self):
+        if self.buf is None:
+            return torch.zeros((0, 1))
+        return self.buf[:self.n]
+
+
+def _allgather_rows(rows, COMM=None):
+    """
+    :param rows: 2D tensor of this rank's rows
+    :param COMM: mpi4py communicator (used if torch.distributed isn't initialized)
+    :return: rows of all ranks, concatenated in rank order
+    """
+    if td.is_available() and td.is_initialized():
+        # all_gather_into_tensor needs the same number of rows per rank, so pad to the largest
+        counts = torch.zeros(td.get_world_size(), dtype=torch.int64, device=rows.device)
+        td.all_gather_into_tensor(counts, torch.tensor([len(rows)], dtype=torch.int64, device=rows.device))
+        counts = counts.tolist()
+        nmax = max(counts)
+        padded = torch.zeros((nmax, rows.shape[1]), dtype=rows.dtype, device=rows.device)
+        padded[:len(rows)] = rows
+        out = torch.empty((len(counts)*nmax, rows.shape[1]), dtype=rows.dtype, device=rows.device)
+        td.all_gather_into_tensor(out, padded)
+        return torch.cat([out[i*nmax: i*nmax+n] for i, n in enumerate(counts)])
+    if COMM is None:
+        return rows
+    rows = np.ascontiguousarray(rows.cpu().numpy())
+    counts = COMM.allgather(rows.size)
+    out = np.empty(sum(counts), rows.dtype)
+    COMM.Allgatherv(rows, [out, counts])
+    return torch.from_numpy(out.reshape((-1, rows.shape[1])))
+
+
+def _allreduce_sum(vals, COMM=None):
+    """
+    :param vals: 1D float64 tensor of this rank's sums
+    :param COMM: mpi4py communicator (used if torch.distributed isn't initialized)
+    :return: sums over all ranks, as a numpy array
+    """
+    if td.is_available() and td.is_initialized():
+        td.all_reduce(vals)
+        return vals.cpu().numpy()
+    vals = vals.cpu().numpy()
+    if COMM is None:
+        return vals
+    out = np.empty_like(vals)
+    COMM.Allreduce(vals, out)
+    return out
+
+
+def validate(input_tens, model, epoch, criterion, COMM=None, error=0.3, dev=None, non_blocking=False,
+             img_dtype=torch.float32, amp=None, channels_last=False):
     """
     tens is return value of tensorloader
+    dev: if provided, each batch is moved to this device before evaluation
+    non_blocking: whether batch copies to dev are asynchronous
+    img_dtype: dtype for integer (e.g. uint8) images after they are moved to dev
+    amp: optional autocast dtype (fp16 or bf16) for the forward pass, requires dev
+    channels_last: convert the images to the channels_last memory format
+    Predictions, labels, losses and accuracy counts stay on the device until the end of the pass,
+    then they are gathered from all ranks with one collective each. Correlations are computed on rank 0.
     TODO make validation multi-channel (e.g. average accuracy over all labels)
     """
     logger = logging.getLogger("resonet")
     using_bce = str(criterion).startswith("BCE")
     ori_loss = criterion.__module__ == 'resonet.utils.orientation'
     use_sgnums = ori_loss and str(criterion) == "Loss()"
+    if td.is_available() and td.is_initialized():
+        is_root = td.get_rank() == 0
+    else:
+        is_root = COMM is None or COMM.rank == 0
 
+    try:
+        nrows = len(input_tens.dataset)
+    except TypeError:
+        nrows = 0
+    all_lab = _RowBuffer(nrows)
+    all_pred = _RowBuffer(nrows)
+    all_loss = _RowBuffer(len(input_tens) if hasattr(input_tens, "__len__") else 0)
+    nacc = 0  # number of accurate predictions (a tensor on the device, after the first batch)
     total = 0
-    nacc = 0  # number of accurate predictions
-    all_lab = []
-    all_pred = []
-    all_loss = []
     for i, tensors in enumerate(input_tens):
+        if dev is not None:
+            tensors = batch_to_dev(tensors, dev, non_blocking, img_dtype)
         data = (tensors[0],)
+        if channels_last:
+            data = (tensors[0].contiguous(memory_format=torch.channels_last),)
         labels = tensors[1]
         sgnums = None
         if len(tensors)==3:
@@ -125,9 +335,11 @@ def validate(input_tens, model, epoch, criterion, COMM=None, error=0.3):
                 data = data + (tensors[2],)
             else:
                 sgnums = tensors[2]
-        if COMM is None or COMM.rank==0:
+        if is_root:
             print("validation batch %d"% i,end="\r", flush=True)
-        pred = model(*data)
+        with get_autocast(dev, amp):
+            pred = model(*data)
+        pred = pred.float()
 
         if len(pred.shape)==3 and not ori_loss:
             nbatch = pred.shape[0]
@@ -141,10 +353,11 @@ def validate(input_tens, model, epoch, criterion, COMM=None, error=0.3):
         else:
             loss = criterion(pred, labels)
 
-        all_loss.append(loss.item())
+        all_loss.append(loss.double().reshape(1, 1))
 
         if using_bce:
             pred = torch.round(torch.sigmoid(pred))
+            nacc = nacc + (pred == labels).sum()
         else:
             if ori_loss:
                 # this is the ori_loss=True case
@@ -152,47 +365,44 @@ def validate(input_tens, model, epoch, criterion, COMM=None, error=0.3):
             else:
                 errors = (pred-labels).abs()
             is_accurate = errors < error
-            nacc += is_accurate.all(dim=1).sum().item()
-            total += len(labels)
-
-        all_lab += [[l.item() for l in labs.ravel()] for labs in labels]
-        all_pred += [[p.item() for p in preds.ravel()] for preds in pred]
-
-    if COMM is not None:
-        all_lab = COMM.bcast(COMM.reduce(all_lab))
-        all_pred = COMM.bcast(COMM.reduce(all_pred))
-        all_loss = COMM.bcast(COMM.reduce(all_loss))
-        nacc = COMM.bcast(COMM.reduce(nacc))
-        total = COMM.bcast(COMM.reduce(total))
-
-    all_lab = np.array(all_lab).T
-    all_pred = np.array(all_pred).T
+            nacc = nacc + is_accurate.all(dim=1).sum()
+        total += len(labels)
+
+        all_lab.append(labels.float())
+        all_pred.append(pred)
+
+    losses = all_loss.get()
+    nacc, total, loss_sum, nloss = _allreduce_sum(
+        torch.stack([torch.as_tensor(nacc, dtype=torch.float64, device=losses.device),
+                     torch.tensor(total, dtype=torch.float64, device=losses.device),
+                     losses.sum(), torch.tensor(len(losses), dtype=torch.float64, device=losses.device)]), COMM)
+    ave_loss = loss_sum / nloss
+    all_lab = _allgather_rows(all_lab.get(), COMM).cpu().numpy().T
+    all_pred = _allgather_rows(all_pred.get(), COMM).cpu().numpy().T
+    acc = nacc / total * 100
 
     if ori_loss:
-        acc = nacc / total *100
-        ave_loss = np.mean(all_loss) * 180 / np.pi  # convert to degrees
+        ave_loss = ave_loss * 180 / np.pi  # convert to degrees
         logger.info("\taccuracy at Ep%d: %.2f%%" \
                     % (epoch+1, acc))
         return acc, ave_loss, all_lab, all_pred
 
     elif not using_bce:
-        acc = nacc / total*100.
-        pears = [pearsonr(L,P)[0] for L,P in zip(all_lab, all_pred)]
-        spears = [spearmanr(L,P)[0] for L,P in zip(all_lab, all_pred)]
         logger.info("\taccuracy at Ep%d: %.2f%%" \
             % (epoch+1, acc))
-        for pear, spear in zip(pears, spears):
-            logger.info("\tpredicted-VS-truth: PearsonR=%.3f%%, SpearmanR=%.3f%%" \
-                % (pear*100, spear*100))
-        ave_loss = np.mean(all_loss)
+        if is_root:
+            pears = [pearsonr(L,P)[0] for L,P in zip(all_lab, all_pred)]
+            spears = [spearmanr(L,P)[0] for L,P in zip(all_lab, all_pred)]
+            for pear, spear in zip(pears, spears):
+                logger.info("\tpredicted-VS-truth: PearsonR=%.3f%%, SpearmanR=%.3f%%" \
+                    % (pear*100, spear*100))
         return acc, ave_loss, all_lab, all_pred
     else:
-        acc = np.sum(all_pred == all_lab) / all_pred.shape[-1] * 100
-        ave_loss = np.mean(all_loss)
-        jaccard = BinaryJaccardIndex()(torch.tensor(all_pred), torch.tensor(all_lab))
         logger.info("\taccuracy at Ep%d: %.2f%%" \
                     % (epoch, acc))
-        logger.info("\tpredicted-VS-truth: Jaccard=%.3f" % jaccard)
+        if is_root:
+            jaccard = BinaryJaccardIndex()(torch.tensor(all_pred), torch.tensor(all_lab))
+            logger.info("\tpredicted-VS-truth: Jaccard=%.3f" % jaccard)
         return acc, ave_loss, all_lab, all_pred
 
 
@@ -267,7 +477,8 @@ def update_plots(ax0,ax1, epoch):
     ax1.legend(prop={"size":12})
 
 
-def _train_iter(data, labels, model, criterion, optimizer, sgnums=None):
+def _train_iter(data, labels, model, criterion, optimizer, sgnums=None, autocast=None, scaler=None,
+                accum_steps=1, first=True, last=True, debug_checks=False, loss_sum=None):
     """
     :param data: data tensor
     :param labels: label tensor
@@ -275,22 +486,48 @@ def _train_iter(data, labels, model, criterion, optimizer, sgnums=None):
     :param criterion: pytorch loss
     :param optimizer: pytorch optimizer
     :param sgnums:
+    :param autocast: optional autocast context for the forward pass (see get_autocast). The loss is computed in fp32
+    :param scaler: optional GradScaler (for fp16 autocast)
+    :param accum_steps: number of micro-batches whose gradients are accumulated (the loss is divided by this)
+    :param first: whether this is the first micro-batch of the accumulation (gradients are zeroed)
+    :param last: whether this is the last micro-batch of the accumulation (the optimizer steps)
+    :param debug_checks: check the loss and the orientation matrices (waits on the device)
+    :param loss_sum: optional tensor on the device, the loss is added to it (without waiting on the device)
     """
 
     ori_loss = criterion.__module__ == 'resonet.utils.orientation'
-    optimizer.zero_grad()
-    outputs = model(*data)
+    if first:
+        optimizer.zero_grad()
+    if autocast is None:
+        outputs = model(*data)
+    else:
+        with autocast:
+            outputs = model(*data)
+        outputs = outputs.float()
     if len(outputs.shape) == 3 and not ori_loss:
         nbatch = outputs.shape[0]
         outputs = outputs.reshape((nbatch, -1))
-    if ori_loss:
+    if ori_loss and debug_checks:
         assert torch.all( torch.round(torch.linalg.det(outputs)) == 1).item()
     if ori_loss and sgnums is not None:
         loss = criterion(outputs, labels, sgnums=sgnums)
     else:
         loss = criterion(outputs, labels)
-    loss.backward()
-    optimizer.step()
+    if debug_checks:
+        assert torch.isfinite(loss).item(), "training loss is not finite"
+    if loss_sum is not None:
+        loss_sum += loss.detach()
+    if accum_steps > 1:
+        loss = loss / accum_steps
+    if scaler is not None:
+        scaler.scale(loss).backward()
+        if last:
+            scaler.step(optimizer)
+            scaler.update()
+    else:
+        loss.backward()
+        if last:
+            optimizer.step()
     return outputs
 
 
@@ -306,7 +543,15 @@ def do_training(h5input, h5label, h5imgs, outdir,
          title=None, COMM=None, ngpu_per_node=1, use_geom=False,
          error=0.3, weights=None, use_transform=False,
          cp=None, ori_mode=False, eval_mode_only=True, debug_mode=False,
-         use_sgnums=False, manual_seed=None, kernel_size=7):
+         use_sgnums=False, manual_seed=None, kernel_size=7,
+         num_workers=0, prefetch_factor=2, chunk_batches=False, block_size=64, block_window=4,
+         shard_shuffle=False, shuffle_buffer=1000, prefix="rank", cache_gb=0, cache_policy="lru",
+         max_shift=0, stream_sims=None, stream_producers=1, stream_queue=64, stream_tee=None,
+         preproc_cache=None, image_reader="fabio", amp=None,
+         validate_every=1, train_validate_size=None, early_stop=None, early_stop_delta=0,
+         keep_last=None, keep_best=0, save_steps=None, compile_model=False, compile_mode="default",
+         channels_last=False, accum_steps=1, comm_hook=None, powersgd_rank=1, zero=False,
+         checkpoint_activations=False, profile_steps=None, debug_checks=False, print_freq=10):
 
     training_args = list(locals().items())
     # model and criterion choices
@@ -339,32 +584,54 @@ def do_training(h5input, h5label, h5imgs, outdir,
     ntrain = train_stop - train_start
 
     assert os.path.exists(h5input)
+    # rank and world size come from torch.distributed (initialized by utils.ddp.slurm_init or utils.ddp.env_init)
+    distributed = td.is_available() and td.is_initialized()
     if COMM is not None:
-        # TODO: assert that e.g. slurm_init has been called (distributed.init_process_group)
-        gpuid = COMM.rank % ngpu_per_node
+        assert distributed, "initialize torch.distributed first (see utils.ddp.slurm_init)"
+    rank, nrank = (td.get_rank(), td.get_world_size()) if distributed else (0, 1)
+    if distributed and str(dev).startswith("cuda"):
+        if COMM is not None:
+            gpuid = COMM.rank % ngpu_per_node
+        else:
+            gpuid = int(os.environ.get("LOCAL_RANK", rank)) % ngpu_per_node
         dev = "cuda:%d" % gpuid
-
-    # Temporariliy define transform here
-    if use_transform:
-        transform = transforms.Compose([
-                    transforms.RandomHorizontalFlip(),
-                    transforms.RandomRotation(90),
-                    ])
-    else:
-        transform = None
+        torch.cuda.set_device(gpuid)
 
     common_args = {"dev":dev,"labels": h5label, "images": h5imgs,
                    "use_geom": use_geom, "label_sel": label_sel,
                    "half_precision": half_precision,
-                   "use_sgnums": use_sgnums, "convert_to_float": True}
-
-    all_imgs = H5SimDataDset(h5input,
-                               start=0, stop=ntrain + ntest, transform=transform, **common_args)
+                   "use_sgnums": use_sgnums, "convert_to_float": True,
+                   "cpu_tensors": num_workers > 0,
+                   "cache_bytes": int(cache_gb*1e9), "cache_policy": cache_policy}
+
+    # a folder is either a flat training set from export_flat.py, or holds the simulation files
+    if os.path.exists(os.path.join(h5input, FLAT_META)):
+        all_imgs = MemmapSimDataDset(h5input,
+                                   start=0, stop=ntrain + ntest, **common_args)
+    elif os.path.isdir(h5input):
+        all_imgs = H5MultiFileDset(h5input, prefix=prefix,
+                                   start=0, stop=ntrain + ntest, **common_args)
+    elif h5input.endswith(".json"):
+        # index sidecar from merge_h5s.py: read the simulation files directly, without opening them all at startup
+        all_imgs = H5MultiFileDset(None, index=h5input,
+                                   start=0, stop=ntrain + ntest, **common_args)
+    elif h5input.endswith(".csv"):
+        # real images, preprocessed once into a cache folder
+        all_imgs = ImageFileDset(h5input, dev=dev, label_sel=label_sel, use_geom=use_geom,
+                                 start=0, stop=ntrain + ntest, half_precision=half_precision,
+                                 cpu_tensors=num_workers > 0, cache_dir=preproc_cache, reader=image_reader)
+    else:
+        all_imgs = H5SimDataDset(h5input,
+                                   start=0, stop=ntrain + ntest, **common_args)
 
     print("Randomly splitting the datasets!")
     gen = torch.Generator().manual_seed(0)
     train_imgs, test_imgs = torch.utils.data.random_split(all_imgs, [ntrain, ntest], generator=gen)
-    _, train_imgs_validate = torch.utils.data.random_split(train_imgs, [ntrain-ntest, ntest], generator=gen)
+    if train_validate_size is None:
+        train_validate_size = ntest
+    assert 0 < train_validate_size <= ntrain
+    _, train_imgs_validate = torch.utils.data.random_split(train_imgs, [ntrain-train_validate_size, train_validate_size],
+                                                           generator=gen)
 
     nout = all_imgs.nlab
     if ori_mode:
@@ -372,25 +639,57 @@ def do_training(h5input, h5label, h5imgs, outdir,
 
     # instantiate model
     # TODO make geometry length a variable (for now its always [detdist, pixsize, wavelen, fastdim, slowdim]
+    arch_kwargs = {}
+    if checkpoint_activations:
+        assert arch.startswith("res"), "checkpoint_activations requires a ResNet arch"
+        arch_kwargs["checkpoint_activations"] = True
     if arch=="counter":
         nety = ARCHES[arch]().to(all_imgs.dev)
     else:
         if cp is None:
-            nety = ARCHES[arch](nout=nout, dev=all_imgs.dev, dropout=dropout, ngeom=5, weights=weights, kernel_size=kernel_size)
+            nety = ARCHES[arch](nout=nout, dev=all_imgs.dev, dropout=dropout, ngeom=5, weights=weights, kernel_size=kernel_size,
+                                **arch_kwargs)
         else:
-            nety = ARCHES[arch](nout=nout, dev="cpu", dropout=dropout, ngeom=5, weights=weights, kernel_size=kernel_size)
+            nety = ARCHES[arch](nout=nout, dev="cpu", dropout=dropout, ngeom=5, weights=weights, kernel_size=kernel_size,
+                                **arch_kwargs)
             nety.load_state_dict(cp["model_state"])
             nety = nety.to(all_imgs.dev)
+    act_bytes = None
+    if checkpoint_activations:
+        act_bytes = _activation_bytes(nety, all_imgs.image_shape, all_imgs.dev)
 
     nety.ori_mode = ori_mode
-
-    if COMM is not None:
-        nety = torch.nn.SyncBatchNorm.convert_sync_batchnorm(nety)
-        nety = nn.parallel.DistributedDataParallel(nety, device_ids=[gpuid], 
+    if channels_last:
+        nety = nety.to(memory_format=torch.channels_last)
+
+    if distributed:
+        device_ids = None
+        if str(all_imgs.dev).startswith("cuda"):
+            # SyncBatchNorm is only implemented for CUDA, on CPU each rank keeps its own batch statistics
+            nety = torch.nn.SyncBatchNorm.convert_sync_batchnorm(nety)
+            device_ids = [gpuid]
+        nety = nn.parallel.DistributedDataParallel(nety, device_ids=device_ids, 
             find_unused_parameters= arch in ["le", "res50", "res34", "res18"])
+        if comm_hook is not None:
+            print("Compressing gradient communication (%s)" % comm_hook)
+            ddp.register_comm_hook(nety, comm_hook, powersgd_rank=powersgd_rank)
+    else:
+        assert comm_hook is None, "comm_hook requires distributed training"
     if half_precision:
+        assert amp is None, "use either half_precision or amp"
         print("Moving model to half precision")
         nety = nety.half()
+    scaler = None
+    if amp is not None:
+        # weights stay in fp32, only the forward pass is in reduced precision
+        print("Using automatic mixed precision (%s)" % amp)
+        if amp == "fp16":
+            scaler = torch.amp.GradScaler(torch.device(all_imgs.dev).type)
+    # forward passes use fwd_model, nety is used for the state_dict (compiled modules prefix the parameter names)
+    fwd_model = nety
+    if compile_model:
+        print("Compiling the model (mode=%s)" % compile_mode)
+        fwd_model = torch.compile(nety, mode=compile_mode)
 
     criterion = LOSSES[loss]()
     if ori_mode:
@@ -401,13 +700,22 @@ def do_training(h5input, h5label, h5imgs, outdir,
                                          dev=all_imgs.dev)
         else:
             criterion = orientation.loss
-    optimizer = optim.SGD(nety.parameters(), lr=lr, momentum=momentum, weight_decay=weight_decay, nesterov=nesterov, dampening=damp )
+    sgd_args = {"lr": lr, "momentum": momentum, "weight_decay": weight_decay, "nesterov": nesterov, "dampening": damp}
+    if zero:
+        # each rank keeps the optimizer state of a shard of the parameters
+        assert distributed, "zero requires distributed training"
+        from torch.distributed.optim import ZeroRedundancyOptimizer
+        optimizer = ZeroRedundancyOptimizer(nety.parameters(), optimizer_class=optim.SGD, **sgd_args)
+    else:
+        optimizer = optim.SGD(nety.parameters(), **sgd_args)
     #optimizer = optim.Adam(nety.parameters(), lr=lr)
     if cp is not None:
         optimizer.load_state_dict(cp["optimizer_state"])
+        if scaler is not None and "scaler_state" in cp:
+            scaler.load_state_dict(cp["scaler_state"])
 
     # setup recordkeeping
-    if COMM is None or COMM.rank==0:
+    if rank==0:
         if not os.path.exists(outdir):
             os.makedirs(outdir)
         logname = os.path.join(outdir, logfile)
@@ -418,12 +726,19 @@ def do_training(h5input, h5label, h5imgs, outdir,
     else:
         logger = get_logger(do_nothing=True)
     for arg_name, arg_val in training_args:
+        if arg_name == "cp":
+            # the restart checkpoint holds the full model and optimizer states
+            continue
         arg_s = "%s=%s" % (arg_name, str(arg_val))
         logger.info("Training arg %s" % arg_s)
 
     logger.info("Training for %d outputs" % all_imgs.nlab)
+    if act_bytes is not None:
+        full, ckpt = (nbytes*bs/1e6 for nbytes in act_bytes)
+        logger.info("Activation checkpointing: %.1f MB of stored activations per batch instead of %.1f MB "
+                    "(saves %.1f MB, fp32)" % (ckpt, full, full-ckpt))
 
-    if COMM is None or COMM.rank==0:
+    if rank==0:
         # optional plots
         if title is None:
             title = os.path.join(os.path.basename(os.path.dirname(h5input)), 
@@ -435,28 +750,110 @@ def do_training(h5input, h5label, h5imgs, outdir,
 
     shuffle = True
     train_sampler = train_validate_sampler = test_sampler = None
-    if COMM is not None:
+    assert not (chunk_batches and shard_shuffle)
+    if shard_shuffle:
         shuffle = None
-        train_sampler = DistributedSampler(train_imgs, rank=COMM.rank, num_replicas=COMM.size)
+        shard_args = {"buffer_size": shuffle_buffer, "num_replicas": nrank, "rank": rank,
+                      "seed": 0 if manual_seed is None else manual_seed}
+        train_sampler = ShardShuffleSampler(train_imgs, **shard_args)
+        train_validate_sampler = ShardShuffleSampler(train_imgs_validate, **shard_args)
+        test_sampler = ShardShuffleSampler(test_imgs, **shard_args)
+    elif distributed:
+        shuffle = None
+        train_sampler = DistributedSampler(train_imgs, rank=rank, num_replicas=nrank)
         train_validate_sampler = DistributedSampler(train_imgs_validate) 
         test_sampler = DistributedSampler(test_imgs) 
+    else:
+        # the training order only depends on the seed and epoch (see set_epoch), so an epoch can be resumed mid-way
+        train_sampler = DistributedSampler(train_imgs, num_replicas=1, rank=0,
+                                           seed=0 if manual_seed is None else manual_seed)
          
-    train_tens = DataLoader(train_imgs, batch_size=bs, shuffle=shuffle, 
-                        sampler=train_sampler)
-    train_tens_validate = DataLoader(train_imgs_validate, batch_size=bs, shuffle=shuffle, 
-                        sampler=train_validate_sampler)
-    test_tens = DataLoader(test_imgs, batch_size=bs, shuffle=shuffle, sampler=test_sampler)
+    # with worker processes, batches are collated on the CPU and moved to the device once
+    img_dtype = torch.float16 if half_precision else torch.float32
+    loader_args = {}
+    pin_memory = False
+    if num_workers > 0:
+        pin_memory = str(all_imgs.dev).startswith("cuda")
+        loader_args = {"num_workers": num_workers, "pin_memory": pin_memory,
+                       "persistent_workers": True, "prefetch_factor": prefetch_factor}
+        if hasattr(all_imgs, "share_read_stats"):
+            # so the reads in the worker processes are counted
+            all_imgs.share_read_stats(num_workers)
+
+    # augmentation is applied to whole training batches on the device
+    augment = None
+    if use_transform:
+        is_square = all_imgs.image_shape[-1] == all_imgs.image_shape[-2]
+        augment = BatchAugment(rot90=is_square, max_shift=max_shift)
+
+    train_stream = None
+    if stream_sims is not None:
+        # shots are simulated on the fly for training, the input file is used for validation
+        from resonet.sims.stream import SimStreamDset, parse_sim_args
+        assert not (chunk_batches or shard_shuffle)
+        train_stream = SimStreamDset(parse_sim_args(stream_sims), num_shots=int(np.ceil(ntrain / nrank)),
+                                     num_producers=stream_producers, queue_size=stream_queue, seed=manual_seed,
+                                     jid_offset=rank*stream_producers, tee_dir=stream_tee, label_sel=label_sel,
+                                     use_geom=use_geom, half_precision=half_precision)
+
+    if chunk_batches:
+        chunk_args = {"block_size": block_size, "window": block_window, "num_replicas": nrank, "rank": rank,
+                      "seed": 0 if manual_seed is None else manual_seed}
+        train_tens = DataLoader(train_imgs, batch_sampler=ChunkBatchSampler(train_imgs, bs, **chunk_args),
+                                **loader_args)
+        train_tens_validate = DataLoader(train_imgs_validate,
+                                         batch_sampler=ChunkBatchSampler(train_imgs_validate, bs, **chunk_args),
+                                         **loader_args)
+        test_tens = DataLoader(test_imgs, batch_sampler=ChunkBatchSampler(test_imgs, bs, **chunk_args),
+                               **loader_args)
+    else:
+        train_tens = DataLoader(train_imgs, batch_size=bs, sampler=train_sampler, **loader_args)
+        train_tens_validate = DataLoader(train_imgs_validate, batch_size=bs, shuffle=shuffle, 
+                            sampler=train_validate_sampler, **loader_args)
+        test_tens = DataLoader(test_imgs, batch_size=bs, shuffle=shuffle, sampler=test_sampler, **loader_args)
+    if train_stream is not None:
+        # the producers are separate processes already, so no loader workers
+        train_tens = DataLoader(train_stream, batch_size=bs)
 
     nbatch = np.ceil((train_stop - train_start) / bs)
-    if COMM is not None:
-        nbatch = np.ceil((train_stop - train_start) / bs / COMM.size)
+    if distributed:
+        nbatch = np.ceil((train_stop - train_start) / bs / nrank)
 
     starting_ep = 0
+    resume = None  # position within the starting epoch, if cp is a step checkpoint (see save_steps)
+    global_step = 0
     if cp is not None:
         starting_ep = cp["epoch"]
+        resume = cp.get("resume")
+        if resume is not None:
+            global_step = resume["global_step"]
 
     assert max_ep > starting_ep
+    writer = None
+    if rank==0:
+        # checkpoints are written off the training thread
+        writer = CheckpointWriter(keep_last=keep_last, keep_best=keep_best)
+    profiler = None
+    if profile_steps is not None:
+        profiler = StepProfiler(profile_steps, outdir, "profile_train" if not distributed else "profile_train_rank%d" % rank)
+        logger.info("Profiling training batches %d:%d" % (profiler.start, profiler.stop))
+    # training loss is summed on the device and read every print_freq optimizer steps
+    loss_sum = torch.zeros((), device=all_imgs.dev)
+    nloss = 0
+    sync_counter = SyncCounter(all_imgs.dev, enabled=debug_checks)
+    train_loss = test_loss = None
+    epoch_stats = []  # training time, loader wait time and number of images of each epoch (this rank)
+    best_loss = np.inf
+    nstale = 0  # validations since the test loss last improved (for early_stop)
+    is_first_step = True
+    nbatch_epoch = len(train_tens)
+    if save_steps is not None:
+        # step checkpoints are written at the end of an accumulation group
+        next_save = (global_step // save_steps + 1) * save_steps
     for epoch in range(starting_ep, max_ep, 1):
+        # losses are only set by a validation, so checkpoints of epochs that are not validated store None
+        # (which the checkpoint rotation ranks as worst)
+        train_loss = test_loss = None
         if not eval_mode_only:
             nety.train()
 
@@ -468,15 +865,58 @@ def do_training(h5input, h5label, h5imgs, outdir,
         losses = []
         all_losses = []
 
-        #if display and (COMM is None or COMM.rank==0):
+        #if display and rank==0:
         #    plt.draw()
         #    plt.pause(0.01)
         
-        if COMM is not None:  # or if train_tens.sampler is not None
+        if train_stream is not None:
+            pass  # every epoch has new shots
+        elif chunk_batches:
+            train_tens.batch_sampler.set_epoch(epoch)
+        else:
             train_tens.sampler.set_epoch(epoch)
 
-        for i, tensors in enumerate(train_tens):
-            data = (tensors[0],)
+        epoch_tens = train_tens
+        skip = 0  # batches of this epoch that were trained before the restart
+        resume_rng = None
+        if resume is not None and epoch == starting_ep:
+            if train_stream is None:
+                skip = resume["step"]
+                epoch_tens = DataLoader(train_tens.dataset,
+                                        batch_sampler=SkipBatchSampler(train_tens.batch_sampler, skip), **loader_args)
+            else:
+                logger.info("Streamed shots are not replayed, restarting epoch %d with new shots" % (epoch+1))
+            if len(resume["rng_states"]) == nrank:
+                resume_rng = resume["rng_states"][rank]
+            else:
+                logger.info("Number of ranks changed, random number generators are not restored")
+            # with eval_mode_only, the model is left in eval mode after the first validation
+            nety.train(resume["train_mode"])
+            logger.info("Resuming epoch %d at batch %d" % (epoch+1, skip+1))
+
+        twait = 0  # time spent waiting on the data loader
+        nbytes_loaded = 0
+        read_start = all_imgs.get_read_stats() if hasattr(all_imgs, "get_read_stats") else None
+        nimg_loaded = 0
+        tbatch = time.time()
+        for i, tensors in enumerate(epoch_tens, skip):
+            twait += time.time() - tbatch
+            sync_counter.start()
+            if resume_rng is not None:
+                # restored after the loader iterator is created, as that consumes random numbers
+                set_rng_states(resume_rng)
+                resume_rng = None
+            nbytes_loaded += tensors[0].nbytes
+            nimg_loaded += len(tensors[0])
+            if profiler is not None:
+                profiler.step()
+            with torch.profiler.record_function("batch_to_dev"):
+                tensors = batch_to_dev(tensors, all_imgs.dev, pin_memory, img_dtype)
+                data = (tensors[0],)
+                if augment is not None:
+                    data = (augment(tensors[0]),)
+                if channels_last:
+                    data = (data[0].contiguous(memory_format=torch.channels_last),)
             labels = tensors[1]
             sgnums = None
             if len(tensors) == 3:
@@ -485,35 +925,105 @@ def do_training(h5input, h5label, h5imgs, outdir,
                 else:
                     sgnums = tensors[2]
 
-            if COMM is None or COMM.rank==0:
-                print("Training Epoch %d batch %d/%d" \
-                    % (epoch+1, i+1, nbatch), flush=True)
-            if debug_mode:
-                with torch.autograd.detect_anomaly():
-                    outputs = _train_iter(data, labels, nety, criterion, optimizer, sgnums)
-            else:
-                outputs = _train_iter(data, labels, nety, criterion, optimizer, sgnums)
+            # the optimizer steps once per accum_steps batches (the last group of the epoch can be smaller)
+            group_start = i - i % accum_steps
+            group_size = min(accum_steps, nbatch_epoch - group_start)
+            first = i == group_start
+            last = i == group_start + group_size - 1
+            # gradients are only all-reduced on the last micro-batch
+            sync = nety.no_sync() if distributed and not last else contextlib.nullcontext()
+            tstep = time.time()
+            with sync, torch.profiler.record_function("train_step"):
+                if debug_mode:
+                    with torch.autograd.detect_anomaly():
+                        outputs = _train_iter(data, labels, fwd_model, criterion, optimizer, sgnums,
+                                              get_autocast(all_imgs.dev, amp), scaler, group_size, first, last,
+                                              debug_checks, loss_sum)
+                else:
+                    outputs = _train_iter(data, labels, fwd_model, criterion, optimizer, sgnums,
+                                          get_autocast(all_imgs.dev, amp), scaler, group_size, first, last,
+                                          debug_checks, loss_sum)
+            nloss += 1
+            if is_first_step:
+                logger.info("First training step: %.2f sec%s"
+                            % (time.time()-tstep, " (includes torch.compile)" if compile_model else ""))
+                is_first_step = False
             #print("Predictions are in the range %f-%f" % (outputs.min().item(), outputs.max().item() ) )
-
+            sync_counter.stop()
+            opt_step = i // accum_steps + 1
+            if last and (opt_step % print_freq == 0 or i == nbatch_epoch-1):
+                if rank==0:
+                    msg = "Training Epoch %d batch %d/%d, train loss=%.5f" \
+                        % (epoch+1, opt_step, np.ceil(nbatch / accum_steps), loss_sum.item() / nloss)
+                    if sync_counter.enabled:
+                        msg += ", %.1f host-device syncs per batch" % sync_counter.per_step()
+                    print(msg, flush=True)
+                loss_sum.zero_()
+                nloss = 0
+            global_step += 1
+            if save_steps is not None and last and global_step >= next_save:
+                next_save = (global_step // save_steps + 1) * save_steps
+                ddp.consolidate_optimizer(optimizer)
+                # every rank has its own random number generators
+                rngs = [rng_states()]
+                if distributed:
+                    rngs = [None]*nrank if rank == 0 else None
+                    td.gather_object(rng_states(), rngs)
+                if writer is not None:
+                    state = checkpoint_state(epoch, nety, optimizer, train_loss, training_args, scaler)
+                    state["resume"] = {"step": i+1, "global_step": global_step, "rng_states": rngs,
+                                       "train_mode": nety.training}
+                    writer.submit({os.path.join(outdir, "nety_step.chkpt"): state}, rotate=False)
+            tbatch = time.time()
+
+        if str(all_imgs.dev).startswith("cuda"):
+            # wait for the queued steps, so the training time is accurate
+            torch.cuda.synchronize(all_imgs.dev)
         ttrain = time.time()-t0
-        if COMM is None or COMM.rank==0:
+        epoch_stats.append({"epoch": epoch+1, "train_sec": ttrain, "wait_sec": twait, "images": nimg_loaded})
+        if rank==0:
             print("Traing time: %.4f sec" % ttrain, flush=True)
+        mb_loaded = nbytes_loaded / 1e6
+        logger.info("Data loading: %.1f MB of images delivered in %.2f sec (%.1f MB/s), waited %.2f sec on the loader"
+                    % (mb_loaded, ttrain, mb_loaded / ttrain, twait))
+        if read_start is not None:
+            nbytes_read, tread = (end - start for end, start in zip(all_imgs.get_read_stats(), read_start))
+            if nbytes_read > 0:
+                # summed over the worker processes, so this is the throughput of a single reader
+                logger.info("Data reads: %.1f MB read from disk in %.2f sec of reading (%.1f MB/s per reader)"
+                            % (nbytes_read/1e6, tread, nbytes_read/1e6 / max(tread, 1e-6)))
+        if all_imgs.cache is not None:
+            cache_stats = all_imgs.cache.stats()
+            logger.info("Sample cache: %.1f%% hit rate, %d images (%.1f MB) resident"
+                        % (cache_stats["hit_rate"]*100, cache_stats["items"], cache_stats["nbytes"]/1e6))
 
         # <><><><><><><><
         #   Validation
         # <><><><><><><><>
+        is_validated = (epoch+1) % validate_every == 0 or epoch+1 == max_ep
         nety.eval()
-        with torch.no_grad():
-            logger.info("Computing test accuracy:")
-            acc, test_loss, test_lab, test_pred = validate(test_tens, nety, epoch, criterion, COMM, error=error)
-            logger.info("Computing train accuracy:")
-            train_acc,train_loss,_,_ = validate(train_tens_validate, nety, epoch, criterion, COMM, error=error)
-            logger.info("Train loss=%.7f, Test loss=%.7f" % (train_loss, test_loss))
-
-            mx_acc = max(acc, mx_acc)
+        if is_validated:
+            with torch.no_grad(), torch.profiler.record_function("validate"):
+                logger.info("Computing test accuracy:")
+                acc, test_loss, test_lab, test_pred = validate(test_tens, fwd_model, epoch, criterion, COMM, error=error,
+                                                               dev=all_imgs.dev, non_blocking=pin_memory,
+                                                               img_dtype=img_dtype, amp=amp, channels_last=channels_last)
+                logger.info("Computing train accuracy:")
+                train_acc,train_loss,_,_ = validate(train_tens_validate, fwd_model, epoch, criterion, COMM, error=error,
+                                                    dev=all_imgs.dev, non_blocking=pin_memory,
+                                                    img_dtype=img_dtype, amp=amp, channels_last=channels_last)
+                logger.info("Train loss=%.7f, Test loss=%.7f" % (train_loss, test_loss))
+
+                mx_acc = max(acc, mx_acc)
+
+            if test_loss < best_loss - early_stop_delta:
+                best_loss = test_loss
+                nstale = 0
+            else:
+                nstale += 1
 
             #try:
-            #    if COMM is None or COMM.rank==0:
+            #    if rank==0:
             #        plot_acc(ax0, 0, test_loss, epoch, starting_ep)
             #        plot_acc(ax0, 1, train_loss, epoch, starting_ep)
             #        plot_acc(ax0, 2, train_loss, epoch, starting_ep)
@@ -533,38 +1043,86 @@ def do_training(h5input, h5label, h5imgs, outdir,
         # <><><><><><><><>
 
         # optional save
-        if (epoch+1)%save_freq==0 and (COMM is None or COMM.rank==0):
+        if (epoch+1)%save_freq==0:
+            ddp.consolidate_optimizer(optimizer)
+        if (epoch+1)%save_freq==0 and rank==0:
             outname = os.path.join(outdir, "nety_ep%d.nn"%(epoch+1))
-            torch.save(nety.state_dict(), outname)
             #plt.savefig(outname.replace(".nn", "_train.png"))
             #save_results_fig(outname, test_lab, test_pred)
-            if True: #False:# save_cps:
-                restart_file = outname.replace(".nn", ".chkpt")
-                save_checkpoint(restart_file,
-                                epoch, nety, optimizer, train_loss, training_args)
+            restart_file = outname.replace(".nn", ".chkpt")
+            writer.submit({outname: nety.state_dict(),
+                           restart_file: checkpoint_state(epoch, nety, optimizer, train_loss, training_args, scaler)},
+                          loss=test_loss)
+
+        if early_stop is not None and nstale >= early_stop:
+            logger.info("Test loss did not improve in %d validations, stopping after epoch %d" % (nstale, epoch+1))
+            break
+
+    if profiler is not None:
+        profiler.close()
+        if profiler.nstep > profiler.start:
+            logger.info("Wrote profile to %s and %s" % (profiler.trace_file, profiler.table_file))
+        else:
+            logger.info("Training had fewer than %d batches, nothing was profiled" % (profiler.start+1))
 
     # final save! 
-    if COMM is None or COMM.rank==0:
+    ddp.consolidate_optimizer(optimizer)
+    if rank==0:
         outname = os.path.join(outdir, "nety_epLast.nn")
-        torch.save(nety.state_dict(), outname)
         #plt.savefig(outname.replace(".nn", "_train.png"))
         #save_results_fig(outname, test_lab, test_pred)
         restart_file = outname.replace(".nn", ".chkpt")
-        save_checkpoint(restart_file,
-                        epoch, nety, optimizer, train_loss, training_args)
-
-
-def save_checkpoint(filename, epoch, model, optimizer, loss, args):
+        writer.submit({outname: nety.state_dict(),
+                       restart_file: checkpoint_state(epoch, nety, optimizer, train_loss, training_args, scaler)},
+                      rotate=False)
+        writer.close()
+    if all_imgs.cache is not None:
+        all_imgs.cache.close()
+    if train_stream is not None:
+        train_stream.close()
+    return epoch_stats
+
+
+def _activation_bytes(model, image_shape, dev):
+    """
+    :param model: RESNetAny model
+    :param image_shape: shape of the training images
+    :param dev: device of the model
+    :return: bytes of activations stored for the backward pass of one image, without and with activation checkpointing
+    """
+    was_training = model.training
+    was_checkpointing = model.checkpoint_activations
+    model.eval()  # dont update the batchnorm statistics
+    x = torch.zeros((1, 1) + tuple(image_shape[-2:]), device=dev)
+    nbytes = []
+    for ckpt in [False, True]:
+        model.checkpoint_activations = ckpt
+        nbytes.append(saved_activation_bytes(model, x))
+    model.checkpoint_activations = was_checkpointing
+    model.train(was_training)
+    return nbytes
+
+
+def checkpoint_state(epoch, model, optimizer, loss, args, scaler=None):
+    """the contents of a .chkpt file (see restart_net.py)"""
     for i_arg, (name, val) in enumerate(args):
         if isinstance(val, str):
             if os.path.isdir(val) or os.path.isfile(val):
                 args[i_arg] = name, os.path.abspath(val)
-        if name == "COMM":
+        if name in ["COMM", "cp"]:
+            # the checkpoint this run was restarted from would be nested in every new checkpoint
             args[i_arg] = name, None
 
-    torch.save({"epoch": epoch, "model_state": model.state_dict(),
-                "optimizer_state": optimizer.state_dict(),
-                'loss': loss, "args": args}, filename)
+    state = {"epoch": epoch, "model_state": model.state_dict(),
+             "optimizer_state": optimizer.state_dict(),
+             'loss': None if loss is None else float(loss), "args": args}
+    if scaler is not None:
+        state["scaler_state"] = scaler.state_dict()
+    return state
+
+
+def save_checkpoint(filename, epoch, model, optimizer, loss, args, scaler=None):
+    torch.save(checkpoint_state(epoch, model, optimizer, loss, args, scaler), filename)
 
 
 def main():
@@ -578,6 +1136,10 @@ def main():
         train_start_stop = args.trainRange
     if args.testRange is not None:
         test_start_stop = args.testRange
+    ngpu_per_node = 1
+    if args.ddp:
+        ddp.env_init(args.ddpBackend)
+        ngpu_per_node = max(torch.cuda.device_count(), 1)
     do_training(args.input, args.labelName, args.imgsName, args.outdir,
                 train_start_stop=train_start_stop,
                 test_start_stop=test_start_stop,
@@ -587,7 +1149,7 @@ def main():
                 dropout=args.dropout,
                 lr=args.lr, bs=args.bs, max_ep=args.ep,
                 arch=args.arch, loss=args.loss,
-                dev="cuda:%d" % args.gpuid,
+                dev="cpu" if args.cpu else "cuda:%d" % args.gpuid, ngpu_per_node=ngpu_per_node,
                 logfile=args.logfile, loglevel=args.loglevel,
                 label_sel=args.labelSel,
                 half_precision=args.half,
@@ -595,7 +1157,20 @@ def main():
                 use_geom=args.useGeom, error=args.error, weights=args.weights,
                 use_transform=args.transform, eval_mode_only=not args.noEvalOnly,
                 ori_mode=args.oriMode, debug_mode=args.debugMode,
-                use_sgnums=args.useSGNums, manual_seed=args.manualSeed, kernel_size=args.kernelSize)
+                use_sgnums=args.useSGNums, manual_seed=args.manualSeed, kernel_size=args.kernelSize,
+                num_workers=args.numWorkers, prefetch_factor=args.prefetchFactor,
+                chunk_batches=args.chunkBatches, block_size=args.blockSize, block_window=args.blockWindow,
+                shard_shuffle=args.shardShuffle, shuffle_buffer=args.shuffleBuffer, prefix=args.prefix,
+                cache_gb=args.cacheGB, cache_policy=args.cachePolicy, max_shift=args.maxShift,
+                stream_sims=args.streamSims, stream_producers=args.streamProducers, stream_queue=args.streamQueue,
+                stream_tee=args.streamTee, preproc_cache=args.preprocCache, image_reader=args.imageReader,
+                amp=args.amp, validate_every=args.validateEvery, train_validate_size=args.trainValidateSize,
+                early_stop=args.earlyStop, early_stop_delta=args.earlyStopDelta,
+                keep_last=args.keepLast, keep_best=args.keepBest, save_steps=args.saveSteps,
+                compile_model=args.compile, compile_mode=args.compileMode, channels_last=args.channelsLast,
+                accum_steps=args.accumSteps, comm_hook=args.commHook, powersgd_rank=args.powerSGDRank,
+                zero=args.zero, checkpoint_activations=args.checkpointActivations,
+                profile_steps=args.profileSteps, debug_checks=args.debugChecks, print_freq=args.printFreq)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,23 @@
 from argparse import ArgumentParser
 parser = ArgumentParser()
-parser.add_argument("checkpoint", type=str, help=".chkpt file from net.py")
+parser.add_argument("checkpoint", type=str, help=".chkpt file from net.py (nety_step.chkpt resumes mid-epoch, see --saveSteps)")
 parser.add_argument("--outdir", type=str, help="optional new output folder")
 parser.add_argument("--maxepochs", type=int, help="optional new max number of epochs to run")
+parser.add_argument("--ddp", action="store_true",
+                    help="resume a distributed run launched with torchrun (no SLURM or MPI needed), "
+                         "e.g. torchrun --nproc_per_node 8 restart_net.py out/nety_step.chkpt --ddp")
+parser.add_argument("--ddpBackend", type=str, choices=["nccl", "gloo"], default=None,
+                    help="torch.distributed backend (default: gloo if the run trained on the CPU, "
+                         "else nccl with GPUs)")
 args = parser.parse_args()
 
-from mpi4py import MPI
-COMM = MPI.COMM_WORLD
-from resonet.utils import ddp, mpi
+import os
+try:
+    from mpi4py import MPI
+    COMM = MPI.COMM_WORLD
+except ImportError:
+    COMM = None
+from resonet.utils import ddp
 from resonet import net
 import torch
 from resonet.utils.eval_model import strip_names_in_state
@@ -17,12 +27,22 @@ cp = torch.load(args.checkpoint, map_location=torch.device("cpu"))
 cp["model_state"] = strip_names_in_state(cp["model_state"])
 train_kwargs = dict(cp["args"])
 
-if COMM.size > 1:
+backend = args.ddpBackend
+if backend is None:
+    backend = "gloo" if train_kwargs["dev"] == "cpu" else ddp.default_backend()
+if args.ddp:
+    ddp.env_init(backend)
+    train_kwargs["COMM"] = None
+    train_kwargs["ngpu_per_node"] = max(torch.cuda.device_count(), 1)
+elif int(os.environ.get("WORLD_SIZE", 1)) > 1:
+    raise RuntimeError("launched with torchrun, but without --ddp (every process would train on its own)")
+elif COMM is not None and COMM.size > 1:
+    from resonet.utils import mpi
     LOCAL_COMM = mpi.get_host_comm()
     ngpu_per_node=LOCAL_COMM.size
     if COMM.rank==0:
         print("GPUs per node: %d" % ngpu_per_node, flush=True)
-    ddp.slurm_init(COMM, mpi.get_host_comm())
+    ddp.slurm_init(COMM, mpi.get_host_comm(), backend=backend)
     train_kwargs["COMM"] = COMM
     train_kwargs["ngpu_per_node"] = ngpu_per_node
 
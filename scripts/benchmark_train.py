@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import itertools
+import subprocess
+import h5py
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from argparse import ArgumentParser
+
+from resonet.utils import h5codecs
+from resonet.sims.main import PARAM_NAMES, GEOM_NAMES
+from resonet.sims.paths_and_const import PDB_MAP
+from resonet.scripts import merge_h5s
+
+"""
+Benchmark the training throughput (images/s, fraction of time waiting on the data loader, peak memory)
+on a synthetic dataset, for combinations of arch, batch size, image storage dtype, codec and loader settings.
+Each combination trains in a fresh process, and the results are written to a JSON file,
+so runs can be compared across commits and machines.
+
+Example usage: python benchmark_train.py bench --archs res18 res50 --batchSizes 16 64 --imageDtypes float32 uint8 \
+    --codecs none bslz4 --numWorkers 0 4
+The synthetic master files are written to bench/data_* (once, and reused by later runs).
+"""
+
+IMAGE_DTYPES = ["float32", "uint16", "uint8"]
+
+
+def write_rank_file(fname, nimg, image_shape=(512, 512), dtype="float32", codec=None, seed=0, block=64):
+    """
+    write a rank*.h5 file with synthetic shots, in the layout of sims/main.py (see create_datasets):
+    images (Poisson background with bright spots), labels with names and pdbmap attrs, and geom with names
+
+    :param fname: output file
+    :param nimg: number of images
+    :param image_shape: shape of each image
+    :param dtype: image storage dtype, one of IMAGE_DTYPES
+    :param codec: None (uncompressed) or one of h5codecs.CODECS
+    :param seed: random seed
+    :param block: number of images generated at once
+    """
+    if dtype not in IMAGE_DTYPES:
+        raise ValueError("dtype should be one of %s" % ", ".join(IMAGE_DTYPES))
+    rng = np.random.default_rng(seed)
+    comp_args = {} if codec is None else h5codecs.get_comp_args(codec)
+    labels = rng.random((nimg, len(PARAM_NAMES)), dtype=np.float32)
+    reso = rng.uniform(1.5, 6, nimg)
+    labels[:, PARAM_NAMES.index("reso")] = reso
+    labels[:, PARAM_NAMES.index("one_over_reso")] = 1 / reso
+    geom = np.zeros((nimg, len(GEOM_NAMES)), np.float32)
+    geom[:, GEOM_NAMES.index("detdist")] = rng.uniform(100, 300, nimg)
+    geom[:, GEOM_NAMES.index("wavelen")] = rng.uniform(0.9, 1.3, nimg)
+    geom[:, GEOM_NAMES.index("pixsize")] = 0.172
+    geom[:, GEOM_NAMES.index("xdim")] = 2463
+    geom[:, GEOM_NAMES.index("ydim")] = 2527
+
+    maxval = np.iinfo(dtype).max if dtype != "float32" else None
+    with h5py.File(fname, "w") as out:
+        dset = out.create_dataset("images", shape=(nimg,) + tuple(image_shape), dtype=dtype,
+                                  chunks=(1,) + tuple(image_shape), **comp_args)
+        for start in range(0, nimg, block):
+            n = min(block, nimg - start)
+            imgs = rng.poisson(1, (n, int(np.prod(image_shape)))).astype(np.float32)
+            spots = rng.integers(0, imgs.shape[1], (n, 50))
+            imgs[np.arange(n)[:, None], spots] += rng.integers(50, 500, (n, 50))
+            if maxval is not None:
+                imgs = np.minimum(imgs, maxval)
+            dset[start: start+n] = imgs.reshape((n,) + tuple(image_shape)).astype(dtype)
+        lab_dset = out.create_dataset("labels", data=labels, **comp_args)
+        geom_dset = out.create_dataset("geom", data=geom, **comp_args)
+        lab_dset.attrs["names"] = PARAM_NAMES
+        lab_dset.attrs["pdbmap"] = list(PDB_MAP)
+        geom_dset.attrs["names"] = GEOM_NAMES
+
+
+def write_synthetic_master(outdir, nimg, image_shape=(512, 512), dtype="float32", codec=None, nfiles=4, seed=0):
+    """
+    write nfiles rank*.h5 files (see write_rank_file) and merge them into outdir/master.h5, as merge_h5s.py does
+    :return: name of the master file
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    counts = [len(part) for part in np.array_split(np.arange(nimg), nfiles)]
+    index = {"keys": None, "files": []}
+    for rank, count in enumerate(counts):
+        fname = os.path.abspath(os.path.join(outdir, "rank%d.h5" % rank))
+        write_rank_file(fname, count, image_shape, dtype, codec, seed=seed+rank)
+        count, key_info = merge_h5s.probe_file(fname, merge_h5s.DEFAULT_KEYS)
+        if index["keys"] is None:
+            index["keys"] = key_info
+        index["files"].append({"name": fname, "count": count})
+    master = os.path.join(outdir, "master.h5")
+    merge_h5s.write_master(master, index)
+    merge_h5s.write_index(master, index)
+    return master
+
+
+def _peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(who).ru_maxrss * scale / 1e6
+
+
+def _train(config, out_queue):
+    from resonet import net
+    result = {}
+    try:
+        stats = net.do_training(config["master"], "labels", "images", config["rundir"],
+                                arch=config["arch"], bs=config["bs"], dev=config["dev"], max_ep=config["epochs"],
+                                train_start_stop=(config["ntest"], config["nimg"]),
+                                test_start_stop=(0, config["ntest"]), label_sel=["one_over_reso"],
+                                num_workers=config["num_workers"], amp=config["amp"],
+                                save_freq=config["epochs"]+1, validate_every=config["epochs"], display=False)
+        # the first epoch includes warmup (worker startup, cudnn autotuning, ...)
+        timed = stats[1:] if len(stats) > 1 else stats
+        train_sec = sum(ep["train_sec"] for ep in timed)
+        result["images_per_sec"] = sum(ep["images"] for ep in timed) / train_sec
+        result["data_wait_fraction"] = sum(ep["wait_sec"] for ep in timed) / train_sec
+        result["epochs"] = stats
+        if str(config["dev"]).startswith("cuda"):
+            result["peak_gpu_mem_mb"] = torch.cuda.max_memory_allocated(config["dev"]) / 1e6
+    except Exception as err:
+        result["error"] = "%s: %s" % (type(err).__name__, err)
+    result["peak_rss_mb"] = _peak_rss_mb(resource.RUSAGE_SELF)
+    result["peak_rss_children_mb"] = _peak_rss_mb(resource.RUSAGE_CHILDREN)
+    out_queue.put(result)
+
+
+def run_config(config):
+    """
+    train with the settings in config, in a new process (so the peak memory is measured per config)
+    :param config: dict with master, rundir, arch, bs, dev, epochs, nimg, ntest, num_workers and amp
+    :return: dict with images_per_sec, data_wait_fraction, peak_rss_mb, the per-epoch stats from do_training,
+        or error if training failed
+    """
+    ctx = mp.get_context("spawn")
+    out_queue = ctx.Queue()
+    proc = ctx.Process(target=_train, args=(config, out_queue))
+    proc.start()
+    proc.join()
+    if out_queue.empty():
+        return {"error": "benchmark process exited with code %s" % proc.exitcode}
+    return out_queue.get()
+
+
+def get_metadata():
+    """:return: commit, versions and hardware of this run"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(merge_h5s.__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    meta = {"commit": commit, "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "host": platform.node(),
+            "python": platform.python_version(), "torch": torch.__version__, "h5py": h5py.__version__,
+            "cpus": os.cpu_count(), "argv": sys.argv}
+    if torch.cuda.is_available():
+        meta["gpu"] = torch.cuda.get_device_name()
+    return meta
+
+
+def get_parser():
+    from resonet.params import ARCHES
+    parser = ArgumentParser()
+    parser.add_argument("outdir", type=str, help="folder for the synthetic data, the training runs and the results")
+    parser.add_argument("--archs", nargs="+", type=str, default=list(ARCHES), choices=list(ARCHES),
+                        help="architectures to benchmark (default: all)")
+    parser.add_argument("--batchSizes", nargs="+", type=int, default=[16, 64])
+    parser.add_argument("--imageDtypes", nargs="+", type=str, default=["float32"], choices=IMAGE_DTYPES,
+                        help="storage dtypes of the synthetic images")
+    parser.add_argument("--codecs", nargs="+", type=str, default=["none"], choices=["none"] + h5codecs.CODECS,
+                        help="compression of the synthetic images")
+    parser.add_argument("--numWorkers", nargs="+", type=int, default=[0, 4], help="DataLoader workers")
+    parser.add_argument("--amp", nargs="+", type=str, default=["none"], choices=["none", "bf16", "fp16"],
+                        help="training precisions (see net.py --amp)")
+    parser.add_argument("--nimg", type=int, default=1024, help="number of synthetic images")
+    parser.add_argument("--ntest", type=int, default=64,
+                        help="images held out for the (single, final) validation, the others are trained on")
+    parser.add_argument("--imageShape", nargs=2, type=int, default=[512, 512])
+    parser.add_argument("--nfiles", type=int, default=4, help="number of rank*.h5 files behind the master file")
+    parser.add_argument("--epochs", type=int, default=2,
+                        help="epochs per config. With more than one epoch, the first is not timed (warmup)")
+    parser.add_argument("--dev", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--json", type=str, default=None, help="results file (default: outdir/benchmark.json)")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    json_name = args.json or os.path.join(args.outdir, "benchmark.json")
+    results = {"meta": get_metadata(), "results": []}
+
+    masters = {}
+    for dtype, codec in itertools.product(args.imageDtypes, args.codecs):
+        datadir = os.path.join(args.outdir, "data_%s_%s_%d_%dx%d" % (dtype, codec, args.nimg, *args.imageShape))
+        master = os.path.join(datadir, "master.h5")
+        if not os.path.exists(master):
+            print("Writing synthetic data to %s" % datadir, flush=True)
+            write_synthetic_master(datadir, args.nimg, args.imageShape, dtype, None if codec == "none" else codec,
+                                   args.nfiles)
+        masters[dtype, codec] = master
+
+    combos = list(itertools.product(args.archs, args.batchSizes, args.imageDtypes, args.codecs, args.numWorkers,
+                                    args.amp))
+    for i_c, (arch, bs, dtype, codec, num_workers, amp) in enumerate(combos):
+        config = {"arch": arch, "bs": bs, "image_dtype": dtype, "codec": codec, "num_workers": num_workers,
+                  "amp": None if amp == "none" else amp, "dev": args.dev, "epochs": args.epochs,
+                  "nimg": args.nimg, "ntest": args.ntest, "image_shape": args.imageShape}
+        name = "%s_bs%d_%s_%s_nw%d_%s" % (arch, bs, dtype, codec, num_workers, amp)
+        print("Config %d / %d: %s" % (i_c+1, len(combos), name), flush=True)
+        result = run_config(dict(config, master=masters[dtype, codec], rundir=os.path.join(args.outdir, "runs", name)))
+        if "error" in result:
+            print("\tfailed: %s" % result["error"], flush=True)
+        else:
+            print("\t%.1f images/s, %.1f%% waiting on data, peak RSS %.0f MB"
+                  % (result["images_per_sec"], result["data_wait_fraction"]*100, result["peak_rss_mb"]), flush=True)
+        results["results"].append(dict(config, **result))
+        # written after every config, so an interrupted benchmark keeps its results
+        tmpname = json_name + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(results, f, indent=1)
+        os.replace(tmpname, json_name)
+    print("Wrote %s" % json_name)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,16 +4,31 @@ import glob
 import numpy as np
 from joblib import Parallel, delayed
 
+from resonet.utils import h5codecs
+
 """
-Example usage: python compress.py folder1 fodler2 10
-The above command uses 10 processes to compress the training files in folders folder1 and fodler2
+Example usage: python compress.py folder1 10
+The above command uses 10 processes to compress the training files in folder1
 The files should compress considerably.
+Images are read and written in blocks of whole chunks, and compressed with a selectable codec
+(e.g. --codec bslz4, which requires hdf5plugin and decodes much faster than gzip)
 """
 
 
-def proc_main(jid, dirname, numJob):
+def proc_main(jid, dirname, numJob, img_dtype=np.uint16, codec="gzip", block_size=64, chunk_len=1):
+    """
 
+    :param jid: job ID
+    :param dirname: folder containing rank*.h5 files
+    :param numJob: number of jobs
+    :param img_dtype: storage type for the compressed images
+    :param codec: compression codec, see resonet.utils.h5codecs
+    :param block_size: number of images per read/write call (rounded to a multiple of chunk_len)
+    :param chunk_len: number of images per chunk in the compressed file
+    """
     fnames = glob.glob(dirname + "/rank*.h5")
+    comp_args = h5codecs.get_comp_args(codec)
+    block_size = max(block_size // chunk_len, 1) * chunk_len
 
     for i_f, f in enumerate(fnames):
         if i_f % numJob != jid:
@@ -26,23 +41,20 @@ def proc_main(jid, dirname, numJob):
 
         with h5py.File(fnew, "w") as hnew:
             dset_im = hnew.create_dataset('images',
-                    dtype=np.uint16,
-                    compression="gzip",
+                    dtype=img_dtype,
                     shape=h['images'].shape,
-                    compression_opts=4)
-            for i_img in range(imgs.shape[0]):
-                if i_img % 10==0: # and jid==0:
-                    print(f"done with file {i_f+1}/{len(fnames)} shot {i_img}/{imgs.shape[0]}")
-                im = imgs[i_img].astype(np.uint16)
-                dset_im[i_img] = im
-
-            dset_lab = hnew.create_dataset("labels", data=labs.astype(np.float32),
-                compression="gzip", compression_opts=4)
+                    chunks=(chunk_len,) + h['images'].shape[1:],
+                    **comp_args)
+            for start in range(0, imgs.shape[0], block_size):
+                stop = min(start+block_size, imgs.shape[0])
+                print(f"done with file {i_f+1}/{len(fnames)} shots {start}-{stop}/{imgs.shape[0]}")
+                dset_im[start:stop] = imgs[start:stop].astype(img_dtype)
+
+            dset_lab = hnew.create_dataset("labels", data=labs.astype(np.float32), **comp_args)
             dset_lab.attrs['names'] = h['labels'].attrs['names']
             dset_lab.attrs['pdbmap'] = h['labels'].attrs['pdbmap']
 
-            dset_geom = hnew.create_dataset("geom", data=geom.astype(np.float32),
-                compression="gzip", compression_opts=4)
+            dset_geom = hnew.create_dataset("geom", data=geom.astype(np.float32), **comp_args)
             dset_geom.attrs['names'] = h['geom'].attrs['names']
 
 
@@ -51,10 +63,17 @@ def main():
     parser = ArgumentParser()
     parser.add_argument("dirname", type=str, help="training data output folder")
     parser.add_argument("nj", type=int, help="number of parallel jobs to run")
+    parser.add_argument("--uint8", action="store_true",
+                        help="store images as uint8 (lossless for sims, whose pixels are integers from 0-255)")
+    parser.add_argument("--codec", type=str, choices=h5codecs.CODECS, default="gzip",
+                        help="compression codec (all but gzip require hdf5plugin)")
+    parser.add_argument("--blockSize", type=int, default=64, help="number of images to read and compress per call")
+    parser.add_argument("--chunkLen", type=int, default=1, help="number of images per hdf5 chunk")
     args = parser.parse_args()
-    Parallel(args.nj)(delayed(proc_main)(j, args.dirname, args.nj) for j in range(args.nj))
+    img_dtype = np.uint8 if args.uint8 else np.uint16
+    Parallel(args.nj)(delayed(proc_main)(j, args.dirname, args.nj, img_dtype, args.codec,
+                                         args.blockSize, args.chunkLen) for j in range(args.nj))
 
 
 if __name__=="__main__":
     main()
-
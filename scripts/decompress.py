@@ -5,6 +5,8 @@ import glob
 import os
 import numpy as np
 
+from resonet.utils import h5codecs  # registers hdf5plugin filters, needed to read e.g. bslz4 files
+
 
 """
 usage:
@@ -32,12 +34,15 @@ def proc_main(jid, args):
             geom = h['geom'][()]
         except KeyError:
             geom = None
+        img_dtype = np.float32
+        if args.keepUint8 and imgs.dtype == np.uint8:
+            img_dtype = np.uint8
         with h5py.File(fnew, "w") as hnew:
-            dset = hnew.create_dataset("images", shape=imgs.shape, dtype=np.float32)
+            dset = hnew.create_dataset("images", shape=imgs.shape, dtype=img_dtype)
             for i_img in range(imgs.shape[0]):
                 if i_img % 10==0:
                    print(f"Job{jid} Decompressing file {i_f+1}/{len(fnames)}, shot {i_img+1}/{imgs.shape[0]}")
-                dset[i_img] = imgs[i_img].astype(np.float32)
+                dset[i_img] = imgs[i_img].astype(img_dtype)
 
             lab_dset = hnew.create_dataset("labels", data=labels.astype(np.float32))
             if geom is not None:
@@ -57,6 +62,7 @@ def main():
     parser.add_argument("--njobs", type=int, default=4)
     parser.add_argument("--names", type=str, default=None, nargs='+')
     parser.add_argument("--ranks", action="store_true", help="use this option to decompress files named rank*.h5")
+    parser.add_argument("--keepUint8", action="store_true", help="write uint8 images as uncompressed uint8 instead of float32")
     args = parser.parse_args()
     if args.ranks:
         fnames = glob.glob(args.dirname + "/rank*.h5")
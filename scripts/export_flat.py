@@ -0,0 +1,73 @@
+import os
+import json
+import h5py
+import numpy as np
+from argparse import ArgumentParser
+
+from resonet.loaders import FLAT_META, FLAT_IMAGES, FLAT_LABELS, FLAT_GEOM
+
+"""
+Export a master file (from merge_h5s.py) to a flat, uncompressed training set for resonet.loaders.MemmapSimDataDset
+
+Example usage: python export_flat.py master.h5 /local/nvme/trainset
+The output folder holds images.bin (one page-aligned record per image), labels.npy, geom.npy and meta.json
+"""
+
+PAGE_SIZE = 4096
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("input", type=str, help="master file written by merge_h5s.py")
+    parser.add_argument("outdir", type=str, help="output folder (will be created if necessary)")
+    parser.add_argument("--labelName", type=str, default="labels", help="path to labels dataset (in input h5 file)")
+    parser.add_argument("--imgsName", type=str, default="images", help="path to images dataset (in input h5 file)")
+    parser.add_argument("--blockSize", type=int, default=64, help="number of images to read per h5 call")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    with h5py.File(args.input, "r") as h:
+        imgs = h[args.imgsName]
+        nimg = imgs.shape[0]
+        shape = imgs.shape[1:]
+        dtype = imgs.dtype
+        img_nbytes = int(np.prod(shape)) * dtype.itemsize
+        # pad each record to a whole number of pages
+        stride = int(np.ceil(img_nbytes / PAGE_SIZE)) * PAGE_SIZE
+        assert stride % dtype.itemsize == 0
+
+        records = np.memmap(os.path.join(args.outdir, FLAT_IMAGES), dtype=dtype, mode="w+",
+                            shape=(nimg, stride // dtype.itemsize))
+        for start in range(0, nimg, args.blockSize):
+            stop = min(start+args.blockSize, nimg)
+            print("exporting images %d-%d / %d" % (start+1, stop, nimg))
+            records[start:stop, :int(np.prod(shape))] = imgs[start:stop].reshape((stop-start, -1))
+        records.flush()
+        del records
+
+        labels = h[args.labelName]
+        np.save(os.path.join(args.outdir, FLAT_LABELS), labels[()])
+        label_names = pdbmap = geom_names = None
+        if "names" in labels.attrs:
+            label_names = [str(name) for name in labels.attrs["names"]]
+        if "pdbmap" in labels.attrs:
+            pdbmap = [str(name) for name in labels.attrs["pdbmap"]]
+        if "geom" in h:
+            geom = h["geom"]
+            np.save(os.path.join(args.outdir, FLAT_GEOM), geom[()])
+            geom_names = []
+            if "names" in geom.attrs:
+                geom_names = [str(name) for name in geom.attrs["names"]]
+
+    meta = {"num_images": nimg, "shape": list(shape), "dtype": dtype.str, "stride": stride,
+            "label_names": label_names, "pdbmap": pdbmap, "geom_names": geom_names,
+            "source": os.path.abspath(args.input)}
+    with open(os.path.join(args.outdir, FLAT_META), "w") as f:
+        json.dump(meta, f, indent=1)
+    print("Wrote %d images (%.1f GB) to %s" % (nimg, nimg*stride/1e9, args.outdir))
+
+
+if __name__=="__main__":
+    main()
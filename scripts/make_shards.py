@@ -0,0 +1,105 @@
+import os
+import h5py
+import numpy as np
+from argparse import ArgumentParser
+from joblib import Parallel, delayed
+
+from resonet.utils import h5codecs
+
+"""
+Write pre-shuffled, fixed-size shards from one or more master files (or rank*.h5 files)
+
+Example usage: python make_shards.py master1.h5 master2.h5 shards --shardSize 512 --nj 8
+Then merge the shards and train with shard-level shuffling (see resonet.loaders.ShardShuffleSampler):
+    python merge_h5s.py shards shards/master.h5 --prefix shard
+    python net.py 100 shards/master.h5 out --shardShuffle
+Each shard is read sequentially during training, so samples are shuffled once globally here,
+and then per epoch by shard order and an in-memory shuffle buffer.
+"""
+
+
+def get_keys(h, more_keys):
+    return [key for key in ["images", "labels", "geom"] + more_keys if key in h]
+
+
+def write_shard(fnames, members, file_ids, local_ids, outname, more_keys, comp_args):
+    """
+    :param fnames: input files
+    :param members: global indices of the images in this shard, in their (shuffled) shard order
+    :param file_ids: input file index of every global index
+    :param local_ids: index within the input file of every global index
+    :param outname: name of the shard file
+    :param more_keys: additional datasets to copy
+    :param comp_args: h5py compression arguments for the images
+    """
+    handles = [h5py.File(f, "r") for f in fnames]
+    keys = get_keys(handles[0], more_keys)
+    with h5py.File(outname, "w") as out:
+        for key in keys:
+            src = handles[0][key]
+            data = np.empty((len(members),) + src.shape[1:], src.dtype)
+            for i_f, h in enumerate(handles):
+                is_in_file = np.where(file_ids[members] == i_f)[0]
+                if not len(is_in_file):
+                    continue
+                # one sorted read per input file
+                order = np.argsort(local_ids[members[is_in_file]])
+                data[is_in_file[order]] = h[key][list(local_ids[members[is_in_file[order]]])]
+            kwargs = {}
+            if key == "images":
+                kwargs = dict(comp_args)
+                kwargs["chunks"] = (1,) + data.shape[1:]
+            dset = out.create_dataset(key, data=data, **kwargs)
+            for attr in ["names", "pdbmap"]:
+                if attr in src.attrs:
+                    dset.attrs[attr] = src.attrs[attr]
+    for h in handles:
+        h.close()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("inputs", nargs="+", type=str, help="master files from merge_h5s.py (or rank*.h5 files)")
+    parser.add_argument("outdir", type=str, help="output folder for the shard*.h5 files (will be created if necessary)")
+    parser.add_argument("--shardSize", type=int, default=512, help="number of images per shard")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the global shuffle")
+    parser.add_argument("--codec", type=str, choices=h5codecs.CODECS, default=None,
+                        help="optionally compress the shard images with this codec")
+    parser.add_argument("--moreKeys", nargs="+", type=str, default=[],
+                        help="names of additional datasets to copy. These should be present in all inputs!")
+    parser.add_argument("--nj", type=int, default=1, help="number of parallel jobs")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    counts = []
+    attrs = None
+    for f in args.inputs:
+        with h5py.File(f, "r") as h:
+            counts.append(h["labels"].shape[0])
+            file_attrs = {attr: list(h["labels"].attrs[attr]) for attr in ["names", "pdbmap"]
+                          if attr in h["labels"].attrs}
+            if attrs is None:
+                attrs = file_attrs
+            elif file_attrs != attrs:
+                # the pdb label column indexes pdbmap, so it must be the same in all inputs
+                raise ValueError("labels names/pdbmap attributes in %s differ from %s" % (f, args.inputs[0]))
+
+    file_ids = np.concatenate([[i_f]*n for i_f, n in enumerate(counts)]).astype(int)
+    local_ids = np.concatenate([np.arange(n) for n in counts])
+    total = len(file_ids)
+    perm = np.random.default_rng(args.seed).permutation(total)
+    shard_starts = list(range(0, total, args.shardSize))
+    print("Writing %d images to %d shards" % (total, len(shard_starts)))
+
+    comp_args = {} if args.codec is None else h5codecs.get_comp_args(args.codec)
+    outnames = [os.path.join(args.outdir, "shard%05d.h5" % i_s) for i_s in range(len(shard_starts))]
+    Parallel(args.nj)(delayed(write_shard)(args.inputs, perm[start:start+args.shardSize], file_ids, local_ids,
+                                           outname, args.moreKeys, comp_args)
+                      for start, outname in zip(shard_starts, outnames))
+    print("Done! Merge with: python merge_h5s.py %s master.h5 --prefix shard" % args.outdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,89 @@
 import h5py
 import glob
 import os
+import json
 from argparse import ArgumentParser
 
+DEFAULT_KEYS = ["images_mean", "images", "labels", "full_maximg", "geom"]
+
+
+def index_name(outname):
+    """name of the index sidecar written next to the master file"""
+    return os.path.splitext(outname)[0] + "_index.json"
+
+
+def load_index(outname):
+    with open(index_name(outname), "r") as f:
+        index = json.load(f)
+    return index
+
+
+def write_index(outname, index):
+    tmpname = index_name(outname) + ".tmp"
+    with open(tmpname, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmpname, index_name(outname))
+
+
+def _attr_str(val):
+    return val.decode() if isinstance(val, bytes) else str(val)
+
+
+def probe_file(fname, keys):
+    """
+    :param fname: rank*.h5 file
+    :param keys: datasets to describe (those missing from the file are skipped)
+    :return: number of images, and a dict of shape, dtype and names/pdbmap attrs per dataset
+    """
+    key_info = {}
+    with h5py.File(fname, "r") as h:
+        for key in keys:
+            if key not in h:
+                continue
+            dset = h[key]
+            attrs = {attr: [_attr_str(val) for val in dset.attrs[attr]] for attr in ["names", "pdbmap"]
+                     if attr in dset.attrs}
+            key_info[key] = {"shape": list(dset.shape[1:]), "dtype": dset.dtype.str, "attrs": attrs}
+        count = h["labels"].shape[0]
+    return count, key_info
+
+
+def check_file(fname, key_info, index_keys):
+    """raise a ValueError if the datasets in fname dont match the index"""
+    for key, info in index_keys.items():
+        if key not in key_info:
+            raise ValueError("file %s has no dataset %s" % (fname, key))
+        if key_info[key]["shape"] != info["shape"] or key_info[key]["dtype"] != info["dtype"]:
+            raise ValueError("dataset %s in file %s has shape %s and dtype %s, but the index has %s and %s"
+                             % (key, fname, key_info[key]["shape"], key_info[key]["dtype"],
+                                info["shape"], info["dtype"]))
+
+
+def write_master(outname, index):
+    """
+    write the virtual master file from the index, without opening any of the source files
+    """
+    total_imgs = sum(f["count"] for f in index["files"])
+    tmpname = outname + ".tmp"
+    with h5py.File(tmpname, "w") as H:
+        for key, info in index["keys"].items():
+            shape = tuple(info["shape"])
+            dtype = info["dtype"]
+            layout = h5py.VirtualLayout(shape=(total_imgs,) + shape, dtype=dtype)
+            start = 0
+            for f in index["files"]:
+                nimg = f["count"]
+                vsource = h5py.VirtualSource(f["name"], key, shape=(nimg,) + shape, dtype=dtype)
+                layout[start:start+nimg] = vsource
+                start += nimg
+            vd = H.create_virtual_dataset(key, layout)
+            for attr, val in info["attrs"].items():
+                vd.attrs[attr] = val
+    # replace atomically, so jobs reading the current master are not affected
+    os.replace(tmpname, outname)
+    return total_imgs
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument("dirnames", nargs="+", type=str, help="output folders from runme.py or runme_joblib.py")
@@ -10,11 +91,16 @@ def main():
     parser.add_argument("--moreKeys", nargs="+", type=str, default=[], help="names of additional datasets to virtualize. These should be present in all rank* files!")
     parser.add_argument("--prefix", type=str, default="rank",
             help="merge h5 files that start with this (default: rank)")
+    parser.add_argument("--append", action="store_true",
+            help="add only the files that are not yet in the index sidecar of an existing master file "
+                 "(the files already in the index are not opened)")
     args = parser.parse_args()
 
     """
     Use this method to merge the rank*.h5 files that are output by
     runme_cpu.py (when using MPI mode , each rank writes a file)
+    Alongside the master file, an index sidecar (outname_index.json) stores the image count of each file,
+    and the shape, dtype and attributes of each dataset. Use --append to extend the master with new files.
     """
 
     fnames = []
@@ -22,63 +108,35 @@ def main():
         fnames += glob.glob(os.path.join(dirname, "%s*h5" % args.prefix))
     fnames = [os.path.abspath(f) for f in fnames]
 
-    print("Combining %d files" % len(fnames))
-
-    dummie_h = h5py.File(fnames[0], "r")
-
-    #has_geom = "geom" in list(dummie_h.keys())
-    #ngeom_params = 0
-    #if has_geom:
-    #    ngeom_params = dummie_h["geom"].shape[1]
-
-    shapes = {}
-    for key in ["images_mean", "images", "labels", "full_maximg", "geom"] + args.moreKeys:
-        try:
-            shapes[key] = dummie_h[key].shape[1:]
-        except KeyError:
-            pass
-
-    imgs_per_fname = [h5py.File(f, 'r')['labels'].shape[0] for f in fnames]
-    total_imgs = sum(imgs_per_fname)
+    if args.append:
+        if not os.path.exists(index_name(args.outname)):
+            raise OSError("No index %s. Run without --append first" % index_name(args.outname))
+        index = load_index(args.outname)
+        indexed = set(f["name"] for f in index["files"])
+        fnames = [f for f in fnames if f not in indexed]
+        print("Appending %d new files to %d indexed files" % (len(fnames), len(indexed)))
+    else:
+        print("Combining %d files" % len(fnames))
+        index = {"keys": None, "files": []}
 
-    Layouts = {}
-    for key, shape in shapes.items():
-        Layouts[key] = h5py.VirtualLayout(shape=(total_imgs,) + shape, dtype=dummie_h[key].dtype)
-
-    Sources = {}
-    records = []
-    start = 0
     for i_f, f in enumerate(fnames):
-        print("virtualizing file %d / %d" % (i_f+1, len(fnames)))
-        nimg = imgs_per_fname[i_f]
-        for key in Layouts:
-            #if key == "geom":
-            #    continue
-            vsource = h5py.VirtualSource(f, key, shape=(nimg,) + shapes[key])
-            Layouts[key][start:start+nimg] = vsource
-            Sources[(key, f)] = vsource
-
-        #if ngeom_params:
-        #    geom_source = h5py.VirtualSource(f, "geom", shape=(ngeom_params,))
-        #    for i_img in range(nimg):
-        #        Layouts["geom"][start+i_img] = geom_source
-
-        #    Sources[("geom", f)] = geom_source
-
-        start += nimg
+        print("indexing file %d / %d" % (i_f+1, len(fnames)))
+        if index["keys"] is None:
+            # the first file determines which datasets are virtualized
+            count, key_info = probe_file(f, DEFAULT_KEYS + args.moreKeys)
+            index["keys"] = key_info
+        else:
+            count, key_info = probe_file(f, list(index["keys"]))
+            check_file(f, key_info, index["keys"])
+        index["files"].append({"name": f, "count": count})
+
+    if index["keys"] is None:
+        raise OSError("No %s*h5 files found in %s" % (args.prefix, ", ".join(args.dirnames)))
 
     print("Saving it all to %s!" % args.outname) #master_name)
+    total_imgs = write_master(args.outname, index)
+    write_index(args.outname, index)
     print("Total number of shots=%d" % total_imgs)
-    with h5py.File(args.outname, "w") as H:
-        for key in Layouts:
-            vd = H.create_virtual_dataset(key, Layouts[key])
-            for attr in ["names", "pdbmap"]:
-                if attr in dummie_h[key].attrs:
-                    vd.attrs[attr] = dummie_h[key].attrs[attr]
-
-            #if key == "labels":
-            #    vd.attrs["names"] = label_names
-
     print("Done!")
 
 
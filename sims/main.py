@@ -6,10 +6,11 @@ from resonet.sims.paths_and_const import PDB_MAP
 import torch
 from resonet.utils.eval_model import to_tens
 from resonet.utils import counter_utils
+from resonet.utils import h5codecs
 from resonet.sims import paths_and_const
 
 
-def args(use_joblib=False):
+def get_parser(use_joblib=False):
     parser = ArgumentParser(formatter_class=arg_formatter)
     parser.add_argument("outdir", help="path to output folder (will be created if necessary)", type=str)
     parser.add_argument("--geom", type=str,
@@ -54,6 +55,11 @@ def args(use_joblib=False):
     parser.add_argument("--uniReso", action="store_true", help="uniformly sample resolution per shot, up to the detector maximum")
     parser.add_argument("--randQuad", action="store_true", help="randomly choose a quad to write per image")
     parser.add_argument("--compress", action="store_true", help="store compressed files")
+    parser.add_argument("--codec", type=str, choices=h5codecs.CODECS, default="gzip",
+                        help="compression codec used with --compress (all but gzip require hdf5plugin)")
+    parser.add_argument("--uint8", action="store_true", help="store images as uint8. This is lossless, as the "
+                                                             "downsampled quads are integers from 0-255 (see eval_model.to_tens). "
+                                                             "Not compatible with --centerCrop")
     parser.add_argument("--centerCrop", action="store_true", help="Alternative to quad downsampling, downsample whole image by a factor and "
                                                                   "crop around the center")
     parser.add_argument("--sanityTestOps", action="store_true", help="If True, then ensure application of operators in the SGOPS file produce the same diffraction pattern")
@@ -61,6 +67,11 @@ def args(use_joblib=False):
     parser.add_argument("--bgOnly", action="store_true", help="Only simulate background scattering")
     if use_joblib:
         parser.add_argument("--njobs", default=None, type=int, help="number of jobs")
+    return parser
+
+
+def args(use_joblib=False):
+    parser = get_parser(use_joblib)
     args = parser.parse_args()
 
     if hasattr(args, "h") or hasattr(args, "help"):
@@ -70,6 +81,416 @@ def args(use_joblib=False):
     return parser.parse_args()
 
 
+PARAM_NAMES = ["reso", "one_over_reso",
+               "radius", "one_over_radius",
+               "is_multi", "multi_lat_angle_sigma",
+               "num_lat", "bg_scale",
+               "beamstop_rad", "detdist", "wavelen",
+               "beam_center_fast", "beam_center_slow",
+               "cent_fast_train", "cent_slow_train",
+               "Na", "Nb", "Nc", "pdb", "mos_spread","xtal_scale"] \
+              + ["r%d" % x for x in range(1, 10)]
+GEOM_NAMES = ["detdist", "wavelen", "pixsize", "xdim", "ydim"]
+
+
+def get_image_dtype(args):
+    """storage type of the processed images"""
+    import numpy as np
+    if args.uint8:
+        return np.uint8
+    if args.compress:
+        return np.uint16
+    return np.float32
+
+
+def get_rot_mats(args, Nshot, gvec=None):
+    """
+    :param args: instance of the args() method in this file
+    :param Nshot: number of rotation matrices
+    :param gvec: rotation axis (only used if args.randAxis)
+    :return: list of crystal rotation matrices (length is Nshot)
+    """
+    import numpy as np
+    from scipy.spatial.transform import Rotation
+    if args.randAxis:
+        assert gvec is not None
+        angle= np.random.uniform(-180,180,Nshot)
+        rot_vecs = np.array([gvec / np.linalg.norm(gvec)]*Nshot)
+        rot_vecs *= angle[:,None]
+        rotMats = Rotation.from_rotvec(rot_vecs, degrees=True).as_matrix()
+    elif args.axisRotOnly is not None:
+        angle = np.random.uniform(-180,180,Nshot)
+        rot_vecs = np.zeros((Nshot, 3))
+        rot_vecs[:,args.axisRotOnly] = angle
+        rotMats = Rotation.from_rotvec(rot_vecs, degrees=True).as_matrix()
+    elif args.twoAxisOnly is not None:
+        angle = np.random.uniform(-180,180, Nshot)
+        gvecs = np.random.normal(0,1,(Nshot, 2))
+        uvecs = gvecs / np.linalg.norm(gvecs, axis=1)[:,None]
+        #rot_vecs = uvecs*angle
+        rot_vecs = np.zeros((Nshot, 3))
+        if args.twoAxisOnly==0: # "xy"
+            rot_vecs[:,[0,1]] = uvecs
+        elif args.twoAxisOnly==1: # xz
+            rot_vecs[:,[0,2]] = uvecs
+        else:  # yz
+            rot_vecs[:,[1,2]] = uvecs
+        rot_vecs *= angle[:,None]
+        rotMats = Rotation.from_rotvec(rot_vecs, degrees=True).as_matrix()
+    else:
+        rotMats = Rotation.random(Nshot).as_matrix()
+    return rotMats
+
+
+class ShotMaker:
+
+    def __init__(self, args, jid):
+        """
+        Loads the geometry and masks, and instantiates the simulator. Each call to make_shot simulates one shot
+        and applies the post-processing (masks, beamstop, hot/bad pixels, downsampling).
+        Used by run (below) to write rank*.h5 files, and by resonet.sims.stream to train on the fly.
+
+        :param args: instance of the args() method in this file
+        :param jid: job ID
+        """
+        import os
+        import numpy as np
+        import dxtbx
+        from simtbx.diffBragg import utils
+        from scipy.ndimage import binary_dilation
+
+        from resonet.sims.simulator import Simulator
+
+        if args.uint8 and args.centerCrop:
+            raise ValueError("--uint8 requires quad downsampling (centerCrop images are not integers in 0-255)")
+        self.args = args
+        self.jid = jid
+
+        maskfiles = []
+        if args.maskFileList is not None:
+            maskfiles = open(args.maskFileList, "r").readlines()
+            maskfiles = [l.strip() for l in maskfiles]
+            for m in maskfiles:
+                if not os.path.exists(m):
+                    raise OSError("Not all maskfiles in the maskFileList exist, or the file couldnt be parsed. "
+                                  "There should be 1 filename per line.")
+            if jid==0:
+                print("Found %d maskfiles" %len(maskfiles))
+        self.maskfiles = maskfiles
+
+        # load the geometry from provided image file
+        if args.geom is None:
+            from resonet.sims.mosflm_geom import DET,BEAM
+            # get the detector dimensions (used to determine detector model below)
+            xdim, ydim = DET[0].get_image_size()
+            mask = np.ones((ydim, xdim), bool)
+        else:
+            loader = dxtbx.load(args.geom)
+            DET = loader.get_detector()
+            BEAM = loader.get_beam()
+            if args.expt is not None:
+                from dxtbx.model import ExperimentList
+                El = ExperimentList.from_file(args.expt, False)
+                DET = El[0].detector
+                BEAM = El[0].beam
+
+            # remove the sensor thickness portion of the geometry
+            DET = utils.set_detector_thickness(DET)
+
+            # get the detector dimensions (used to determine detector model below)
+            xdim,ydim = DET[0].get_image_size()
+            # which pixel do not contain data
+            mask = loader.get_raw_data().as_numpy_array() >= 0
+            mask = ~binary_dilation(~mask, iterations=2)
+            if args.mask is not None:
+                mask = np.load(args.mask)
+                assert len(mask.shape) == 2
+        self.DET, self.BEAM = DET, BEAM
+        self.xdim, self.ydim = xdim, ydim
+        self.mask = mask
+
+        # Load the ice d spacings for doing ice masking later
+        #unit_cell = uctbx.unit_cell((4.498, 4.498, 7.338, 90, 90, 120))
+        #space_group = sgtbx.space_group_info(number=194).group()
+        #indices = index_generator(unit_cell, space_group.type(), False, 1).to_array()
+        #dsd = unit_cell.d_star_sq(indices)
+        #ice_d = sorted(1 / np.sqrt(dsd.as_numpy_array()))
+        from resonet.utils.ice_mask import IceMasker
+        geom_dict = {"detector":DET, "beam":BEAM}
+        self.ice_masker = IceMasker(dxtbx_geom_dict=geom_dict)
+
+        # TODO: check whether factor is meant to be replaced totally by quad_ds_fact, and adjust rest of code accordingly
+        # process the raw images according to detector model
+        if xdim == 2463:  # Pilatus 6M
+            quad_ds_fact = 2
+            center_ds_fact = 3
+        elif xdim == 3840:
+            quad_ds_fact = 3
+            center_ds_fact = 4
+        elif xdim == 4096:  # Mar
+            quad_ds_fact = 4
+            center_ds_fact = 5
+        else:  # Eiger
+            quad_ds_fact = 4
+            center_ds_fact = 5
+        self.quad_ds_fact = quad_ds_fact
+        self.center_ds_fact = center_ds_fact
+        self.cropdim = min(xdim, ydim) // center_ds_fact - 1
+        # make an image whose pixel value corresonds to the radius from the center.
+        # and this will be used to create on-the-fly beamstop masks of varying radius
+        self.Y, self.X = np.indices((ydim, xdim))
+
+        # instantiate the simulator class
+        self.HS = Simulator(DET, BEAM, cuda=not args.cpuMode,
+                            verbose=args.verbose and jid==0)
+
+        self.HS.bg_only = args.bgOnly
+        # sample-to-detector distance and pixel size
+        #detdist = abs(DET[0].get_distance())
+        self.pixsize = DET[0].get_pixel_size()[0]
+        #wavelen = BEAM.get_wavelength()
+
+        # GPU device Id for this rank
+        self.dev = jid % args.ngpu
+
+        self.ds_shape = 512,512
+        if args.centerCrop:
+            self.ds_shape = self.cropdim, self.cropdim
+
+        # random generators
+        self.random_dist = self.random_wave = None
+        if args.randDist:
+            if args.randDistChoice is not None:
+                self.random_dist = lambda: np.random.choice(args.randDistChoice)
+            else:
+                d1,d2 = args.randDistRange
+                assert d1 < d2
+                self.random_dist = lambda: np.random.uniform(d1,d2)
+        if args.randWave:
+            en1, en2 = args.randWaveRange
+            assert en1 < en2
+            self.random_wave = lambda: np.random.uniform(en1, en2)
+
+    def make_shot(self, rot_mat, cbf_name=None):
+        """
+        :param rot_mat: crystal rotation matrix
+        :param cbf_name: optionally write the raw simulated image to this file
+        :return: downsampled image (numpy array of shape ds_shape and type get_image_dtype(args)),
+            labels (list, see PARAM_NAMES), and geometry (list, see GEOM_NAMES)
+        """
+        import os
+        import numpy as np
+        from resonet.sims.simulator import reso2radius
+
+        args = self.args
+        HS = self.HS
+        xdim, ydim = self.xdim, self.ydim
+        pixsize = self.pixsize
+        quad_ds_fact, center_ds_fact, cropdim = self.quad_ds_fact, self.center_ds_fact, self.cropdim
+        params, spots, img, shot_det, shot_beam = HS.simulate(rot_mat=rot_mat,
+                                  multi_lattice_chance=args.multiChance,
+                                  mos_min_max=args.mosMinMax,
+                                  max_lat=args.maxLat,
+                                  dev=self.dev, mos_dom_override=args.nmos,
+                                  vary_background_scale=args.varyBgScale,
+                                  pdb_name=args.pdbName,
+                                  randomize_dist=self.random_dist,
+                                  randomize_center=args.randCent,
+                                  randomize_wavelen=self.random_wave,
+                                  randomize_scale=args.randScale,
+                                  low_bg_chance=args.lowBgChance,
+                                  uniform_reso=args.uniReso,
+                                  cbf_name=cbf_name)
+        is_ice_ring = None
+        if args.iceMaskChance > np.random.random():
+            distance = shot_det[0].get_distance()
+            wavelen = shot_beam.get_wavelength()
+            beam_x, beam_y = shot_det[0].get_beam_centre_px(shot_beam.get_unit_s0())
+            is_ice_ring = self.ice_masker.mask(distance=distance, wavelength=wavelen,
+                                               beam_x=beam_x, beam_y=beam_y)[0]
+
+        if args.sanityTestOps:
+            pdb_name = params['pdb_name']
+            pdb_id = os.path.basename(pdb_name)
+            OPS = np.load(paths_and_const.SGOP_FILE, allow_pickle=True)[()][pdb_id]
+            print(pdb_id)
+            assert paths_and_const.FIX_RES
+
+            for i_op, U_o in enumerate(OPS):
+                rot2 = np.dot(rot_mat, np.reshape(U_o, (3,3)))
+                print("Doing op %d / %d" %(i_op+1, len(OPS)))
+                print(U_o)
+                params2, spots2, img2, _, _ = HS.simulate(rot_mat=rot2,
+                                                 multi_lattice_chance=args.multiChance,
+                                                 mos_min_max=args.mosMinMax,
+                                                 max_lat=args.maxLat,
+                                                 dev=self.dev, mos_dom_override=args.nmos,
+                                                 vary_background_scale=args.varyBgScale,
+                                                 pdb_name=pdb_name,
+                                                 randomize_dist=self.random_dist,
+                                                 randomize_center=args.randCent,
+                                                 randomize_wavelen=self.random_wave,
+                                                 randomize_scale=args.randScale,
+                                                 low_bg_chance=args.lowBgChance,
+                                                 uniform_reso=args.uniReso)
+                assert np.allclose(spots, spots2)
+            exit()
+
+        # at what pixel radius does this resolution corresond to
+        radius = reso2radius(params["reso"], self.DET, self.BEAM)
+
+        cent_x, cent_y = params["beam_center"]
+
+        # load a mask for this shot
+        if self.maskfiles:
+            # choose a random mask for this shot
+            maskname = np.random.choice(self.maskfiles)
+            shot_mask = np.load(maskname)
+            if self.jid == 0:
+                print("Loading mask %s" % maskname)
+        else:
+            shot_mask = self.mask.copy()
+        # add optional beamstop mask:
+        beamstop_rad=-1
+        if args.beamStop:
+            # assume beamstop can vary in radius from 0 to 15 mm
+            beamstop_rad_mm = np.random.choice(np.arange(0,15.1,0.375))
+            beamstop_rad = int(beamstop_rad_mm/pixsize)
+
+            # jitter the beamstop center by 0.5 mm
+            bs_jitt = .5/pixsize
+            bs_cent_x = np.random.uniform(cent_x-bs_jitt, cent_x+bs_jitt)
+            bs_cent_y = np.random.uniform(cent_y-bs_jitt, cent_y+bs_jitt)
+            pixR = np.sqrt((self.X - bs_cent_x) ** 2 + (self.Y - bs_cent_y) ** 2)
+            is_in_beamstop = pixR < beamstop_rad
+            if args.verbose:
+                print("beamstop rad=%.1f" % beamstop_rad)
+            shot_mask = np.logical_and(shot_mask, ~is_in_beamstop)
+
+        # optionally add ice mask
+        if is_ice_ring is not None:
+            shot_mask = np.logical_and(shot_mask, ~is_ice_ring)
+
+        # add hot pixels
+        npix = img.size
+        if args.addHot:
+            nhot = np.random.randint(0, 6)
+            hot_inds = np.random.permutation(npix)[:nhot]
+
+            img_1d = img.ravel()
+            img_1d[hot_inds] = 2**16
+            img = img_1d.reshape(img.shape)
+            img *= shot_mask
+
+        # add bad pixels
+        if args.addBad:
+            min_npix = int(0.01 * xdim)
+            max_npix = 3*min_npix
+            nbad = np.random.randint(min_npix, max_npix)
+            bad_inds = np.random.permutation(npix)[:nbad]
+
+            img_1d = img.ravel()
+            img_1d[bad_inds] = 0
+            img = img_1d.reshape(img.shape)
+            img *= shot_mask
+
+        if paths_and_const.LAUE_MODE:
+            ave_pool = counter_utils.mx_gamma(stride=center_ds_fact, use_mean=True)
+            ds_wavelen = counter_utils.process_image(params['wavelen_data'],
+                                                     ave_pool, useSqrt=False)[0]
+
+        if paths_and_const.PEAK_MODE:
+            img = spots > np.percentile(spots,99.99)
+
+        if args.centerCrop:
+            max_pool = counter_utils.mx_gamma(stride=center_ds_fact, dim=cropdim)
+            ds_img = counter_utils.process_image(img, max_pool, useSqrt=True)[0]
+            dx = xdim *.5 / center_ds_fact - cropdim*.5
+            dy = ydim *.5 / center_ds_fact - cropdim*.5
+            cent_x_train = cent_x / center_ds_fact - dx
+            cent_y_train = cent_y / center_ds_fact - dy
+        else:
+            max_pool = torch.nn.MaxPool2d(quad_ds_fact, quad_ds_fact)
+            q = 'A'
+            if args.randQuad:
+                q = np.random.choice(["A", "B", "C", "D"])
+            ds_img = to_tens(img, shot_mask, maxpool=max_pool, ds_fact=quad_ds_fact, quad=q)
+            # TODO update cent_x_train, cent_y_train
+            cent_x_train = (cent_x - xdim*.5)/quad_ds_fact #factor
+            cent_y_train = (cent_y - ydim*.5)/quad_ds_fact #factor
+
+        # convert cent_x, cent_y to downsampled version
+        Na, Nb, Nc = params["Ncells_abc"]
+        #r1,r2,r3,r4,r5,r6,r7,r8,r9 = params["Umat"]
+        r1,r2,r3,r4,r5,r6,r7,r8,r9 = np.ravel(rot_mat)
+        param_arr = [params["reso"], 1/params["reso"],
+             radius/quad_ds_fact, quad_ds_fact/radius, # TODO update depending on args.centerCrop?
+             params["multi_lattice"],
+             params["ang_sigma"],
+             params["num_lat"],
+             params["bg_scale"],
+             beamstop_rad,
+             params["detector_distance"],
+             params["wavelength"],
+             cent_x, cent_y,
+             cent_x_train, cent_y_train,
+             Na, Nb, Nc,
+             PDB_MAP[params["pdb_name"]],
+             params["mos_spread"],
+             params["crystal_scale"],
+             r1,r2,r3,r4,r5,r6,r7,r8,r9]
+        geom_array = [params["detector_distance"],
+                         params["wavelength"],
+                         pixsize,
+                         xdim, ydim]
+
+        if args.uint8:
+            # to_tens clips at 255**2 before the sqrt and floor, so this cast is exact
+            ds_img = ds_img.numpy().astype(np.uint8)
+        elif args.compress:
+            IMAX=np.sqrt(65535)
+            ds_img[ds_img > IMAX] = IMAX
+            ds_img = ds_img.numpy().astype(np.uint16)
+        else:
+            ds_img = ds_img.numpy().astype(np.float32, copy=False)
+        ds_img = ds_img.reshape(self.ds_shape)
+        return ds_img, param_arr, geom_array
+
+
+def create_datasets(out, Nshot, ds_shape, args, mask=None):
+    """
+    :param out: h5py File opened for writing
+    :param Nshot: number of shots. If None, the datasets start empty and are resizable along the first axis
+    :param ds_shape: shape of the processed images
+    :param args: instance of the args() method in this file
+    :param mask: optional nominal mask to store
+    :return: images, labels and geom h5py datasets
+    """
+    import numpy as np
+
+    def shape_args(item_shape):
+        if Nshot is None:
+            return {"shape": (0,) + item_shape, "maxshape": (None,) + item_shape}
+        return {"shape": (Nshot,) + item_shape}
+
+    if mask is not None:
+        out.create_dataset("nominal_mask", data=mask)
+    comp_args = {"dtype": get_image_dtype(args)}
+    if args.compress:
+        comp_args.update(h5codecs.get_comp_args(args.codec))
+    dset = out.create_dataset("images",
+                              chunks = (1,)+ds_shape,
+                              **shape_args(ds_shape), **comp_args)
+
+    comp_args.pop("dtype")
+    lab_dset = out.create_dataset("labels", dtype=np.float32, **shape_args((len(PARAM_NAMES),)), **comp_args)
+    geom_dset = out.create_dataset("geom", dtype=np.float32, **shape_args((len(GEOM_NAMES),)), **comp_args)
+    lab_dset.attrs["names"] = PARAM_NAMES
+    lab_dset.attrs["pdbmap"] = list(PDB_MAP)
+    geom_dset.attrs["names"] = GEOM_NAMES
+    return dset, lab_dset, geom_dset
+
+
 def run(args, seeds, jid, njobs, gvec=None):
     """
 
@@ -82,96 +503,9 @@ def run(args, seeds, jid, njobs, gvec=None):
     import time
     import h5py
     import numpy as np
-    import dxtbx
-    from simtbx.diffBragg import utils
-    from scipy.spatial.transform import Rotation
-    from scipy.ndimage import binary_dilation
-
-    from resonet.sims.simulator import Simulator, reso2radius
 
     np.random.seed(seeds[jid])
-
-    maskfiles = []
-    if args.maskFileList is not None:
-        maskfiles = open(args.maskFileList, "r").readlines()
-        maskfiles = [l.strip() for l in maskfiles]
-        for m in maskfiles:
-            if not os.path.exists(m):
-                raise OSError("Not all maskfiles in the maskFileList exist, or the file couldnt be parsed. "
-                              "There should be 1 filename per line.")
-        if jid==0:
-            print("Found %d maskfiles" %len(maskfiles))
-
-    # load the geometry from provided image file
-    if args.geom is None:
-        from resonet.sims.mosflm_geom import DET,BEAM
-        # get the detector dimensions (used to determine detector model below)
-        xdim, ydim = DET[0].get_image_size()
-        mask = np.ones((ydim, xdim), bool)
-    else:
-        loader = dxtbx.load(args.geom)
-        DET = loader.get_detector()
-        BEAM = loader.get_beam()
-        if args.expt is not None:
-            from dxtbx.model import ExperimentList
-            El = ExperimentList.from_file(args.expt, False)
-            DET = El[0].detector
-            BEAM = El[0].beam
-
-        # remove the sensor thickness portion of the geometry
-        DET = utils.set_detector_thickness(DET)
-
-        # get the detector dimensions (used to determine detector model below)
-        xdim,ydim = DET[0].get_image_size()
-        # which pixel do not contain data
-        mask = loader.get_raw_data().as_numpy_array() >= 0
-        mask = ~binary_dilation(~mask, iterations=2)
-        if args.mask is not None:
-            mask = np.load(args.mask)
-            assert len(mask.shape) == 2
-
-    # Load the ice d spacings for doing ice masking later
-    #unit_cell = uctbx.unit_cell((4.498, 4.498, 7.338, 90, 90, 120))
-    #space_group = sgtbx.space_group_info(number=194).group()
-    #indices = index_generator(unit_cell, space_group.type(), False, 1).to_array()
-    #dsd = unit_cell.d_star_sq(indices)
-    #ice_d = sorted(1 / np.sqrt(dsd.as_numpy_array()))
-    from resonet.utils.ice_mask import IceMasker
-    geom_dict = {"detector":DET, "beam":BEAM}
-    ice_masker = IceMasker(dxtbx_geom_dict=geom_dict)
-
-    # TODO: check whether factor is meant to be replaced totally by quad_ds_fact, and adjust rest of code accordingly
-    # process the raw images according to detector model
-    if xdim == 2463:  # Pilatus 6M
-        quad_ds_fact = 2
-        center_ds_fact = 3
-    elif xdim == 3840:
-        quad_ds_fact = 3
-        center_ds_fact = 4
-    elif xdim == 4096:  # Mar
-        quad_ds_fact = 4
-        center_ds_fact = 5
-    else:  # Eiger
-        quad_ds_fact = 4
-        center_ds_fact = 5
-    cropdim = min(xdim, ydim) // center_ds_fact - 1
-    factor = 2 if xdim == 2463 else 4
-    # make an image whose pixel value corresonds to the radius from the center.
-    # and this will be used to create on-the-fly beamstop masks of varying radius
-    Y,X = np.indices((ydim, xdim))
-
-    # instantiate the simulator class
-    HS = Simulator(DET, BEAM, cuda=not args.cpuMode,
-                   verbose=args.verbose and jid==0)
-
-    HS.bg_only = args.bgOnly
-    # sample-to-detector distance and pixel size
-    #detdist = abs(DET[0].get_distance())
-    pixsize = DET[0].get_pixel_size()[0]
-    #wavelen = BEAM.get_wavelength()
-
-    # GPU device Id for this rank
-    dev = jid % args.ngpu
+    maker = ShotMaker(args, jid)
 
     #  how many shots will this rank simulate
     Nshot = len(np.array_split(np.arange(args.nshot), njobs)[jid])
@@ -188,23 +522,7 @@ def run(args, seeds, jid, njobs, gvec=None):
             o.write("Python command: " + " ".join(sys.argv) + "\n")
 
     with h5py.File(outname, "w") as out:
-        out.create_dataset("nominal_mask", data=mask)
-        ds_shape = 512,512
-        if args.centerCrop:
-            ds_shape = cropdim, cropdim
-        comp_args = {"dtype": np.float32}
-
-        if args.compress:
-            comp_args["compression_opts"] = 4
-            comp_args["compression"] = "gzip"
-            comp_args["shuffle"] = True
-            comp_args["dtype"] = np.uint16
-        dset = out.create_dataset("images",
-                                  shape=(Nshot,) + ds_shape,
-                                  chunks = (1,)+ds_shape,
-                                  **comp_args)
-
-        comp_args.pop("dtype")
+        dset, lab_dset, geom_dset = create_datasets(out, Nshot, maker.ds_shape, args, mask=maker.mask)
         cbf_names = []
 
         #if args.saveRaw:
@@ -212,65 +530,10 @@ def run(args, seeds, jid, njobs, gvec=None):
         #                                  shape=(Nshot,) + (1,ydim, xdim),
         #                                  dtype=np.float32, **comp_args)
 
-        param_names = ["reso", "one_over_reso",
-                       "radius", "one_over_radius",
-                       "is_multi", "multi_lat_angle_sigma",
-                       "num_lat", "bg_scale",
-                       "beamstop_rad", "detdist", "wavelen",
-                       "beam_center_fast", "beam_center_slow",
-                       "cent_fast_train", "cent_slow_train",
-                       "Na", "Nb", "Nc", "pdb", "mos_spread","xtal_scale"] \
-                      + ["r%d" % x for x in range(1, 10)]
-        geom_names = ["detdist", "wavelen", "pixsize", "xdim", "ydim"]
-        lab_dset = out.create_dataset("labels", dtype=np.float32, shape=(Nshot, len(param_names)) , **comp_args)
-        geom_dset = out.create_dataset("geom", dtype=np.float32, shape=(Nshot, len(geom_names)), **comp_args)
-        lab_dset.attrs["names"] = param_names
-        lab_dset.attrs["pdbmap"] = list(PDB_MAP)
-        geom_dset.attrs["names"] = geom_names
-
         # list of rotation matrices (length is Nshot)
-        if args.randAxis:
-            assert gvec is not None
-            angle= np.random.uniform(-180,180,Nshot)
-            rot_vecs = np.array([gvec / np.linalg.norm(gvec)]*Nshot)
-            rot_vecs *= angle[:,None]
-            rotMats = Rotation.from_rotvec(rot_vecs, degrees=True).as_matrix()
-        elif args.axisRotOnly is not None:
-            angle = np.random.uniform(-180,180,Nshot)
-            rot_vecs = np.zeros((Nshot, 3))
-            rot_vecs[:,args.axisRotOnly] = angle
-            rotMats = Rotation.from_rotvec(rot_vecs, degrees=True).as_matrix()
-        elif args.twoAxisOnly is not None:
-            angle = np.random.uniform(-180,180, Nshot)
-            gvecs = np.random.normal(0,1,(Nshot, 2))
-            uvecs = gvecs / np.linalg.norm(gvecs, axis=1)[:,None]
-            #rot_vecs = uvecs*angle
-            rot_vecs = np.zeros((Nshot, 3))
-            if args.twoAxisOnly==0: # "xy"
-                rot_vecs[:,[0,1]] = uvecs
-            elif args.twoAxisOnly==1: # xz
-                rot_vecs[:,[0,2]] = uvecs
-            else:  # yz
-                rot_vecs[:,[1,2]] = uvecs
-            rot_vecs *= angle[:,None]
-            rotMats = Rotation.from_rotvec(rot_vecs, degrees=True).as_matrix()
-        else:
-            rotMats = Rotation.random(Nshot).as_matrix()
+        rotMats = get_rot_mats(args, Nshot, gvec)
         times = []  # store processing times per shot
 
-        # random generators
-        random_dist = random_wave = None
-        if args.randDist:
-            if args.randDistChoice is not None:
-                random_dist = lambda: np.random.choice(args.randDistChoice)
-            else:
-                d1,d2 = args.randDistRange
-                assert d1 < d2
-                random_dist = lambda: np.random.uniform(d1,d2)
-        if args.randWave:
-            en1, en2 = args.randWaveRange
-            assert en1 < en2
-            random_wave = lambda: np.random.uniform(en1, en2)
         for i_shot in range(Nshot):
             t = time.time()
             cbf_name = None
@@ -281,170 +544,10 @@ def run(args, seeds, jid, njobs, gvec=None):
                 cbf_name = os.path.join(cbf_dir, "shot_1_%05d.cbf" % i_shot)
                 cbf_names.append(os.path.abspath(cbf_name))
 
-            params, spots, img, shot_det, shot_beam = HS.simulate(rot_mat=rotMats[i_shot],
-                                      multi_lattice_chance=args.multiChance,
-                                      mos_min_max=args.mosMinMax,
-                                      max_lat=args.maxLat,
-                                      dev=dev, mos_dom_override=args.nmos,
-                                      vary_background_scale=args.varyBgScale,
-                                      pdb_name=args.pdbName,
-                                      randomize_dist=random_dist,
-                                      randomize_center=args.randCent,
-                                      randomize_wavelen=random_wave,
-                                      randomize_scale=args.randScale,
-                                      low_bg_chance=args.lowBgChance,
-                                      uniform_reso=args.uniReso,
-                                      cbf_name=cbf_name)
-            is_ice_ring = None
-            if args.iceMaskChance > np.random.random():
-                distance = shot_det[0].get_distance()
-                wavelen = shot_beam.get_wavelength()
-                beam_x, beam_y = shot_det[0].get_beam_centre_px(shot_beam.get_unit_s0())
-                is_ice_ring = ice_masker.mask(distance=distance, wavelength=wavelen,
-                                              beam_x=beam_x, beam_y=beam_y)[0]
-
-            if args.sanityTestOps:
-                pdb_name = params['pdb_name']
-                pdb_id = os.path.basename(pdb_name)
-                OPS = np.load(paths_and_const.SGOP_FILE, allow_pickle=True)[()][pdb_id]
-                print(pdb_id)
-                assert paths_and_const.FIX_RES
-
-                for i_op, U_o in enumerate(OPS):
-                    rot2 = np.dot(rotMats[i_shot], np.reshape(U_o, (3,3)))
-                    print("Doing op %d / %d" %(i_op+1, len(OPS)))
-                    print(U_o)
-                    params2, spots2, img2, _, _ = HS.simulate(rot_mat=rot2,
-                                                     multi_lattice_chance=args.multiChance,
-                                                     mos_min_max=args.mosMinMax,
-                                                     max_lat=args.maxLat,
-                                                     dev=dev, mos_dom_override=args.nmos,
-                                                     vary_background_scale=args.varyBgScale,
-                                                     pdb_name=pdb_name,
-                                                     randomize_dist=random_dist,
-                                                     randomize_center=args.randCent,
-                                                     randomize_wavelen=random_wave,
-                                                     randomize_scale=args.randScale,
-                                                     low_bg_chance=args.lowBgChance,
-                                                     uniform_reso=args.uniReso)
-                    assert np.allclose(spots, spots2)
-                exit()
-
-            # at what pixel radius does this resolution corresond to
-            radius = reso2radius(params["reso"], DET, BEAM)
-
-            cent_x, cent_y = params["beam_center"]
-
-            # load a mask for this shot
-            if maskfiles:
-                # choose a random mask for this shot
-                maskname = np.random.choice(maskfiles)
-                shot_mask = np.load(maskname)
-                if jid == 0:
-                    print("Loading mask %s" % maskname)
-            else:
-                shot_mask = mask.copy()
-            # add optional beamstop mask:
-            beamstop_rad=-1
-            if args.beamStop:
-                # assume beamstop can vary in radius from 0 to 15 mm
-                beamstop_rad_mm = np.random.choice(np.arange(0,15.1,0.375))
-                beamstop_rad = int(beamstop_rad_mm/pixsize)
-
-                # jitter the beamstop center by 0.5 mm
-                bs_jitt = .5/pixsize
-                bs_cent_x = np.random.uniform(cent_x-bs_jitt, cent_x+bs_jitt)
-                bs_cent_y = np.random.uniform(cent_y-bs_jitt, cent_y+bs_jitt)
-                pixR = np.sqrt((X - bs_cent_x) ** 2 + (Y - bs_cent_y) ** 2)
-                is_in_beamstop = pixR < beamstop_rad
-                if args.verbose:
-                    print("beamstop rad=%.1f" % beamstop_rad)
-                shot_mask = np.logical_and(shot_mask, ~is_in_beamstop)
-
-            # optionally add ice mask
-            if is_ice_ring is not None:
-                shot_mask = np.logical_and(shot_mask, ~is_ice_ring)
-
-            # add hot pixels
-            npix = img.size
-            if args.addHot:
-                nhot = np.random.randint(0, 6)
-                hot_inds = np.random.permutation(npix)[:nhot]
-
-                img_1d = img.ravel()
-                img_1d[hot_inds] = 2**16
-                img = img_1d.reshape(img.shape)
-                img *= shot_mask
-
-            # add bad pixels
-            if args.addBad:
-                min_npix = int(0.01 * xdim)
-                max_npix = 3*min_npix
-                nbad = np.random.randint(min_npix, max_npix)
-                bad_inds = np.random.permutation(npix)[:nbad]
-
-                img_1d = img.ravel()
-                img_1d[bad_inds] = 0
-                img = img_1d.reshape(img.shape)
-                img *= shot_mask
-
-            if paths_and_const.LAUE_MODE:
-                ave_pool = counter_utils.mx_gamma(stride=center_ds_fact, use_mean=True)
-                ds_wavelen = counter_utils.process_image(params['wavelen_data'],
-                                                         ave_pool, useSqrt=False)[0]
-
-            if paths_and_const.PEAK_MODE:
-                img = spots > np.percentile(spots,99.99)
-
-            if args.centerCrop:
-                max_pool = counter_utils.mx_gamma(stride=center_ds_fact, dim=cropdim)
-                ds_img = counter_utils.process_image(img, max_pool, useSqrt=True)[0]
-                dx = xdim *.5 / center_ds_fact - cropdim*.5
-                dy = ydim *.5 / center_ds_fact - cropdim*.5
-                cent_x_train = cent_x / center_ds_fact - dx
-                cent_y_train = cent_y / center_ds_fact - dy
-            else:
-                max_pool = torch.nn.MaxPool2d(quad_ds_fact, quad_ds_fact)
-                q = 'A'
-                if args.randQuad:
-                    q = np.random.choice(["A", "B", "C", "D"])
-                ds_img = to_tens(img, shot_mask, maxpool=max_pool, ds_fact=quad_ds_fact, quad=q)
-                # TODO update cent_x_train, cent_y_train
-                cent_x_train = (cent_x - xdim*.5)/quad_ds_fact #factor
-                cent_y_train = (cent_y - ydim*.5)/quad_ds_fact #factor
-
-            # convert cent_x, cent_y to downsampled version
-            Na, Nb, Nc = params["Ncells_abc"]
-            #r1,r2,r3,r4,r5,r6,r7,r8,r9 = params["Umat"]
-            r1,r2,r3,r4,r5,r6,r7,r8,r9 = rotMats[i_shot].ravel()
-            param_arr = [params["reso"], 1/params["reso"],
-                 radius/quad_ds_fact, quad_ds_fact/radius, # TODO update depending on args.centerCrop?
-                 params["multi_lattice"],
-                 params["ang_sigma"],
-                 params["num_lat"],
-                 params["bg_scale"],
-                 beamstop_rad,
-                 params["detector_distance"],
-                 params["wavelength"],
-                 cent_x, cent_y,
-                 cent_x_train, cent_y_train,
-                 Na, Nb, Nc, 
-                 PDB_MAP[params["pdb_name"]],
-                 params["mos_spread"],
-                 params["crystal_scale"],
-                 r1,r2,r3,r4,r5,r6,r7,r8,r9]
-            geom_array = [params["detector_distance"],
-                             params["wavelength"],
-                             pixsize,
-                             xdim, ydim]
+            ds_img, param_arr, geom_array = maker.make_shot(rotMats[i_shot], cbf_name=cbf_name)
 
             #if args.saveRaw:
             #    raw_dset[i_shot] = img[None]
-            if args.compress:
-                IMAX=np.sqrt(65535)
-                ds_img[ds_img > IMAX] = IMAX
-                ds_img = ds_img.numpy().astype(np.uint16)
-
             dset[i_shot] =ds_img
             geom_dset[i_shot] = geom_array
             lab_dset[i_shot] = param_arr
@@ -0,0 +1,190 @@
+"""
+Train directly from live simulations, without writing and merging rank*.h5 files first.
+Producer processes run sims/main.py's ShotMaker (same post-processing as main.run) and feed a bounded queue,
+so simulation overlaps with training. Optionally, each producer also writes its shots to disk (a tee),
+in the rank*.h5 format that merge_h5s.py reads.
+
+Example: python net.py 100 master.h5 out --streamSims "--cpuMode --nmos 10 --beamStop" --streamProducers 8
+"""
+
+import os
+import contextlib
+import queue
+import shlex
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import h5py
+from torch.utils.data import IterableDataset
+
+from resonet.sims import main as sim_main
+from resonet.loaders import H5SimDataDset
+
+
+def parse_sim_args(sim_args):
+    """
+    :param sim_args: string of sims/main.py command line arguments (without the output folder)
+    :return: parsed arguments, as returned by sims.main.args()
+    """
+    return sim_main.get_parser().parse_args(["."] + shlex.split(sim_args))
+
+
+def simulate_forever(sim_args, jid, gvec=None):
+    """
+    yields processed shots (image, labels, geom) from the simulator, see sims.main.ShotMaker
+    :param sim_args: parsed sims/main.py arguments
+    :param jid: producer ID (selects the GPU, as in main.run)
+    :param gvec: rotation axis, if sim_args.randAxis
+    """
+    device = contextlib.nullcontext()
+    if not sim_args.cpuMode:
+        from simtbx.diffBragg.device import DeviceWrapper
+        device = DeviceWrapper(jid % sim_args.ngpu)
+    with device:
+        maker = sim_main.ShotMaker(sim_args, jid)
+        while True:
+            yield maker.make_shot(sim_main.get_rot_mats(sim_args, 1, gvec)[0])
+
+
+def _producer_main(producer, sim_args, jid, seed, gvec, out_queue, stop, tee_name, flush_every=32):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    tee = dsets = None
+    nshot = 0
+    try:
+        for img, labels, geom in producer(sim_args, jid, gvec):
+            if tee_name is not None:
+                if tee is None:
+                    tee = h5py.File(tee_name, "w")
+                    dsets = sim_main.create_datasets(tee, None, img.shape, sim_args)
+                for dset, val in zip(dsets, (img, labels, geom)):
+                    dset.resize(nshot+1, axis=0)
+                    dset[nshot] = val
+                nshot += 1
+                if nshot % flush_every == 0:
+                    tee.flush()
+            item = img, np.array(labels, np.float32), np.array(geom, np.float32)
+            # dont block forever on a full queue, so producers can be stopped
+            while not stop.is_set():
+                try:
+                    out_queue.put(item, timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                break
+    finally:
+        if tee is not None:
+            tee.close()
+
+
+class SimStreamDset(IterableDataset):
+
+    def __init__(self, sim_args, num_shots, num_producers=1, queue_size=64, seed=None, jid_offset=0,
+                 tee_dir=None, label_sel=None, use_geom=False, half_precision=False, producer=None):
+        """
+        Iterable dataset of simulated shots, produced on the fly by `num_producers` processes.
+        Each pass over the dataset (an epoch) yields `num_shots` new shots, as CPU tensors in the same
+        format as H5SimDataDset with cpu_tensors=True (use with DataLoader num_workers=0 and batch_to_dev).
+
+        :param sim_args: parsed sims/main.py arguments (see parse_sim_args)
+        :param num_shots: number of shots per epoch
+        :param num_producers: number of simulation processes
+        :param queue_size: maximum number of shots waiting in the queue
+        :param seed: random seed of the first producer (producer j uses seed+jid_offset+j). Default uses the time
+        :param jid_offset: producer IDs start here (e.g. rank*num_producers, so ranks dont repeat shots)
+        :param tee_dir: optionally write every shot to tee_dir/rank{jid}.h5 (can be merged with merge_h5s.py)
+        :param label_sel: names or indices of the labels (see sims.main.PARAM_NAMES)
+        :param use_geom: also yield the geometry, ordered like H5SimDataDset
+        :param half_precision: yield float16 labels and images (uint8 images stay uint8)
+        :param producer: function(sim_args, jid, gvec) returning an iterator of (image, labels, geom),
+            default is simulate_forever
+        """
+        if label_sel is None:
+            label_sel = [0]
+        elif all([isinstance(l, str) for l in label_sel]):
+            label_sel = [sim_main.PARAM_NAMES.index(name) for name in label_sel]
+        self.label_sel = label_sel
+        self.nlab = len(label_sel)
+        self.geom_inds = H5SimDataDset._geom_inds(sim_main.GEOM_NAMES, len(sim_main.GEOM_NAMES))
+        self.use_geom = use_geom
+        self.half_precision = half_precision
+        self.sim_args = sim_args
+        self.num_shots = num_shots
+        self.num_producers = num_producers
+        self.queue_size = queue_size
+        self.seed = int(time.time()) if seed is None else seed
+        self.jid_offset = jid_offset
+        self.tee_dir = tee_dir
+        self.producer = simulate_forever if producer is None else producer
+        self.gvec = None
+        if getattr(sim_args, "randAxis", False):
+            self.gvec = np.random.default_rng(self.seed).normal(0, 1, 3)
+        self.procs = []
+        self.queue = self.stop = None
+        self.wait_time = 0  # seconds spent waiting on the producers
+
+    def start(self):
+        """start the producer processes (done automatically on the first iteration)"""
+        if self.procs:
+            return
+        if self.tee_dir is not None and not os.path.exists(self.tee_dir):
+            os.makedirs(self.tee_dir)
+        # spawn, as producers may use CUDA
+        ctx = mp.get_context("spawn")
+        self.queue = ctx.Queue(self.queue_size)
+        self.stop = ctx.Event()
+        for j in range(self.num_producers):
+            jid = self.jid_offset + j
+            tee_name = None
+            if self.tee_dir is not None:
+                tee_name = os.path.join(self.tee_dir, "rank%d.h5" % jid)
+            proc = ctx.Process(target=_producer_main,
+                               args=(self.producer, self.sim_args, jid, self.seed+jid, self.gvec,
+                                     self.queue, self.stop, tee_name),
+                               daemon=True)
+            proc.start()
+            self.procs.append(proc)
+
+    def close(self):
+        """stop the producers (their tee files are closed)"""
+        if not self.procs:
+            return
+        self.stop.set()
+        # drain, so producers blocked on put can exit
+        while any(proc.is_alive() for proc in self.procs):
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for proc in self.procs:
+            proc.join()
+        self.procs = []
+
+    def _make_sample(self, img, labels, geom):
+        img = torch.from_numpy(img[None])
+        if img.dtype != torch.uint8:
+            img = img.to(torch.float16 if self.half_precision else torch.float32)
+        lab_dtype = torch.float16 if self.half_precision else torch.float32
+        img_lab = torch.from_numpy(labels[self.label_sel]).to(lab_dtype)
+        if self.use_geom:
+            return img, img_lab, torch.from_numpy(geom[self.geom_inds]).to(lab_dtype)
+        return img, img_lab
+
+    def __iter__(self):
+        self.start()
+        for _ in range(self.num_shots):
+            t = time.time()
+            while True:
+                try:
+                    img, labels, geom = self.queue.get(timeout=10)
+                    break
+                except queue.Empty:
+                    if not all(proc.is_alive() for proc in self.procs):
+                        raise RuntimeError("a simulation producer exited, see its output for errors")
+            self.wait_time += time.time()-t
+            yield self._make_sample(img, labels, geom)
+
+    def __len__(self):
+        return self.num_shots
@@ -15,7 +15,8 @@ ngpu_per_node=LOCAL_COMM.size
 if COMM.rank==0:
     print("GPUs per node: %d" % ngpu_per_node, flush=True)
 
-ddp.slurm_init(COMM, mpi.get_host_comm())
+ddp.slurm_init(COMM, mpi.get_host_comm(),
+               backend=args.ddpBackend or ("gloo" if args.cpu else ddp.default_backend()))
 
 net.do_training(args.input, args.labelName, args.imgsName, args.outdir,
             train_start_stop=args.trainRange,
@@ -29,7 +30,20 @@ net.do_training(args.input, args.labelName, args.imgsName, args.outdir,
             logfile=args.logfile, loglevel=args.loglevel,
             label_sel=args.labelSel, half_precision=args.half,
             display=not args.noDisplay, save_freq=args.saveFreq,
-            COMM=COMM, ngpu_per_node=ngpu_per_node,
+            COMM=COMM, ngpu_per_node=ngpu_per_node, dev="cpu" if args.cpu else "cuda:0",
             use_geom=args.useGeom, weights=args.weights, error=args.error,
             use_transform=args.transform, eval_mode_only=not args.noEvalOnly,
-            debug_mode=args.debugMode, ori_mode=args.oriMode, use_sgnums=args.useSGNums)
+            debug_mode=args.debugMode, ori_mode=args.oriMode, use_sgnums=args.useSGNums,
+            num_workers=args.numWorkers, prefetch_factor=args.prefetchFactor,
+            chunk_batches=args.chunkBatches, block_size=args.blockSize, block_window=args.blockWindow,
+            shard_shuffle=args.shardShuffle, shuffle_buffer=args.shuffleBuffer, prefix=args.prefix,
+            cache_gb=args.cacheGB, cache_policy=args.cachePolicy, max_shift=args.maxShift,
+            stream_sims=args.streamSims, stream_producers=args.streamProducers, stream_queue=args.streamQueue,
+            stream_tee=args.streamTee, preproc_cache=args.preprocCache, image_reader=args.imageReader,
+            amp=args.amp, validate_every=args.validateEvery, train_validate_size=args.trainValidateSize,
+            early_stop=args.earlyStop, early_stop_delta=args.earlyStopDelta,
+            keep_last=args.keepLast, keep_best=args.keepBest, save_steps=args.saveSteps,
+            compile_model=args.compile, compile_mode=args.compileMode, channels_last=args.channelsLast,
+            accum_steps=args.accumSteps, comm_hook=args.commHook, powersgd_rank=args.powerSGDRank,
+            zero=args.zero, checkpoint_activations=args.checkpointActivations,
+            profile_steps=args.profileSteps, debug_checks=args.debugChecks, print_freq=args.printFreq)
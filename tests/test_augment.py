@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from resonet.utils import augment
+
+
+def _symmetries(img, rot90=True):
+    syms = []
+    for k in range(4 if rot90 else 2):
+        for x in (img, torch.flip(img, dims=(-1,))):
+            syms.append(torch.rot90(x, k if rot90 else 2*k, dims=(-2, -1)))
+    return syms
+
+
+@pytest.mark.parametrize("shape", [(6, 6), (5, 7)])
+def test_dihedral(shape):
+    torch.manual_seed(0)
+    imgs = torch.randint(256, (256, 1) + shape).to(torch.float32)
+    rot90 = shape[0] == shape[1]
+    out = augment.dihedral(imgs, rot90=rot90)
+    assert out.shape == imgs.shape
+    found = set()
+    for img, aug in zip(imgs, out):
+        matches = [i for i, sym in enumerate(_symmetries(img, rot90)) if torch.equal(sym, aug)]
+        assert matches
+        found.add(matches[0])
+    assert len(found) == (8 if rot90 else 4)
+    if not rot90:
+        with pytest.raises(ValueError):
+            augment.dihedral(imgs)
+
+
+def test_shift():
+    torch.manual_seed(0)
+    imgs = torch.arange(1, 65, dtype=torch.float32).reshape(1, 1, 8, 8).repeat(16, 2, 1, 1)
+    out = augment.shift(imgs, max_shift=2)
+    for img, aug in zip(imgs, out):
+        # each shifted image is an exact crop of the zero-padded original
+        padded = torch.nn.functional.pad(img, (2, 2, 2, 2))
+        crops = [padded[:, 2-dy: 10-dy, 2-dx: 10-dx] for dy in range(-2, 3) for dx in range(-2, 3)]
+        assert any(torch.equal(crop, aug) for crop in crops)
+    assert torch.equal(augment.BatchAugment(flips=False)(imgs), imgs)
@@ -0,0 +1,38 @@
+import h5py
+import numpy as np
+import pytest
+
+from resonet import loaders
+from resonet.scripts import benchmark_train, merge_h5s
+
+
+@pytest.mark.parametrize("dtype,codec", [("float32", None), ("uint16", "gzip"), ("uint8", None)])
+def test_synthetic_master(tmp_path, dtype, codec):
+    master = benchmark_train.write_synthetic_master(str(tmp_path), 10, (16, 16), dtype, codec, nfiles=3)
+    index = merge_h5s.load_index(master)
+    assert [f["count"] for f in index["files"]] == [4, 3, 3]
+    with h5py.File(master, "r") as h:
+        assert h["images"].shape == (10, 16, 16)
+        assert h["images"].dtype == np.dtype(dtype)
+        assert "pdbmap" in h["labels"].attrs
+        assert list(h["geom"].attrs["names"]) == ["detdist", "wavelen", "pixsize", "xdim", "ydim"]
+    with h5py.File(index["files"][0]["name"], "r") as h:
+        assert h["images"].compression == (None if codec is None else "gzip")
+    dset = loaders.H5SimDataDset(master, dev="cpu", label_sel=["reso", "one_over_reso"], use_geom=True,
+                                 convert_to_float=True)
+    img, labels, geom = dset[7]
+    assert img.shape == (1, 16, 16)
+    assert np.isclose(labels[0].item() * labels[1].item(), 1)
+
+
+def test_run_config(tmp_path):
+    master = benchmark_train.write_synthetic_master(str(tmp_path / "data"), 24, (64, 64), "uint8")
+    config = {"master": master, "rundir": str(tmp_path / "run"), "arch": "res18", "bs": 8, "dev": "cpu",
+              "epochs": 2, "nimg": 24, "ntest": 8, "num_workers": 0, "amp": None}
+    result = benchmark_train.run_config(config)
+    assert "error" not in result, result.get("error")
+    assert len(result["epochs"]) == 2
+    assert all(ep["images"] == 16 for ep in result["epochs"])
+    assert result["images_per_sec"] > 0
+    assert 0 <= result["data_wait_fraction"] <= 1
+    assert result["peak_rss_mb"] > 0
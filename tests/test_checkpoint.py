@@ -0,0 +1,37 @@
+import os
+import torch
+
+from resonet.utils.checkpoint import CheckpointWriter, to_cpu
+
+
+def test_to_cpu_snapshot():
+    model = torch.nn.Linear(4, 2)
+    state = to_cpu({"model_state": model.state_dict(), "epoch": 3})
+    with torch.no_grad():
+        model.weight += 1
+    assert state["epoch"] == 3
+    assert not torch.allclose(state["model_state"]["weight"], model.weight)
+
+
+def test_rotation(tmp_path):
+    writer = CheckpointWriter(keep_last=2, keep_best=1)
+    losses = [5, 1, 3, 4, 6]
+    for ep, loss in enumerate(losses):
+        name = str(tmp_path / ("nety_ep%d.nn" % ep))
+        writer.submit({name: {"w": torch.full((3,), float(ep))}}, loss=loss)
+    writer.submit({str(tmp_path / "nety_epLast.nn"): {"w": torch.zeros(3)}}, rotate=False)
+    writer.close()
+    # the last 2, the best one (ep1), and the final model
+    assert sorted(os.listdir(tmp_path)) == ["nety_ep1.nn", "nety_ep3.nn", "nety_ep4.nn", "nety_epLast.nn"]
+    assert torch.load(tmp_path / "nety_ep4.nn")["w"][0] == 4
+
+
+def test_rotation_unvalidated(tmp_path):
+    # with validate_every=2, only every other checkpoint has a loss
+    writer = CheckpointWriter(keep_last=1, keep_best=2)
+    losses = [None, 3, None, 1, None, 2, None]
+    for ep, loss in enumerate(losses):
+        writer.submit({str(tmp_path / ("nety_ep%d.nn" % ep)): {"w": torch.zeros(3)}}, loss=loss)
+    writer.close()
+    # the last one, and the two best validated ones (never an unvalidated one)
+    assert sorted(os.listdir(tmp_path)) == ["nety_ep3.nn", "nety_ep5.nn", "nety_ep6.nn"]
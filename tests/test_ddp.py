@@ -0,0 +1,75 @@
+import os
+import pytest
+import torch
+import torch.distributed as td
+from torch.nn.parallel import DistributedDataParallel
+from torch.distributed.optim import ZeroRedundancyOptimizer
+from torch.distributed.algorithms.ddp_comm_hooks import powerSGD_hook
+
+from resonet import net
+from resonet.utils import ddp
+from resonet.scripts import benchmark_train
+
+
+@pytest.fixture
+def gloo_group(monkeypatch):
+    """a one-process gloo group, initialized like a torchrun launch"""
+    monkeypatch.setenv("MASTER_ADDR", "localhost")
+    monkeypatch.setenv("MASTER_PORT", str(ddp.find_free_port()))
+    monkeypatch.setenv("RANK", "0")
+    monkeypatch.setenv("LOCAL_RANK", "0")
+    monkeypatch.setenv("WORLD_SIZE", "1")
+    assert ddp.env_init("gloo") == (0, 1)
+    yield
+    td.destroy_process_group()
+
+
+@pytest.mark.parametrize("hook", ddp.COMM_HOOKS)
+def test_comm_hooks(gloo_group, hook):
+    torch.manual_seed(0)
+    model = DistributedDataParallel(torch.nn.Linear(8, 4))
+    # PowerSGD compresses from the third iteration on, so the last backward goes through the low-rank allreduce
+    state = ddp.register_comm_hook(model, hook, powersgd_start=2)
+    if hook == "powersgd":
+        assert isinstance(state, powerSGD_hook.PowerSGDState)
+    else:
+        assert state is None
+    for _ in range(3):
+        model.zero_grad()
+        model(torch.randn(16, 8)).sum().backward()
+        assert all(p.grad is not None and torch.isfinite(p.grad).all() for p in model.parameters())
+
+
+def test_consolidate_zero(gloo_group):
+    torch.manual_seed(0)
+    model = DistributedDataParallel(torch.nn.Linear(8, 4))
+    optimizer = ZeroRedundancyOptimizer(model.parameters(), optimizer_class=torch.optim.SGD, lr=0.1, momentum=0.9)
+    model(torch.randn(16, 8)).sum().backward()
+    optimizer.step()
+    ddp.consolidate_optimizer(optimizer)
+    state = optimizer.state_dict()
+    fresh = ZeroRedundancyOptimizer(model.parameters(), optimizer_class=torch.optim.SGD, lr=0.1, momentum=0.9)
+    fresh.load_state_dict(state)
+    for key, val in optimizer.optim.state_dict()["state"].items():
+        assert torch.equal(fresh.optim.state_dict()["state"][key]["momentum_buffer"], val["momentum_buffer"])
+
+
+def test_do_training_gloo(gloo_group, tmp_path, monkeypatch):
+    master = benchmark_train.write_synthetic_master(str(tmp_path / "data"), 24, (64, 64), "float32")
+    wrapped = []
+
+    class SpyDDP(DistributedDataParallel):
+        def __init__(self, module, **kwargs):
+            wrapped.append((module, kwargs))
+            super().__init__(module, **kwargs)
+    monkeypatch.setattr(net.nn.parallel, "DistributedDataParallel", SpyDDP)
+
+    stats = net.do_training(master, "labels", "images", str(tmp_path / "out"), arch="res18", bs=8, dev="cpu",
+                            max_ep=1, train_start_stop=(8, 24), test_start_stop=(0, 8),
+                            label_sel=["one_over_reso"], display=False)
+    assert len(stats) == 1 and stats[0]["images"] == 16
+    module, kwargs = wrapped[0]
+    assert kwargs["device_ids"] is None
+    # SyncBatchNorm is CUDA only, on the CPU the batchnorm layers are kept
+    assert not any(isinstance(m, torch.nn.SyncBatchNorm) for m in module.modules())
+    assert os.path.exists(tmp_path / "out" / "nety_epLast.nn")
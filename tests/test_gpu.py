@@ -0,0 +1,23 @@
+import warnings
+import torch
+
+from resonet.utils.gpu import SyncCounter
+
+
+def test_sync_counter(monkeypatch):
+    # the sync debug mode needs a GPU, here the sync warnings are raised by hand
+    monkeypatch.setattr(torch.cuda, "set_sync_debug_mode", lambda mode: None)
+    assert not SyncCounter("cuda:0", enabled=False).enabled
+    assert not SyncCounter("cpu").enabled
+    counter = SyncCounter("cuda:0")
+    with warnings.catch_warnings(record=True) as shown:
+        warnings.simplefilter("default")
+        for _ in range(3):
+            counter.start()
+            warnings.warn("called a synchronizing CUDA operation")
+            warnings.warn("called a synchronizing CUDA operation")
+            warnings.warn("unrelated warning")
+            counter.stop()
+    assert counter.per_step() == 2
+    # other warnings are not swallowed, and are shown once per location as usual
+    assert [str(rec.message) for rec in shown] == ["unrelated warning"]
@@ -0,0 +1,363 @@
+import os
+import h5py
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from resonet import loaders
+from resonet.utils import h5codecs
+
+
+LABEL_NAMES = ["reso", "one_over_reso", "pdb"]
+
+
+def _write_master(fname, nimg=20, shape=(8, 8), dtype=np.float32, seed=0):
+    np.random.seed(seed)
+    with h5py.File(fname, "w") as h:
+        imgs = np.floor(np.random.random((nimg,) + shape) * 255).astype(dtype)
+        h.create_dataset("images", data=imgs, chunks=(1,) + shape)
+        labs = np.random.random((nimg, len(LABEL_NAMES))).astype(np.float32)
+        labs[:, 0] = np.arange(nimg)
+        dset = h.create_dataset("labels", data=labs)
+        dset.attrs["names"] = LABEL_NAMES
+        dset.attrs["pdbmap"] = ["pdbs/1abc"]
+        geom = h.create_dataset("geom", data=np.random.random((nimg, 5)).astype(np.float32))
+        geom.attrs["names"] = ["detdist", "wavelen", "pixsize", "xdim", "ydim"]
+    return imgs, labs
+
+
+def test_cpu_tensors_workers(tmp_path):
+    fname = str(tmp_path / "master.h5")
+    imgs, labs = _write_master(fname)
+    dset = loaders.H5SimDataDset(fname, label_sel=["reso"], use_geom=True, cpu_tensors=True)
+    batches = DataLoader(dset, batch_size=4, num_workers=2, persistent_workers=True)
+    seen = []
+    for tensors in batches:
+        tensors = loaders.batch_to_dev(tensors, "cpu")
+        img_dat, img_lab, geom = tensors
+        assert img_dat.shape == (4, 1, 8, 8)
+        assert geom.shape == (4, 5)
+        for lab, img in zip(img_lab, img_dat):
+            i = int(lab.item())
+            assert np.allclose(img[0].numpy(), imgs[i])
+            seen.append(i)
+    assert sorted(seen) == list(range(len(imgs)))
+
+
+def test_dev_required(tmp_path):
+    fname = str(tmp_path / "master.h5")
+    _write_master(fname)
+    dset = loaders.H5SimDataDset(fname)
+    with pytest.raises(AssertionError):
+        dset[0]
+    dset.dev = "cpu"
+    img_dat, img_lab = dset[0]
+    assert img_dat.device == torch.device("cpu")
+
+
+def test_batched_reads(tmp_path):
+    fname = str(tmp_path / "master.h5")
+    imgs, labs = _write_master(fname)
+    dset = loaders.H5SimDataDset(fname, label_sel=["reso"], dev="cpu", start=2, stop=18)
+    inds = [7, 3, 4, 15, 0, 5]
+    batch = dset.__getitems__(inds)
+    for i, (img_dat, img_lab) in zip(inds, batch):
+        assert np.allclose(img_dat[0].numpy(), imgs[i+2])
+        assert img_lab.item() == i+2
+    assert dset.get_read_stats()[0] == len(inds)*dset.image_nbytes
+
+
+def test_read_stats_workers(tmp_path):
+    fname = str(tmp_path / "master.h5")
+    _write_master(fname)
+    dset = loaders.H5SimDataDset(fname, label_sel=["reso"], cpu_tensors=True)
+    dset.share_read_stats(2)
+    for _ in DataLoader(dset, batch_size=4, num_workers=2):
+        pass
+    nbytes, seconds = dset.get_read_stats()
+    assert nbytes == len(dset)*dset.image_nbytes
+    assert seconds > 0
+
+
+def test_chunk_batch_sampler(tmp_path):
+    fname = str(tmp_path / "master.h5")
+    _write_master(fname, nimg=40)
+    dset = loaders.H5SimDataDset(fname, dev="cpu")
+    gen = torch.Generator().manual_seed(0)
+    train, test = torch.utils.data.random_split(dset, [30, 10], generator=gen)
+
+    samplers = [loaders.ChunkBatchSampler(train, 4, block_size=5, window=2, num_replicas=2, rank=rank)
+                for rank in range(2)]
+    batches = [list(s) for s in samplers]
+    assert len(batches[0]) == len(batches[1]) == len(samplers[0])
+    positions = sorted(sum(batches[0] + batches[1], []))
+    assert set(positions) == set(range(len(train)))
+
+    # deterministic per epoch, different across epochs
+    assert batches[0] == list(samplers[0])
+    samplers[0].set_epoch(1)
+    assert batches[0] != list(samplers[0])
+
+    # a batch can straddle two windows, so it draws from at most 2*window blocks
+    for batch in batches[0]:
+        blocks = {train.indices[p] // 5 for p in batch}
+        assert len(blocks) <= 4
+
+    batch_imgs = DataLoader(train, batch_sampler=samplers[1])
+    nimg = sum(len(labs) for _, labs in batch_imgs)
+    assert nimg == sum(len(b) for b in batches[1])
+
+
+def test_skip_batch_sampler():
+    sampler = torch.utils.data.DistributedSampler(range(30), num_replicas=1, rank=0, seed=1)
+    sampler.set_epoch(3)
+    batch_sampler = torch.utils.data.BatchSampler(sampler, 4, drop_last=False)
+    batches = list(batch_sampler)
+    skipped = loaders.SkipBatchSampler(batch_sampler, 5)
+    assert list(skipped) == batches[5:]
+    assert len(skipped) == len(batches) - 5
+
+
+def test_memmap_export(tmp_path, monkeypatch):
+    import sys
+    from resonet.scripts import export_flat
+    fname = str(tmp_path / "master.h5")
+    imgs, labs = _write_master(fname, dtype=np.float32)
+    flatdir = str(tmp_path / "flat")
+    monkeypatch.setattr(sys, "argv", ["export_flat.py", fname, flatdir, "--blockSize", "7"])
+    export_flat.main()
+
+    h5_dset = loaders.H5SimDataDset(fname, label_sel=["reso", "one_over_reso"], use_geom=True, dev="cpu")
+    mm_dset = loaders.MemmapSimDataDset(flatdir, label_sel=["reso", "one_over_reso"], use_geom=True, dev="cpu")
+    assert len(h5_dset) == len(mm_dset)
+    for i in [0, 5, 19]:
+        for t1, t2 in zip(h5_dset[i], mm_dset[i]):
+            assert torch.equal(t1, t2)
+    batch = mm_dset.__getitems__([3, 1])
+    assert torch.equal(batch[0][0], h5_dset[3][0])
+    # samples are views into the memory map
+    assert isinstance(mm_dset.images, np.memmap) or isinstance(mm_dset.images.base, np.memmap)
+
+
+def test_uint8_to_device(tmp_path):
+    fname = str(tmp_path / "master.h5")
+    imgs, labs = _write_master(fname, dtype=np.uint8)
+    dset = loaders.H5SimDataDset(fname, cpu_tensors=True, convert_to_float=True)
+    img_dat, img_lab = dset[3]
+    assert img_dat.dtype == torch.uint8
+    batch = loaders.batch_to_dev(next(iter(DataLoader(dset, batch_size=4))), "cpu")
+    assert batch[0].dtype == torch.float32
+    assert np.allclose(batch[0][3, 0].numpy(), imgs[3])
+
+    dset = loaders.H5SimDataDset(fname, dev="cpu", convert_to_float=True, half_precision=True)
+    img_dat, _ = dset[3]
+    assert img_dat.dtype == torch.float16
+    assert np.allclose(img_dat[0].numpy(), imgs[3])
+
+
+@pytest.mark.parametrize("codec", h5codecs.CODECS)
+def test_codecs(tmp_path, codec):
+    if codec != "gzip":
+        pytest.importorskip("hdf5plugin")
+    fname = str(tmp_path / "master.h5")
+    imgs = np.floor(np.sqrt(np.random.random((6, 8, 8)) * 65025)).astype(np.uint8)
+    with h5py.File(fname, "w") as h:
+        h.create_dataset("images", data=imgs, chunks=(1, 8, 8), **h5codecs.get_comp_args(codec))
+        h.create_dataset("labels", data=np.zeros((6, 1), np.float32))
+    dset = loaders.H5SimDataDset(fname, dev="cpu", convert_to_float=True)
+    batch = dset.__getitems__([4, 1])
+    assert np.array_equal(batch[0][0][0].numpy(), imgs[4])
+    assert np.array_equal(batch[1][0][0].numpy(), imgs[1])
+
+
+def test_shards(tmp_path, monkeypatch):
+    import sys
+    from resonet.scripts import make_shards, merge_h5s
+    fnames = [str(tmp_path / ("master%d.h5" % i)) for i in range(2)]
+    for fname in fnames:
+        _write_master(fname, nimg=20)
+    outdir = str(tmp_path / "shards")
+    monkeypatch.setattr(sys, "argv", ["make_shards.py"] + fnames + [outdir, "--shardSize", "6"])
+    make_shards.main()
+    master = str(tmp_path / "shards" / "master.h5")
+    monkeypatch.setattr(sys, "argv", ["merge_h5s.py", outdir, master, "--prefix", "shard"])
+    merge_h5s.main()
+
+    dset = loaders.H5SimDataDset(master, label_sel=["reso"], dev="cpu")
+    assert len(dset) == 40
+    assert len(dset.source_edges) == 7
+    dset.open()
+    # every input image is in exactly one shard (reso labels are 0-19 in each input)
+    assert sorted(dset.labels[:, 0]) == sorted(list(range(20))*2)
+
+    samplers = [loaders.ShardShuffleSampler(dset, buffer_size=4, num_replicas=2, rank=rank) for rank in range(2)]
+    inds = [list(s) for s in samplers]
+    assert len(inds[0]) == len(inds[1]) == len(samplers[0]) == 20
+    assert sorted(inds[0] + inds[1]) == list(range(40))
+    assert inds[0] == list(samplers[0])
+    samplers[0].set_epoch(1)
+    assert inds[0] != list(samplers[0])
+
+
+def test_multi_file(tmp_path, monkeypatch):
+    import sys
+    from resonet.scripts import merge_h5s
+    simdir = tmp_path / "sims"
+    simdir.mkdir()
+    for rank, nimg in enumerate([5, 9, 3]):
+        _write_master(str(simdir / ("rank%d.h5" % rank)), nimg=nimg, seed=rank)
+    master = str(tmp_path / "master.h5")
+    monkeypatch.setattr(sys, "argv", ["merge_h5s.py", str(simdir), master])
+    merge_h5s.main()
+
+    kwargs = {"label_sel": ["reso", "one_over_reso"], "use_geom": True, "dev": "cpu"}
+    vds = loaders.H5SimDataDset(master, **kwargs)
+    multi = loaders.H5MultiFileDset([str(simdir)], max_open=1, **kwargs)
+    assert len(multi) == len(vds) == 17
+    # merge_h5s globs in arbitrary order, so match samples by content
+    vds_samples = {vds[i][1][1].item(): vds[i] for i in range(len(vds))}
+    batch = multi.__getitems__([13, 0, 7, 8, 1])
+    for sample in batch + [multi[4]]:
+        expected = vds_samples[sample[1][1].item()]
+        for t1, t2 in zip(sample, expected):
+            assert torch.equal(t1, t2)
+    assert len(multi.handles) == 1
+
+    multi_sub = loaders.H5MultiFileDset(str(simdir), start=2, stop=16, **kwargs)
+    assert len(multi_sub) == 14
+    assert torch.equal(multi_sub[10][0], multi[12][0])
+
+
+def test_merge_append(tmp_path, monkeypatch):
+    import sys
+    from resonet.scripts import merge_h5s
+    simdir = tmp_path / "sims"
+    simdir.mkdir()
+    for rank, nimg in enumerate([5, 9]):
+        _write_master(str(simdir / ("rank%d.h5" % rank)), nimg=nimg, seed=rank)
+    master = str(tmp_path / "master.h5")
+    monkeypatch.setattr(sys, "argv", ["merge_h5s.py", str(simdir), master])
+    merge_h5s.main()
+    assert len(loaders.H5SimDataDset(master, dev="cpu")) == 14
+
+    # files already in the index must not be opened again
+    _write_master(str(simdir / "rank2.h5"), nimg=3, seed=2)
+    probed = []
+    probe_file = merge_h5s.probe_file
+    monkeypatch.setattr(merge_h5s, "probe_file", lambda f, keys: probed.append(f) or probe_file(f, keys))
+    monkeypatch.setattr(sys, "argv", ["merge_h5s.py", str(simdir), master, "--append"])
+    merge_h5s.main()
+    assert probed == [str(simdir / "rank2.h5")]
+    kwargs = {"label_sel": ["reso"], "use_geom": True, "dev": "cpu"}
+    vds = loaders.H5SimDataDset(master, **kwargs)
+    multi = loaders.H5MultiFileDset(None, index=merge_h5s.index_name(master), **kwargs)
+    assert len(vds) == len(multi) == 17
+    for i in [0, 6, 16]:
+        for t1, t2 in zip(vds[i], multi[i]):
+            assert torch.equal(t1, t2)
+
+    _write_master(str(simdir / "rank3.h5"), nimg=3, shape=(4, 4))
+    with pytest.raises(ValueError):
+        merge_h5s.main()
+
+
+@pytest.mark.parametrize("policy", ["lru", "first"])
+def test_sample_cache_policy(policy):
+    from resonet.utils.sample_cache import SharedSampleCache
+    items = np.arange(6)
+    arrays = [np.full((2, 2), i, np.float32) for i in items]
+    cache = SharedSampleCache("resonet_test_%s_%d" % (policy, os.getpid()), 6, (2, 2), np.float32,
+                              budget_bytes=3*16, policy=policy)
+    try:
+        assert cache.num_slots == 3
+        cache.put(items[:3], arrays[:3])
+        cache.get(items[:1])  # item 0 is now more recent than items 1 and 2
+        cache.put(items[3:5], arrays[3:5])
+        cached = [i for i, arr in zip(items, cache.get(items)) if arr is not None]
+        assert cached == ([0, 3, 4] if policy == "lru" else [0, 1, 2])
+        assert np.all(cache.get(items[:1])[0] == 0)
+        assert cache.stats()["nbytes"] == 3*16
+    finally:
+        cache.close()
+
+
+def test_sample_cache_workers(tmp_path):
+    fname = str(tmp_path / "master.h5")
+    imgs, labs = _write_master(fname)
+    kwargs = {"label_sel": ["reso"], "cpu_tensors": True, "half_precision": True}
+    dset = loaders.H5SimDataDset(fname, cache_bytes=1e6, cache_name="resonet_test_%d" % os.getpid(), **kwargs)
+    try:
+        assert dset.cache.item_dtype == np.float16
+        batches = DataLoader(dset, batch_size=4, num_workers=2)
+        for epoch in range(2):
+            for img_dat, img_lab in batches:
+                assert img_dat.dtype == torch.float16
+                for lab, img in zip(img_lab, img_dat):
+                    assert np.allclose(img[0].numpy(), imgs[int(lab.item())])
+            # the workers fill the cache in the first epoch, and only read from it in the second
+            stats = dset.cache.stats()
+            assert stats["hits"] == epoch*len(imgs)
+            assert stats["items"] == len(imgs)
+        # another process (e.g. a second rank) attaches to the same cache
+        other = loaders.H5SimDataDset(fname, cache_bytes=1e6, cache_name=dset.cache.name, **kwargs)
+        assert torch.equal(other[3][0], loaders.H5SimDataDset(fname, **kwargs)[3][0])
+        assert dset.cache.stats()["hits"] == len(imgs) + 1
+        other.cache.close()
+    finally:
+        dset.cache.close()
+
+
+def test_image_file_dset(tmp_path, monkeypatch):
+    import fabio.cbfimage
+    from scipy.ndimage import binary_dilation
+    from resonet.utils.eval_model import to_tens
+    np.random.seed(0)
+    rows = ["image,one_over_reso,detdist,wavelen,pixsize"]
+    raws = []
+    for i in range(3):
+        raw = np.random.randint(-1, 70000, (1030, 1030)).astype(np.int32)
+        fabio.cbfimage.CbfImage(data=raw).write(str(tmp_path / ("img%d.cbf" % i)))
+        raws.append(raw)
+        rows.append("img%d.cbf,%f,200,1,0.1" % (i, 0.5+i))
+    csvname = str(tmp_path / "labels.csv")
+    with open(csvname, "w") as f:
+        f.write("\n".join(rows))
+
+    kwargs = {"label_sel": ["one_over_reso"], "use_geom": True, "cpu_tensors": True, "ds_stride": 1}
+    dset = loaders.ImageFileDset(csvname, **kwargs)
+    img, lab, geom = dset[1]
+    assert img.dtype == torch.uint8 and img.shape == (1, 512, 512)
+    assert lab.item() == 1.5
+    assert geom.tolist() == pytest.approx([200, 0.1, 1, 1030, 1030])
+    mask = ~binary_dilation(raws[1] < 0, iterations=1)
+    expected = to_tens(raws[1].astype(np.float32), mask, torch.nn.MaxPool2d(1, 1), ds_fact=1)[0, 0]
+    assert torch.equal(img[0].float(), expected)
+    assert dset.cache_stats["misses"] == 1
+
+    # a new dataset (e.g. a later run) reads the cache instead of the image files
+    dset2 = loaders.ImageFileDset(csvname, **kwargs)
+    batches = DataLoader(dset2, batch_size=3)
+    img2, _, _ = next(iter(batches))
+    assert torch.equal(img2[1], img)
+    assert dset2.cache_stats == {"hits": 1, "misses": 2}
+    dset3 = loaders.ImageFileDset(csvname, **kwargs)
+    assert torch.equal(dset3[2][0], img2[2])
+    assert dset3.cache_stats == {"hits": 1, "misses": 0}
+
+    # content keys: each file is hashed once, later lookups use the saved hash
+    file_sizes = {os.path.getsize(str(tmp_path / ("img%d.cbf" % i))) for i in range(3)}
+    hashed_sizes = []
+    real_sha1 = loaders.hashlib.sha1
+
+    def sha1(data=b""):
+        hashed_sizes.append(len(data))
+        return real_sha1(data)
+    monkeypatch.setattr(loaders.hashlib, "sha1", sha1)
+    dset4 = loaders.ImageFileDset(csvname, hash_contents=True, **kwargs)
+    key = dset4.cache_key(0)
+    assert file_sizes & set(hashed_sizes)
+    hashed_sizes.clear()
+    assert loaders.ImageFileDset(csvname, hash_contents=True, **kwargs).cache_key(0) == key
+    assert dset4.cache_key(0) == key
+    assert hashed_sizes and not file_sizes & set(hashed_sizes)
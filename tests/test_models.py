@@ -59,6 +59,26 @@ class TestModels:
         print(model)
         assert str(model)==str(model2)
 
+    def test_checkpoint_activations(self):
+        torch.manual_seed(0)
+        model = params.res18(nout=2, dev="cpu")
+        model.eval()
+        image = torch.randn(2, 1, 128, 128)
+        outs, grads = [], []
+        for ckpt in [False, True]:
+            model.checkpoint_activations = ckpt
+            model.zero_grad()
+            out = model(image)
+            out.sum().backward()
+            outs.append(out.detach())
+            grads.append(model.resnet.layer1[0].conv1.weight.grad.clone())
+        assert torch.allclose(outs[0], outs[1])
+        assert torch.allclose(grads[0], grads[1], atol=1e-6)
+        nbytes = [arches.saved_activation_bytes(model, image)]
+        model.checkpoint_activations = False
+        nbytes.append(arches.saved_activation_bytes(model, image))
+        assert nbytes[0] < nbytes[1]
+
     def main(self, resnet_num, num_out=1, num_geom=5, dev="cuda:0", nchan=1, weight = None):
         """
         :param resnet_num: resnet number (18,34,50,101,152)
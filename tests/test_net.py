@@ -1,14 +1,18 @@
 from resonet import arches
 from resonet.net import *
+from resonet.net import _train_iter
+import torch
 from argparse import ArgumentParser
 from argparse import ArgumentDefaultsHelpFormatter as arg_formatter
 from argparse import Namespace
 import pytest
 import io
+import os
 import sys
 import numpy as np
 import logging
 from resonet.params import ARCHES, LOSSES
+from resonet.scripts import benchmark_train
 
 class TestNet:
 
@@ -89,4 +93,97 @@ class TestNet:
         print('# test case 3 passed!')
     
     
-    
\ No newline at end of file
+    
+    @pytest.mark.parametrize("amp", ["bf16", "fp16"])
+    def test_train_iter_amp(self, amp):
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.ReLU(), torch.nn.Linear(16, 1))
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+        scaler = torch.amp.GradScaler("cpu") if amp == "fp16" else None
+        data = torch.randn(32, 8)
+        labels = torch.randn(32, 1)
+        outputs = _train_iter((data,), labels, model, torch.nn.MSELoss(), optimizer,
+                              autocast=get_autocast("cpu", amp), scaler=scaler)
+        # the loss is computed in fp32, and the weights stay fp32
+        assert outputs.dtype == torch.float32
+        assert all(p.dtype == torch.float32 for p in model.parameters())
+        assert all(p.grad is not None for p in model.parameters())
+
+    def test_validate(self):
+        torch.manual_seed(0)
+        model = torch.nn.Linear(8, 2)
+        data = torch.randn(50, 8)
+        labels = torch.randn(50, 2)
+        loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(data, labels), batch_size=16)
+        with torch.no_grad():
+            acc, ave_loss, all_lab, all_pred = validate(loader, model, 0, torch.nn.L1Loss(), error=0.5)
+            pred = model(data)
+        batch_losses = [torch.nn.L1Loss()(pred[i:i+16], labels[i:i+16]).item() for i in range(0, 50, 16)]
+        assert all_lab.shape == all_pred.shape == (2, 50)
+        assert np.allclose(all_pred, pred.numpy().T, atol=1e-6)
+        assert np.allclose(all_lab, labels.numpy().T)
+        assert np.isclose(ave_loss, np.mean(batch_losses))
+        assert np.isclose(acc, ((pred-labels).abs() < 0.5).all(dim=1).float().mean().item()*100)
+
+    def test_train_iter_accum(self):
+        torch.manual_seed(0)
+        data = torch.randn(8, 4)
+        labels = torch.randn(8, 1)
+        models = [torch.nn.Linear(4, 1) for _ in range(2)]
+        models[1].load_state_dict(models[0].state_dict())
+        optimizers = [torch.optim.SGD(m.parameters(), lr=0.1) for m in models]
+        _train_iter((data,), labels, models[0], torch.nn.L1Loss(), optimizers[0])
+        # two micro-batches of 4, one optimizer step
+        _train_iter((data[:4],), labels[:4], models[1], torch.nn.L1Loss(), optimizers[1],
+                    accum_steps=2, first=True, last=False)
+        _train_iter((data[4:],), labels[4:], models[1], torch.nn.L1Loss(), optimizers[1],
+                    accum_steps=2, first=False, last=True)
+        for p0, p1 in zip(models[0].parameters(), models[1].parameters()):
+            assert torch.allclose(p0, p1, atol=1e-6)
+
+    def test_checkpoint_state_drops_cp(self):
+        model = torch.nn.Linear(4, 1)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        cp = checkpoint_state(0, model, optimizer, 1.0, [("lr", 0.1)])
+        # a restarted run must not nest the checkpoint it was restarted from
+        state = checkpoint_state(1, model, optimizer, 0.5, [("lr", 0.1), ("cp", cp), ("COMM", object())])
+        assert dict(state["args"]) == {"lr": 0.1, "cp": None, "COMM": None}
+
+    def test_train_iter_debug_checks(self):
+        torch.manual_seed(0)
+        model = torch.nn.Linear(4, 1)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        data = torch.randn(8, 4)
+        labels = torch.randn(8, 1)
+        loss_sum = torch.zeros(())
+        with torch.no_grad():
+            loss0 = torch.nn.L1Loss()(model(data), labels)
+        _train_iter((data,), labels, model, torch.nn.L1Loss(), optimizer, debug_checks=True, loss_sum=loss_sum)
+        assert torch.isclose(loss_sum, loss0)
+        labels[0] = np.nan
+        with pytest.raises(AssertionError):
+            _train_iter((data,), labels, model, torch.nn.L1Loss(), optimizer, debug_checks=True)
+
+    def _train_synthetic(self, tmp_path, outdir, **kwargs):
+        master = str(tmp_path / "data" / "master.h5")
+        if not os.path.exists(master):
+            benchmark_train.write_synthetic_master(str(tmp_path / "data"), 24, (64, 64), nfiles=2)
+        outdir = str(tmp_path / outdir)
+        stats = do_training(master, "labels", "images", outdir, arch="res18", bs=8, dev="cpu",
+                            train_start_stop=(8, 24), test_start_stop=(0, 8), label_sel=["one_over_reso"],
+                            save_freq=1, display=False, **kwargs)
+        return stats, outdir
+
+    def test_do_training_validate_every(self, tmp_path):
+        _, outdir = self._train_synthetic(tmp_path, "out", max_ep=3, validate_every=2, train_validate_size=8)
+        # epoch 1 was not validated, its checkpoint has no loss (and ranks last in the rotation)
+        assert torch.load(os.path.join(outdir, "nety_ep1.chkpt"), weights_only=False)["loss"] is None
+        assert isinstance(torch.load(os.path.join(outdir, "nety_ep2.chkpt"), weights_only=False)["loss"], float)
+
+    def test_do_training_early_stop(self, tmp_path):
+        # with a huge delta, only the first validation counts as an improvement
+        stats, outdir = self._train_synthetic(tmp_path, "out", max_ep=5, validate_every=1,
+                                              early_stop=1, early_stop_delta=1e9)
+        assert len(stats) == 2
+        assert os.path.exists(os.path.join(outdir, "nety_ep2.chkpt"))
+        assert not os.path.exists(os.path.join(outdir, "nety_ep3.chkpt"))
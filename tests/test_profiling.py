@@ -0,0 +1,30 @@
+import json
+import pytest
+import torch
+
+from resonet.utils.profiling import StepProfiler, parse_steps
+
+
+def test_parse_steps():
+    assert parse_steps("2:5") == (2, 5)
+    assert parse_steps((0, 1)) == (0, 1)
+    for bad in ["5:2", "3", "a:b"]:
+        with pytest.raises(ValueError):
+            parse_steps(bad)
+
+
+def test_step_profiler(tmp_path):
+    model = torch.nn.Linear(8, 2)
+    profiler = StepProfiler("1:3", str(tmp_path), "profile_test")
+    for i in range(5):
+        profiler.step()
+        assert profiler.active == (1 <= i < 3)
+        model(torch.randn(4, 8)).sum().backward()
+    profiler.close()
+    with open(profiler.trace_file) as f:
+        trace = json.load(f)
+    assert len(trace["traceEvents"])
+    with open(profiler.table_file) as f:
+        table = f.read()
+    assert table.startswith("Profiled steps 1:3")
+    assert "aten::" in table
@@ -0,0 +1,49 @@
+import h5py
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from resonet.sims import main as sim_main
+from resonet.sims import stream
+
+
+def _fake_producer(sim_args, jid, gvec=None):
+    """stands in for the simulator: label 0 counts the shots of each producer"""
+    i_shot = 0
+    while True:
+        labels = np.zeros(len(sim_main.PARAM_NAMES))
+        labels[0] = i_shot
+        labels[1] = jid
+        img = np.full((8, 8), i_shot % 256, np.uint8)
+        yield img, list(labels), [100, 1, 0.1, 8, 8]
+        i_shot += 1
+
+
+def test_stream(tmp_path):
+    sim_args = stream.parse_sim_args("--uint8 --cpuMode")
+    dset = stream.SimStreamDset(sim_args, num_shots=12, num_producers=2, queue_size=4, seed=0,
+                                tee_dir=str(tmp_path / "tee"), label_sel=["reso", "one_over_reso"],
+                                use_geom=True, producer=_fake_producer)
+    try:
+        for epoch in range(2):
+            nimg = 0
+            for img, lab, geom in DataLoader(dset, batch_size=4):
+                assert img.shape == (4, 1, 8, 8) and img.dtype == torch.uint8
+                assert torch.all(img[:, 0, 0, 0] == lab[:, 0].to(torch.uint8))
+                assert torch.all(geom[:, 0] == 100) and torch.all(geom[:, 1] == 0.1)  # detdist, pixsize
+                nimg += len(img)
+            assert nimg == 12
+    finally:
+        dset.close()
+
+    # producers tee every shot they make, in the rank*.h5 format
+    ntee = 0
+    for jid in range(2):
+        with h5py.File(str(tmp_path / "tee" / ("rank%d.h5" % jid)), "r") as h:
+            labels = h["labels"][()]
+            assert list(h["labels"].attrs["names"]) == sim_main.PARAM_NAMES
+            assert h["images"].dtype == np.uint8
+            assert np.all(labels[:, 0] == np.arange(len(labels)))
+            assert np.all(labels[:, 1] == jid)
+            ntee += len(labels)
+    assert ntee >= 24
@@ -0,0 +1,75 @@
+"""
+Batched data augmentation, applied to collated batches on the training device.
+Only exact symmetries are used (flips, rotations by multiples of 90 degrees, and integer shifts),
+so pixel values are never interpolated.
+"""
+
+import torch
+
+
+def dihedral(imgs, rot90=True):
+    """
+    apply a random element of the dihedral group (flips and 90 degree rotations) to each image
+    :param imgs: tensor of shape (N, C, H, W)
+    :param rot90: use the 90 degree rotations (requires H == W). Otherwise only
+        flips and 180 degree rotations are used
+    :return: augmented tensor, same shape as imgs
+    """
+    nsym = 8 if rot90 else 4
+    if rot90 and imgs.shape[-1] != imgs.shape[-2]:
+        raise ValueError("rot90 requires square images, got shape %s" % (tuple(imgs.shape[-2:]),))
+    syms = torch.randint(nsym, (imgs.shape[0],), device=imgs.device)
+    # sym = 2*k + f: rotate by k (or 2k if not rot90) quarter turns, after an optional horizontal flip.
+    # every variant is computed for the whole batch and selected per sample, so nothing waits on the device
+    flip = (syms % 2 == 1)[:, None, None, None]
+    k = syms // 2 if rot90 else 2*(syms // 2)
+    x = torch.where(flip, torch.flip(imgs, dims=(-1,)), imgs)
+    out = x
+    for quarter_turns in ([1, 2, 3] if rot90 else [2]):
+        out = torch.where((k == quarter_turns)[:, None, None, None], torch.rot90(x, quarter_turns, dims=(-2, -1)), out)
+    return out
+
+
+def shift(imgs, max_shift):
+    """
+    shift each image by a random integer number of pixels, filling the exposed border with zeros
+    :param imgs: tensor of shape (N, C, H, W)
+    :param max_shift: shifts are drawn uniformly from [-max_shift, max_shift] along each axis
+    :return: shifted tensor, same shape as imgs
+    """
+    N, _, H, W = imgs.shape
+    dy, dx = torch.randint(-max_shift, max_shift+1, (2, N, 1), device=imgs.device)
+    rows = torch.arange(H, device=imgs.device) - dy  # source row for each output row, (N, H)
+    cols = torch.arange(W, device=imgs.device) - dx  # (N, W)
+    valid = ((rows >= 0) & (rows < H))[:, :, None] & ((cols >= 0) & (cols < W))[:, None, :]
+    batch = torch.arange(N, device=imgs.device)[:, None, None]
+    out = imgs[batch, :, rows.clamp(0, H-1)[:, :, None], cols.clamp(0, W-1)[:, None, :]]  # (N, H, W, C)
+    out = out.permute(0, 3, 1, 2) * valid[:, None].to(imgs.dtype)
+    return out.contiguous()
+
+
+class BatchAugment:
+
+    def __init__(self, flips=True, rot90=True, max_shift=0):
+        """
+        replaces per-sample torchvision transforms (see H5SimDataDset transform). Call on each
+        batch of images after it is moved to the device
+
+        :param flips: apply random flips and 180 degree rotations
+        :param rot90: also apply random 90 degree rotations (only if flips is True, requires square images)
+        :param max_shift: if >0, also shift images by up to this many pixels along each axis
+        """
+        self.flips = flips
+        self.rot90 = rot90
+        self.max_shift = max_shift
+
+    def __call__(self, imgs):
+        """
+        :param imgs: tensor of shape (N, C, H, W)
+        :return: augmented tensor
+        """
+        if self.flips:
+            imgs = dihedral(imgs, self.rot90)
+        if self.max_shift > 0:
+            imgs = shift(imgs, self.max_shift)
+        return imgs
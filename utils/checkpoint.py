@@ -0,0 +1,131 @@
+"""
+Write training checkpoints from a background thread, so rank 0 does not stall the other ranks.
+State is copied to the CPU when it is submitted, then written to a temporary file and renamed,
+so a checkpoint file on disk is always complete. Old checkpoints are rotated away.
+"""
+
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+def to_cpu(state):
+    """
+    :param state: (nested dicts/lists/tuples of) tensors and other values, e.g. a state_dict
+    :return: the same structure, with every tensor copied to the CPU
+    """
+    if isinstance(state, torch.Tensor):
+        state = state.detach()
+        # a CPU tensor would be updated in place by the next optimizer step, so always copy
+        return state.clone() if state.device.type == "cpu" else state.cpu()
+    if isinstance(state, dict):
+        return type(state)((key, to_cpu(val)) for key, val in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(val) for val in state)
+    return state
+
+
+def rng_states():
+    """:return: the python, numpy and torch (and cuda, if available) random number generator states of this process"""
+    name, key, pos, has_gauss, gauss = np.random.get_state()
+    # plain python values, so the states can be loaded with torch.load(weights_only=True)
+    states = {"python": random.getstate(), "numpy": (name, key.tolist(), pos, has_gauss, gauss),
+              "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    """:param states: random number generator states from rng_states()"""
+    random.setstate(states["python"])
+    name, key, pos, has_gauss, gauss = states["numpy"]
+    np.random.set_state((name, np.array(key, dtype=np.uint32), pos, has_gauss, gauss))
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def atomic_save(obj, filename):
+    """torch.save to a temporary file in the same folder, then rename it to filename"""
+    tmpname = filename + ".tmp"
+    torch.save(obj, tmpname)
+    os.replace(tmpname, filename)
+
+
+class CheckpointWriter:
+
+    def __init__(self, keep_last=None, keep_best=0):
+        """
+        :param keep_last: keep the files of the last N submitted checkpoints (default keeps all)
+        :param keep_best: also keep the files of the K checkpoints with the lowest loss
+        """
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.saved = []  # (files, loss) of the checkpoints on disk, oldest first
+        self.error = None
+        # at most one checkpoint waits while another is written, that bounds the extra host memory
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            files, loss, rotate = item
+            try:
+                for filename, obj in files.items():
+                    atomic_save(obj, filename)
+                if rotate:
+                    self.saved.append((list(files), loss))
+                    self._rotate()
+            except Exception as err:
+                self.error = err
+            finally:
+                self.queue.task_done()
+
+    def _rotate(self):
+        if self.keep_last is None:
+            return
+        nsaved = len(self.saved)
+        keep = set(range(max(nsaved-self.keep_last, 0), nsaved))
+        losses = [np.inf if loss is None else loss for _, loss in self.saved]
+        keep.update(np.argsort(losses, kind="stable")[:self.keep_best].tolist())
+        for i in range(nsaved):
+            if i not in keep:
+                for filename in self.saved[i][0]:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+        self.saved = [self.saved[i] for i in sorted(keep)]
+
+    def _check(self):
+        if self.error is not None:
+            err, self.error = self.error, None
+            raise RuntimeError("writing a checkpoint failed") from err
+
+    def submit(self, files, loss=None, rotate=True):
+        """
+        copy state to the CPU and write it in the background (waits if the previous checkpoint is still being written)
+        :param files: dict of filename: object to save (e.g. a state_dict, or a dict from checkpoint_state)
+        :param loss: test loss of this checkpoint, used to keep the best ones (None counts as worst)
+        :param rotate: if False, these files are never deleted by the rotation (e.g. for the final model)
+        """
+        self._check()
+        self.queue.put(({filename: to_cpu(obj) for filename, obj in files.items()}, loss, rotate))
+
+    def wait(self):
+        """block until all submitted checkpoints are on disk"""
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        """write the remaining checkpoints and stop the writer thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check()
@@ -1,5 +1,6 @@
 import os
 import socket
+import torch
 import torch.distributed as td
 from contextlib import closing
 
@@ -12,7 +13,25 @@ def find_free_port():
         return s.getsockname()[1]
 
 
-def slurm_init(WORLD_COMM=None, LOCAL_COMM=None):
+def default_backend():
+    """nccl if GPUs are available, else gloo (CPU-only nodes)"""
+    return "nccl" if torch.cuda.is_available() else "gloo"
+
+
+def env_init(backend=None):
+    """
+    initialize torch.distributed from the environment set by torchrun (RANK, WORLD_SIZE, MASTER_ADDR, ...),
+    without SLURM or mpi4py, e.g. torchrun --nproc_per_node 8 net.py 100 master.h5 out --cpu --ddp
+    :param backend: torch.distributed backend, default is nccl with GPUs, and gloo otherwise
+    :return: rank and world size
+    """
+    if backend is None:
+        backend = default_backend()
+    td.init_process_group(backend=backend, init_method="env://")
+    return td.get_rank(), td.get_world_size()
+
+
+def slurm_init(WORLD_COMM=None, LOCAL_COMM=None, backend="nccl"):
 
     try:
         if WORLD_COMM is None:
@@ -35,4 +54,41 @@ def slurm_init(WORLD_COMM=None, LOCAL_COMM=None):
     except Exception:
         print("Run in a slrum environment on NERSC, or else adjust the above env vars for your env!")
 
-    td.init_process_group(backend='nccl', init_method="env://")
+    td.init_process_group(backend=backend, init_method="env://")
+
+
+COMM_HOOKS = ["fp16", "bf16", "powersgd"]
+
+
+def register_comm_hook(model, hook, powersgd_rank=1, powersgd_start=1000):
+    """
+    compress the gradient allreduce of a DistributedDataParallel model
+    :param model: DistributedDataParallel model
+    :param hook: fp16 or bf16 (cast gradients for the allreduce), or powersgd (low-rank approximation)
+    :param powersgd_rank: matrix approximation rank of PowerSGD (higher is more accurate, and more traffic)
+    :param powersgd_start: number of iterations with uncompressed allreduce before PowerSGD starts
+    :return: the hook state (None, or the PowerSGDState)
+    """
+    from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+    if hook not in COMM_HOOKS:
+        raise ValueError("hook should be one of %s" % ", ".join(COMM_HOOKS))
+    state = None
+    if hook == "fp16":
+        model.register_comm_hook(state, default_hooks.fp16_compress_hook)
+    elif hook == "bf16":
+        model.register_comm_hook(state, default_hooks.bf16_compress_hook)
+    else:
+        state = powerSGD_hook.PowerSGDState(process_group=None, matrix_approximation_rank=powersgd_rank,
+                                            start_powerSGD_iter=powersgd_start)
+        model.register_comm_hook(state, powerSGD_hook.powerSGD_hook)
+    return state
+
+
+def consolidate_optimizer(optimizer, to=0):
+    """
+    a ZeroRedundancyOptimizer shards its state across ranks, so before its state_dict is saved
+    on rank `to`, every rank must call this. Does nothing for other optimizers
+    """
+    from torch.distributed.optim import ZeroRedundancyOptimizer
+    if isinstance(optimizer, ZeroRedundancyOptimizer):
+        optimizer.consolidate_state_dict(to=to)
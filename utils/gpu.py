@@ -1,5 +1,7 @@
+import warnings
 import torch
 
+
 def get_mem(dev_id):
     # https://stackoverflow.com/a/58216793/2077270
     t = torch.cuda.get_device_properties(dev_id).total_memory
@@ -9,5 +11,53 @@ def get_mem(dev_id):
     return t/1024**3,f/1024**3
 
 
+class SyncCounter:
+
+    def __init__(self, dev, enabled=True):
+        """
+        counts the host-device synchronizations made by CUDA operations (e.g. .item(), or indexing with a mask),
+        using torch.cuda.set_sync_debug_mode. Call start() and stop() around each step.
+        This adds overhead to every sync, so it is meant for debugging.
+        On other devices nothing is counted (enabled is False)
+
+        :param dev: the training device
+        :param enabled: if False, start() and stop() do nothing
+        """
+        self.enabled = enabled and torch.device(dev).type == "cuda"
+        self.nsync = 0
+        self.nstep = 0
+        self._catcher = self._records = None
+        self._reemitted = set()  # warnings recorded during the steps are re-emitted once per message and location
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._catcher = warnings.catch_warnings(record=True)
+        self._records = self._catcher.__enter__()
+        warnings.simplefilter("always")
+        torch.cuda.set_sync_debug_mode("warn")
 
+    def stop(self):
+        if not self.enabled:
+            return
+        torch.cuda.set_sync_debug_mode("default")
+        records = self._records
+        self._catcher.__exit__(None, None, None)
+        self._catcher = self._records = None
+        self.nstep += 1
+        for rec in records:
+            if "synchroniz" in str(rec.message):
+                self.nsync += 1
+            else:
+                # other warnings of the step go through the restored warning filters. The filters are reset every step
+                # (which clears the warnings registries), so repeats are skipped here
+                key = str(rec.message), rec.category, rec.filename, rec.lineno
+                if key not in self._reemitted:
+                    self._reemitted.add(key)
+                    warnings.warn_explicit(rec.message, rec.category, rec.filename, rec.lineno)
 
+    def per_step(self):
+        """:return: syncs per step since the last call (and resets the counts)"""
+        val = self.nsync / max(self.nstep, 1)
+        self.nsync = self.nstep = 0
+        return val
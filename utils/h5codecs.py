@@ -0,0 +1,46 @@
+"""
+HDF5 compression codecs for training data.
+gzip ships with h5py, the faster-decoding codecs (bitshuffle+LZ4, Blosc) require hdf5plugin.
+Importing this module registers the hdf5plugin filters, which is required for reading files written with them.
+"""
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+HAS_HDF5PLUGIN = hdf5plugin is not None
+
+CODECS = ["gzip", "bslz4", "blosc-lz4", "blosc-zstd"]
+
+
+def get_comp_args(codec="gzip", clevel=None):
+    """
+
+    Parameters
+    ----------
+    codec: str, one of CODECS
+        gzip: deflate with byte shuffle (slowest decode)
+        bslz4: bitshuffle + LZ4 (fast decode, the format used by Eiger detectors)
+        blosc-lz4: Blosc with bitshuffle and LZ4
+        blosc-zstd: Blosc with bitshuffle and Zstd (best ratio of the fast codecs)
+    clevel: int, optional compression level (gzip and blosc only)
+
+    Returns
+    -------
+    dict of keyword arguments for h5py create_dataset
+    """
+    if codec not in CODECS:
+        raise ValueError("codec should be one of %s" % ", ".join(CODECS))
+    if codec == "gzip":
+        return {"compression": "gzip", "compression_opts": 4 if clevel is None else clevel, "shuffle": True}
+
+    if not HAS_HDF5PLUGIN:
+        raise ImportError("codec %s requires hdf5plugin (pip install hdf5plugin)" % codec)
+    if codec == "bslz4":
+        filt = hdf5plugin.Bitshuffle(cname="lz4")
+    else:
+        cname = codec.split("-")[1]
+        filt = hdf5plugin.Blosc(cname=cname, clevel=5 if clevel is None else clevel,
+                                shuffle=hdf5plugin.Blosc.BITSHUFFLE)
+    return dict(filt)
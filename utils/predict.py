@@ -6,6 +6,7 @@ from collections.abc import Iterable
 from resonet.utils.eval_model import load_model, to_tens
 from resonet.utils.ice_mask import IceMasker
 from resonet.utils.counter_utils import mx_gamma, load_count_model, process_image
+from resonet.utils.profiling import StepProfiler
 
 """
 """
@@ -46,7 +47,7 @@ class ImagePredict:
 
     def __init__(self, reso_model=None, multi_model=None, ice_model=None, counts_model=None,
                  reso_arch=None, multi_arch=None, ice_arch=None, counts_arch=None,
-                 dev="cpu", use_modern_reso=True, B_to_d=None):
+                 dev="cpu", use_modern_reso=True, B_to_d=None, profile_steps=None, profile_dir="."):
         """
 
         Parameters
@@ -62,6 +63,9 @@ class ImagePredict:
         dev: device string (e.g. 'cpu' or 'cuda:0')
         use_modern_reso: bool, whether to use the d_to_dnew method to alter resolution
         B_to_d: str, path to the MLP model for estimating reso from B factor
+        profile_steps: str start:stop, profile the preprocessing and predictions of these images with torch.profiler.
+            Images are counted from 0 by calls to _set_pixel_tensor, and each step lasts until the next call
+        profile_dir: str, folder for the profiler outputs (profile_predict_trace.json and profile_predict_ops.txt)
         """
         self.ice_masker = None   # instance of resonet.utiuls.ice_masker.IceMasker
         self.pixels = None  # this is the image tensor, a (512x512) representation of the diffraction shot
@@ -92,6 +96,9 @@ class ImagePredict:
         self.gain = 1  # adu per photon
         self.raw_image = None
         self.cache_raw_image = False
+        self.profiler = None
+        if profile_steps is not None:
+            self.profiler = StepProfiler(profile_steps, profile_dir, "profile_predict")
 
     def _try_load_B_to_d(self, path):
         """path: saved MLP model for estimating reso from Bfactor"""
@@ -267,6 +274,8 @@ class ImagePredict:
 
     def _set_pixel_tensor(self, raw_img):
         """pass in a raw image (2D array) and convert it to an torch tensor for prediction"""
+        if self.profiler is not None:
+            self.profiler.step()
         # check for mask and set a default if none found
         self._set_default_mask(raw_img)
 
@@ -301,6 +310,11 @@ class ImagePredict:
         if self.cache_raw_image:
             self.raw_image = raw_img
 
+    def stop_profiler(self):
+        """write the profiler outputs, if fewer images than profile_steps stop were processed"""
+        if self.profiler is not None:
+            self.profiler.close()
+
     def _set_default_mask(self, raw_img):
         if self.mask is None or raw_img.shape != self.mask.shape:
             mask = raw_img >= 0
@@ -32,6 +32,25 @@ class ImagePredictDxtbx(ImagePredict):
         :param image_file:  path to an image file readable by DXTBX
         :param use_ice_mask: bool, whether or not to add ice rings to the loaded image
         """
+        raw_image, det, beam = self.get_image_array(image_file, filenum)
+
+        self.xdim, self.ydim = det[0].get_image_size()
+        self.pixsize_mm = det[0].get_pixel_size()[0]
+        self.detdist_mm = abs(det[0].get_distance())
+        self.wavelen_Angstrom = beam.get_wavelength()
+        self._set_geom_tensor()
+        if use_ice_mask:
+            dxtbx_geom = {"detector":det, "beam": beam}
+            self.set_ice_mask(dxtbx_geom=dxtbx_geom)
+        self._set_pixel_tensor(raw_image)
+
+    @staticmethod
+    def get_image_array(image_file, filenum=0):
+        """
+        :param image_file:  path to an image file readable by DXTBX
+        :param filenum: image number, for multi-image formats (e.g. NeXus)
+        :return: the raw image (float32 2D numpy array), and the dxtbx detector and beam models
+        """
         loader = dxtbx.load(image_file)
         try:
             raw_image = loader.get_raw_data()
@@ -58,13 +77,4 @@ class ImagePredictDxtbx(ImagePredict):
             raw_image = raw_image[0]
         if not raw_image.dtype == np.float32:
             raw_image = raw_image.astype(np.float32)
-
-        self.xdim, self.ydim = det[0].get_image_size()
-        self.pixsize_mm = det[0].get_pixel_size()[0]
-        self.detdist_mm = abs(det[0].get_distance())
-        self.wavelen_Angstrom = beam.get_wavelength()
-        self._set_geom_tensor()
-        if use_ice_mask:
-            dxtbx_geom = {"detector":det, "beam": beam}
-            self.set_ice_mask(dxtbx_geom=dxtbx_geom)
-        self._set_pixel_tensor(raw_image)
+        return raw_image, det, beam
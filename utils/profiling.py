@@ -0,0 +1,80 @@
+"""
+Capture a window of steps (training batches, or predicted images) with torch.profiler.
+When the window closes, a Chrome trace (open in chrome://tracing or https://ui.perfetto.dev)
+and a table of the most expensive operators are written to disk.
+"""
+
+import os
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+
+def parse_steps(steps):
+    """
+    :param steps: string start:stop, or a (start, stop) pair
+    :return: start, stop (ints, start < stop)
+    """
+    if isinstance(steps, str):
+        try:
+            start, stop = (int(val) for val in steps.split(":"))
+        except ValueError:
+            raise ValueError("profile steps should be start:stop, got %s" % steps)
+    else:
+        start, stop = steps
+    if not 0 <= start < stop:
+        raise ValueError("profile steps should satisfy 0 <= start < stop, got %d:%d" % (start, stop))
+    return start, stop
+
+
+class StepProfiler:
+
+    def __init__(self, steps, outdir, name="profile", row_limit=30):
+        """
+        call step() at the start of every step. Steps are counted from 0, and steps start..stop-1 are profiled
+        (with input shapes and memory). The outputs are outdir/name_trace.json and outdir/name_ops.txt
+
+        :param steps: start:stop string or (start, stop) pair, see parse_steps
+        :param outdir: output folder
+        :param name: prefix of the output files
+        :param row_limit: number of operators in the table
+        """
+        self.start, self.stop = parse_steps(steps)
+        self.trace_file = os.path.join(outdir, name + "_trace.json")
+        self.table_file = os.path.join(outdir, name + "_ops.txt")
+        self.row_limit = row_limit
+        self.nstep = 0
+        self.prof = None
+
+    def step(self):
+        """marks the start of a step, the profiler is started and stopped here"""
+        if self.nstep == self.start:
+            activities = [ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            self.prof = profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.prof.start()
+        elif self.nstep == self.stop:
+            self.close()
+        elif self.prof is not None:
+            self.prof.step()
+        self.nstep += 1
+
+    @property
+    def active(self):
+        return self.prof is not None
+
+    def close(self):
+        """stop profiling (if the window is still open, e.g. training ended early) and write the outputs"""
+        if self.prof is None:
+            return
+        prof, self.prof = self.prof, None
+        prof.stop()
+        outdir = os.path.dirname(self.trace_file)
+        if outdir and not os.path.exists(outdir):
+            os.makedirs(outdir)
+        prof.export_chrome_trace(self.trace_file)
+        sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        table = prof.key_averages().table(sort_by=sort_by, row_limit=self.row_limit)
+        with open(self.table_file, "w") as f:
+            f.write("Profiled steps %d:%d\n" % (self.start, min(self.nstep, self.stop)))
+            f.write(table + "\n")
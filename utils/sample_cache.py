@@ -0,0 +1,197 @@
+"""
+Node-wide cache of decoded training images in POSIX shared memory.
+Every process (DDP ranks on a node, and their DataLoader workers) that opens a cache with the same name
+shares one arena of fixed-size slots, so each image is read and decompressed once per node,
+and later epochs are served from memory. Access is serialized with an flock on a small lock file.
+"""
+
+import os
+import fcntl
+import hashlib
+import tempfile
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+POLICIES = ["lru", "first"]
+
+# header of the table segment: int64 values
+_CLOCK, _HITS, _MISSES, _NSTORED, _NITEMS, _NSLOTS, _ITEM_NBYTES = range(7)
+_HEADER_LEN = 8
+
+
+def cache_name(*keys):
+    """a shared memory name derived from keys (e.g. the data file and image dtype), the same in every process"""
+    digest = hashlib.sha1("|".join(str(k) for k in keys).encode()).hexdigest()[:16]
+    return "resonet_%s" % digest
+
+
+class SharedSampleCache:
+
+    def __init__(self, name, num_items, item_shape, item_dtype, budget_bytes, policy="lru"):
+        """
+        :param name: shared memory name. Processes using the same name share the cache
+        :param num_items: number of dataset items (items are cached by their index in range(num_items))
+        :param item_shape: shape of each cached array
+        :param item_dtype: dtype of each cached array
+        :param budget_bytes: maximum number of bytes of cached data (rounded down to whole items)
+        :param policy: `lru` evicts the least recently used items when the cache is full,
+            `first` keeps the first items that were stored and caches nothing after the cache is full
+        """
+        if policy not in POLICIES:
+            raise ValueError("policy should be one of %s" % ", ".join(POLICIES))
+        self.name = name
+        self.num_items = num_items
+        self.item_shape = tuple(item_shape)
+        self.item_dtype = np.dtype(item_dtype)
+        self.item_nbytes = int(np.prod(self.item_shape)) * self.item_dtype.itemsize
+        self.num_slots = int(min(budget_bytes // self.item_nbytes, num_items))
+        if self.num_slots < 1:
+            raise ValueError("cache budget of %d bytes is smaller than one item (%d bytes)"
+                             % (budget_bytes, self.item_nbytes))
+        self.policy = policy
+        self.lockname = os.path.join(tempfile.gettempdir(), name + ".lock")
+        self.owner_pid = None  # the process that created the shared memory unlinks it (see close)
+        self._shm = None
+        self._attach()
+
+    def __getstate__(self):
+        # worker processes started with spawn re-attach by name
+        state = self.__dict__.copy()
+        state["_shm"] = None
+        return state
+
+    def _lock(self):
+        # a new descriptor per acquisition: flock locks are shared by descriptors inherited through fork
+        fd = os.open(self.lockname, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    @staticmethod
+    def _unlock(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _attach(self):
+        table_nbytes = (_HEADER_LEN + self.num_items + 2*self.num_slots) * 8
+        fd = self._lock()
+        try:
+            try:
+                table = shared_memory.SharedMemory(self.name + "_table", create=True, size=table_nbytes)
+                data = shared_memory.SharedMemory(self.name + "_data", create=True,
+                                                  size=self.num_slots*self.item_nbytes)
+                created = True
+            except FileExistsError:
+                table = shared_memory.SharedMemory(self.name + "_table")
+                data = shared_memory.SharedMemory(self.name + "_data")
+                # only the creator should unlink the memory
+                resource_tracker.unregister(table._name, "shared_memory")
+                resource_tracker.unregister(data._name, "shared_memory")
+                created = False
+            self._shm = table, data
+            self._setup_views()
+            if created:
+                self.header[:] = 0
+                self.header[[_NITEMS, _NSLOTS, _ITEM_NBYTES]] = self.num_items, self.num_slots, self.item_nbytes
+                self.slot_of_item[:] = -1
+                self.item_of_slot[:] = -1
+                self.last_used[:] = 0
+                self.owner_pid = os.getpid()
+        finally:
+            self._unlock(fd)
+        layout = self.num_items, self.num_slots, self.item_nbytes
+        existing = tuple(self.header[[_NITEMS, _NSLOTS, _ITEM_NBYTES]])
+        if existing != layout:
+            raise ValueError("shared memory %s has (items, slots, item bytes)=%s, expected %s. "
+                             "Use a different cache name." % (self.name, existing, layout))
+
+    def _setup_views(self):
+        table, data = self._shm
+        vals = np.ndarray((_HEADER_LEN + self.num_items + 2*self.num_slots,), dtype=np.int64, buffer=table.buf)
+        self.header = vals[:_HEADER_LEN]
+        self.slot_of_item = vals[_HEADER_LEN: _HEADER_LEN+self.num_items]
+        self.item_of_slot = vals[_HEADER_LEN+self.num_items: _HEADER_LEN+self.num_items+self.num_slots]
+        self.last_used = vals[_HEADER_LEN+self.num_items+self.num_slots:]
+        self.slots = np.ndarray((self.num_slots,) + self.item_shape, dtype=self.item_dtype, buffer=data.buf)
+
+    def get(self, items):
+        """
+        :param items: item indices
+        :return: list with a copy of each cached item, or None where the item isn't cached
+        """
+        if self._shm is None:
+            self._attach()
+        out = [None]*len(items)
+        fd = self._lock()
+        try:
+            slots = self.slot_of_item[items]
+            nhit = 0
+            for i, slot in enumerate(slots):
+                if slot >= 0:
+                    out[i] = self.slots[slot].copy()
+                    nhit += 1
+            if self.policy == "lru":
+                self.header[_CLOCK] += 1
+                self.last_used[slots[slots >= 0]] = self.header[_CLOCK]
+            self.header[_HITS] += nhit
+            self.header[_MISSES] += len(items) - nhit
+        finally:
+            self._unlock(fd)
+        return out
+
+    def put(self, items, arrays):
+        """
+        store arrays in the cache (items already stored are skipped, and nothing is evicted by the `first` policy)
+        :param items: item indices
+        :param arrays: an array for each item, with the cache item shape (converted to the cache dtype)
+        """
+        if self._shm is None:
+            self._attach()
+        fd = self._lock()
+        try:
+            todo = [i for i, item in enumerate(items) if self.slot_of_item[item] < 0]
+            nfree = self.num_slots - self.header[_NSTORED]
+            if len(todo) > nfree and self.policy == "first":
+                todo = todo[:nfree]
+            todo = todo[:self.num_slots]
+            nstored = self.header[_NSTORED]
+            free = np.arange(nstored, nstored+min(nfree, len(todo)))
+            slots = list(free)
+            nevict = len(todo) - len(free)
+            if nevict > 0:
+                # least recently used of the slots that were already filled
+                evict = np.argpartition(self.last_used[:nstored], nevict-1)[:nevict]
+                self.slot_of_item[self.item_of_slot[evict]] = -1
+                slots += list(evict)
+            self.header[_NSTORED] += len(free)
+            self.header[_CLOCK] += 1
+            for i, slot in zip(todo, slots):
+                self.slots[slot] = arrays[i]
+                self.slot_of_item[items[i]] = slot
+                self.item_of_slot[slot] = items[i]
+                self.last_used[slot] = self.header[_CLOCK]
+        finally:
+            self._unlock(fd)
+
+    def stats(self):
+        """
+        :return: dict with the hits and misses so far (summed over all processes using the cache),
+            the hit rate, and the number of stored items and bytes
+        """
+        if self._shm is None:
+            self._attach()
+        hits, misses, nstored = (int(v) for v in self.header[[_HITS, _MISSES, _NSTORED]])
+        return {"hits": hits, "misses": misses, "hit_rate": hits / max(hits+misses, 1),
+                "items": nstored, "nbytes": nstored*self.item_nbytes}
+
+    def close(self):
+        """detach from the shared memory, and unlink it if this process created it"""
+        if self._shm is None:
+            return
+        del self.header, self.slot_of_item, self.item_of_slot, self.last_used, self.slots
+        for shm in self._shm:
+            shm.close()
+            if self.owner_pid == os.getpid():
+                shm.unlink()
+        if self.owner_pid == os.getpid() and os.path.exists(self.lockname):
+            os.remove(self.lockname)
+        self._shm = None